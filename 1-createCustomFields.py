@@ -4,8 +4,12 @@
 Like all scripts in this project, this script requires that the `config/app.ini`
 file has been set up already. Check out the README.md file in this project for
 more information on configuration.
+
+Fields that already exist in Pardot are left alone, so if a previous run was
+interrupted (or some fields could not be created), simply run it again.
 """
-import demoFunctions, os.path, sys
+import demoFunctions, sys
+from fieldSchema import customFieldDefinitions, formatFieldName
 
 # read our configuration
 config = demoFunctions.readConfig()
@@ -13,30 +17,43 @@ config = demoFunctions.readConfig()
 # login to the org
 demoFunctions.authenticate(config)
 
-# make sure we haven't previously created fields
-if os.path.isfile('config/fields.csv'):
-    print('This script has already generated fields in the past. Please delete them first using '\
-        + '5-deleteCustomFields.py, then try re-running this script')
-    sys.exit(10)
-
-# create the fields to support the Template, which aren't specific to the number of 
-# listings we want to display
-demoFunctions.createCustomField(config,'Count','')
-demoFunctions.createCustomField(config,'AgentName','')
-
-
-# loop through number of listings we can have at most in an email
+# the fields to support the Template: the ones which aren't specific to the number of listings,
+# then a group of fields for each listing we can have at most in an email. Fields will be named
+# with the prefix defined in app.ini (for example: PD2021_Listing_XXXXXXXX)
 itemCount = int(config['Field Naming']['listing_count_max'])
-print('need to create {lineItemCount} groups of custom fields'\
-        .format(lineItemCount = itemCount))
-
-for i in range(1,itemCount+1):
-    # loop through all the fields, creating them all
-    print('Creating Fields for listing {lineItemNumber}'\
-            .format(lineItemNumber = i))
-            
-    # fields will be named with the prefix defined in app.ini (for example: PD2021_Listing_XXXXXXXX)
-    demoFunctions.createCustomFields(config, ['Price','Bedrooms','Bathrooms','Sqft','Address',
-                                                'ListingUrl','ImageUrl'], i)
-
-print('Done creating fields, details stored in config/fields.csv')
\ No newline at end of file
+definitions = customFieldDefinitions(itemCount)
+print('need {fieldCount} custom fields, for up to {lineItemCount} listings'\
+        .format(fieldCount = len(definitions), lineItemCount = itemCount))
+
+# find out which fields were already created, by an earlier run or by hand
+existing = demoFunctions.queryCustomFields(config)
+if existing is None:
+    sys.exit(10)
+apiNames = [formatFieldName(config['Field Naming']['api_format'], fieldName, rowNum) for fieldName, rowNum in definitions]
+fields = {apiName: existing[apiName] for apiName in apiNames if apiName in existing}
+toCreate = [definition for definition, apiName in zip(definitions, apiNames) if apiName not in existing]
+print('{existingCount} fields already exist, creating the other {createCount}' \
+        .format(existingCount = len(fields), createCount = len(toCreate)))
+
+# create the missing fields, a few at a time (see [Concurrency] in config/app.ini)
+workers = config.getint('Concurrency', 'workers', fallback=1)
+fields.update(demoFunctions.createCustomFields(config, toCreate, workers))
+
+# store every field in a CSV, in creation order, so that they can be later deleted. Fields from an
+# earlier run that are still around (for example with a larger listing_count_max) stay in there too,
+# so 5-deleteCustomFields.py removes them as well
+manifest = {apiName: fields[apiName] for apiName in apiNames if apiName in fields}
+for apiName, fieldId in demoFunctions.readFieldsManifest().items():
+    if existing.get(apiName) == fieldId:
+        manifest.setdefault(apiName, fieldId)
+demoFunctions.writeFieldsManifest(manifest)
+
+demoFunctions.reportDeadLetters(config)
+missingCount = len([apiName for apiName in apiNames if apiName not in fields])
+if missingCount:
+    print('{missingCount} fields could not be created, run this script again to create them' \
+            .format(missingCount = missingCount))
+else:
+    print('Done creating fields, details stored in config/fields.csv')
+# the email template needs a listing slot for each listing, see buildEmailTemplate.py
+demoFunctions.checkEmailTemplate(config)
@@ -1,40 +1,56 @@
 #!/usr/bin/env python3
-import demoFunctions, requests, sys
-from dataServices import RecipientService, ListingService
-from mako.template import Template
-
-# read our configuration
-config = demoFunctions.readConfig()
-recipientService = RecipientService(config)
-listingService = ListingService(config)
-
-# login to the org
-demoFunctions.authenticate(config)
-
-# get our email template
-mailTemplate = Template(filename='templates/completeHtmlTemplate.html')
-
-# get a list of people that need emails!
-recipients = recipientService.getRecipientsNeedingWeeklyEmail()
-for recipient in recipients:
-    # get the listings we want to share with the recipient
-    listings = listingService.getListingsForRecipientId(recipient['id'])
-    print('for {firstName} {lastName}, we will show them {itemCount} listings' \
-            .format(firstName = recipient['firstName'], \
-                    lastName = recipient['lastName'], \
-                    itemCount = len(listings)))
-                    
-    emailHtml = mailTemplate.render(listings=listings, recipient=recipient)
-
-    # now that we've assembled our own HTML, we can send this directly to Pardot    
-    apiUrl = '{pardotUrl}/api/email/version/{legacyVersion}/do/send/prospect_id/{prospectId}?format=json' \
-            .format(pardotUrl = config['Pardot']['url'], \
-                    legacyVersion = config['Pardot']['legacy_api_version'], \
-                    prospectId = recipient['prospectId'])
+import argparse, demoFunctions, emailRenderer, metrics, os, time
+from concurrency import ThroughputTracker, runProcessThenSend
+from pardotClient import RequestFailed
+from dataServices import RecipientService, ListingService, recipientsWithListings
+
+TEMPLATE_FILENAME = 'templates/completeHtmlTemplate.html'
+
+def announceListings(recipientListings):
+    """Tells the console about each recipient, on its way to being rendered."""
+    for recipient, listings in recipientListings:
+        print('for {firstName} {lastName}, we will show them {itemCount} listings' \
+                .format(firstName = recipient['firstName'], \
+                        lastName = recipient['lastName'], \
+                        itemCount = len(listings)))
+        yield recipient, listings
+
+def emailPayload(recipient, listings):
+    """Provides what a recipient's email is made from, to tell whether it changed since last time."""
+    return {'firstName': recipient['firstName'], 'lastName': recipient['lastName'], 'agent': recipient['agent'], \
+            'listings': listings}
+
+def leaveOutUnchanged(config, recipientListings, payloadHashes):
+    """In incremental mode, leaves out the recipients whose email would be the same as last time.
+
+    The hash of every other recipient's email is put in payloadHashes, by
+    Prospect id, to be recorded once the email is sent.
+    """
+    for recipient, listings in recipientListings:
+        payloadHash = demoFunctions.incrementalPayloadHash(config, emailPayload(recipient, listings))
+        if demoFunctions.skipUnchangedPayload(config, recipient['prospectId'], payloadHash):
+            print('the email for {prospectId} did not change, skipping it'.format(prospectId = recipient['prospectId']))
+            continue
+        if payloadHash is not None:
+            payloadHashes[recipient['prospectId']] = payloadHash
+        yield recipient, listings
+
+def sendEmail(config, client, tracker, journal, payloadHashes, recipientListings, rendered):
+    """Sends the already rendered HTML email to a single recipient."""
+    started = time.perf_counter()
+    recipient, listings = recipientListings
+    payloadHash = payloadHashes.pop(recipient['prospectId'], None)
+    # rendering happened in another process, which timed it for us
+    emailHtml, renderSeconds, cacheHit = rendered
+    metrics.observe('email.render.cacheHit' if cacheHit else 'email.render', renderSeconds)
+
+    # now that we've assembled our own HTML, we can send this directly to Pardot
+    sendAction = 'send/prospect_id/{prospectId}'.format(prospectId = recipient['prospectId'])
+    apiUrl = client.legacyApiUrl('email', sendAction)
 
     print(apiUrl)
     reqData = {
-        # required fields for a one-to-one, providing complete HTML Content and Sender Details 
+        # required fields for a one-to-one, providing complete HTML Content and Sender Details
         # (not specifying Pardot User Id)
         'campaign_id': config['Pardot']['campaign_id'],
         'text_content': 'This is a demo, so we are skipping the text version. '\
@@ -45,19 +61,83 @@ for recipient in recipients:
         'from_name': 'ParDreamin Realty',
         'html_content' : emailHtml
     }
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-    }
 
-    response = requests.post(url=apiUrl, data=reqData, headers=reqHeaders)
-    json = response.json()
+    try:
+        response = client.legacyRequest('POST', 'email', sendAction, idempotent=False, data=reqData)
+        reason = demoFunctions.readLegacyResponse(response)[1]
+    except RequestFailed as e:
+        reason = e.reason
+    sent = reason is None
+
+    if not sent:
+        # keep going with the other recipients, this one can be looked into (and sent again) later
+        demoFunctions.deadLetter(config, 'email.send', {'prospectId': recipient['prospectId']}, reason)
+        return
+    print('Successfully sent email to {prospectId}'.format(prospectId = recipient['prospectId']))
+    metrics.count('emails.sent')
+    journal.record('sent', recipient['prospectId'])
+    demoFunctions.recordSentPayloads(config, [(recipient['prospectId'], payloadHash)])
+    tracker.record(time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends complete HTML emails to every recipient')
+    parser.add_argument('--resume', action='store_true', help='skip recipients already sent to by the previous run')
+    parser.add_argument('--shard', type=int, default=0, help='only send to the recipients of this shard (see runSharded.py)')
+    parser.add_argument('--shards', type=int, default=1, help='the number of shards the recipients are split into')
+    parser.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sample'], \
+                        help='profile the run, with cProfile (the default) or by sampling stacks')
+    args = parser.parse_args()
+
+    # read our configuration
+    config = demoFunctions.readConfig()
+    demoFunctions.configureShard(config, __file__, args.shard, args.shards)
+    profiler = demoFunctions.startProfiling(config, __file__, args.profile)
+    recipientService = RecipientService(config, args.shard, args.shards)
+    listingService = ListingService(config)
+
+    # login to the org
+    demoFunctions.authenticate(config)
+    client = demoFunctions.getClient(config)
+    tracker = ThroughputTracker()
+    # progress is journaled, so an interrupted run can be picked up with --resume
+    journal = demoFunctions.openRunJournal(config, __file__, args.resume)
+
+    # HTML is rendered by a pool of processes (one per core unless configured otherwise), while
+    # a pool of threads sends the rendered emails. A bounded queue between the two keeps memory
+    # flat: rendering pauses whenever the senders fall behind
+    renderProcesses = config.getint('Concurrency', 'render_processes', fallback=os.cpu_count() or 1)
+    workers = config.getint('Concurrency', 'workers', fallback=1)
+    queueSize = config.getint('Concurrency', 'send_queue_size', fallback=100)
+    moduleDirectory = config.get('Templates', 'module_directory', fallback=None)
+    # recipients with the same listings share most of their email, see emailRenderer
+    renderCacheSize = config.getint('Templates', 'render_cache_size', fallback=1000)
+
+    alreadySent = lambda recipient: journal.has('sent', recipient['prospectId'])
+    # in incremental mode (see [Incremental] in config/app.ini), the hash of each recipient's email until it is sent
+    payloadHashes = {}
+    recipientListings = leaveOutUnchanged(config, recipientsWithListings(recipientService, listingService, skip=alreadySent), \
+                                          payloadHashes)
+    runProcessThenSend(announceListings(recipientListings), \
+                       emailRenderer.renderEmailTimed, \
+                       lambda recipientListings, rendered: sendEmail(config, client, tracker, journal, payloadHashes, \
+                                                                     recipientListings, rendered), \
+                       renderProcesses, workers, queueSize, \
+                       initializer=emailRenderer.loadTemplate, initargs=(TEMPLATE_FILENAME, moduleDirectory, renderCacheSize))
 
-    if response.status_code == 200 and json.get('@attributes').get('stat') == 'ok':
-        print('Successfully sent email to {prospectId}'.format(prospectId = recipient['prospectId']))
-    else:
-        print('Could not send email to {prospectId}'.format(prospectId = recipient['prospectId']))
-        print(json)
-        sys.exit(20)
+    journal.close()
+    tracker.printSummary('emails')
+    stages = metrics.summary()['stages']
+    hits = stages.get('email.render.cacheHit', {}).get('count', 0)
+    renders = hits + stages.get('email.render', {}).get('count', 0)
+    if renderCacheSize and renders:
+        print('render cache: {hits} of {renders} emails reused an earlier render ({hitRate:.1f}%)' \
+                .format(hits = hits, renders = renders, hitRate = 100 * hits / renders))
+    client.printStats()
+    demoFunctions.reportDeadLetters(config)
+    demoFunctions.writeMetrics(config, __file__, profiler)
+    print('Script executed successfully')
 
-print('Script executed successfully')
\ No newline at end of file
+# rendering happens in other processes, which must be able to import this file without
+# starting another run
+if __name__ == '__main__':
+    main()
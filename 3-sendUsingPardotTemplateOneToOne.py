@@ -1,99 +1,272 @@
 #!/usr/bin/env python3
-import demoFunctions, requests, sys
-from dataServices import RecipientService, ListingService
+import argparse, demoFunctions, metrics, sys, time, uuid
+from batchDispatcher import BatchDispatcher
+from cleanupQueue import CleanupQueue
+from concurrency import ThroughputTracker, runConcurrently
+from dataServices import RecipientService, ListingService, recipientsWithListings
+from pardotClient import RequestFailed
+
+parser = argparse.ArgumentParser(description='Sends the Pardot template to every recipient, one at a time')
+parser.add_argument('--resume', action='store_true', help='pick up where the previous run stopped')
+parser.add_argument('--shard', type=int, default=0, help='only send to the recipients of this shard (see runSharded.py)')
+parser.add_argument('--shards', type=int, default=1, help='the number of shards the recipients are split into')
+parser.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sample'], \
+                    help='profile the run, with cProfile (the default) or by sampling stacks')
+parser.add_argument('--bulk', action='store_true', help='update prospects in batches and send to them as a list, '\
+                    'one to one only for prospects whose batch update failed (needs bulk_list_id)')
+args = parser.parse_args()
+if args.bulk and args.shards > 1:
+    parser.error('--bulk sends a single list email, which runSharded.py does not do for script 3')
 
 # read our configuration
 config = demoFunctions.readConfig()
-recipientService = RecipientService(config)
+demoFunctions.configureShard(config, __file__, args.shard, args.shards)
+profiler = demoFunctions.startProfiling(config, __file__, args.profile)
+bulkListId = config.get('Pardot', 'bulk_list_id', fallback='')
+if args.bulk and not bulkListId:
+    parser.error('--bulk needs a bulk_list_id in the [Pardot] section of config/app.ini')
+# with --bulk, setting this field to 1 in a prospect's update adds them to the bulk List
+membershipField = demoFunctions.listMembershipField(bulkListId)
+# the email template and the listing fields come from the same [Field Naming] config, make sure they
+# still agree before sending anything (see buildEmailTemplate.py)
+if not demoFunctions.checkEmailTemplate(config):
+    sys.exit(20)
+recipientService = RecipientService(config, args.shard, args.shards)
 listingService = ListingService(config)
 
 # login to the org
 demoFunctions.authenticate(config)
+client = demoFunctions.getClient(config)
 
-# get a list of people that need emails!
-recipients = recipientService.getRecipientsNeedingWeeklyEmail()
-for recipient in recipients:
-    # get the listings we want to share with the recipient
-    listings = listingService.getListingsForRecipientId(recipient['id'])
-    print('for {firstName} {lastName}, we will show them {itemCount} listings' \
-            .format(firstName = recipient['firstName'], \
-                    lastName = recipient['lastName'], \
-                    itemCount = len(listings)))
+# each recipient goes through update -> send -> clear, always in that order. With more than
+# 1 worker (see [Concurrency] in config/app.ini), many recipients are in flight at once
+workers = config.getint('Concurrency', 'workers', fallback=1)
+clearAfterSend = config.getboolean('Field State', 'clear_after_send', fallback=True)
+tracker = ThroughputTracker()
+# every step done for a recipient is journaled, so an interrupted run can be picked up with --resume
+journal = demoFunctions.openRunJournal(config, __file__, args.resume)
+# in incremental mode (see [Incremental] in config/app.ini), the hash of each recipient's email until it is sent
+payloadHashes = {}
 
-    # lets update the prospect to have the right listing info!
-    # first we need to build our Prospect Update Request data
-    prospectFields = {}
-    fieldNameFormat = config['Field Naming']['api_format']
-    # these 2 fields are not line-item dependant, so we keep them out of a loop
-    listingCountFieldName = fieldNameFormat.format(field='Count', lineItemNumber='')
-    prospectFields[listingCountFieldName] = len(listings)
-
-    agentNameFieldName = fieldNameFormat.format(field='AgentName', lineItemNumber='')
-    prospectFields[agentNameFieldName] = recipient['agent']
-    
-    # now we loop through the listings
-    listingNumber=1
-    for listing in listings:
-        # here we "build" the field name, taking into consideration the 
-        # - "line item field" 
-        # - "listing number", or the LineItemNumber
-        priceFieldName = fieldNameFormat.format(field='Price', lineItemNumber=listingNumber)
-        prospectFields[priceFieldName] = listing['price']
-        # repeat for each field
-        bedroomsFieldName = fieldNameFormat.format(field='Bedrooms', lineItemNumber=listingNumber)
-        prospectFields[bedroomsFieldName] = listing['bedrooms']
-
-        bathroomsFieldName = fieldNameFormat.format(field='Bathrooms', lineItemNumber=listingNumber)
-        prospectFields[bathroomsFieldName] = listing['bathrooms']
-
-        sqftFieldName = fieldNameFormat.format(field='Sqft', lineItemNumber=listingNumber)
-        prospectFields[sqftFieldName] = listing['sqft']
-
-        addressFieldName = fieldNameFormat.format(field='Address', lineItemNumber=listingNumber)
-        prospectFields[addressFieldName] = listing['fullAddress']
-
-        listingUrlFieldName = fieldNameFormat.format(field='ListingUrl', lineItemNumber=listingNumber)
-        prospectFields[listingUrlFieldName] = listing['listing_url']
-
-        imageUrlFieldName = fieldNameFormat.format(field='ImageUrl', lineItemNumber=listingNumber)
-        prospectFields[imageUrlFieldName] = listing['image_url']
-        
-        listingNumber = listingNumber + 1
-
-    # once we have all our Pardot Field updates ready, let's tell the API to make the Prospect Update
-    demoFunctions.updateProspect(config, recipient['prospectId'], prospectFields)
-
-    # now that the prospect has been updated, lets send the email
-    apiUrl = '{pardotUrl}/api/email/version/{legacyVersion}/do/send/prospect_id/{prospectId}?format=json' \
-            .format(pardotUrl = config['Pardot']['url'], \
-                    legacyVersion = config['Pardot']['legacy_api_version'], \
-                    prospectId = recipient['prospectId'])
+def alreadyDone(recipient):
+    return journal.has('sent', recipient['prospectId']) \
+        and (not clearAfterSend or journal.has('cleared', recipient['prospectId']))
+
+def sendEmail(recipient):
+    """Sends the Pardot template to a recipient, returning whether it worked."""
+    sendAction = 'send/prospect_id/{prospectId}'.format(prospectId = recipient['prospectId'])
+    apiUrl = client.legacyApiUrl('email', sendAction)
     print(apiUrl)
     reqData = {
         # required fields for a one-to-one, providing Pardot Template Id with a Campaign Id
         'campaign_id': config['Pardot']['campaign_id'],
         'email_template_id': config['Pardot']['email_template_id']
     }
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-    }
 
-    response= requests.post(url=apiUrl, data=reqData, headers=reqHeaders)
-    json = response.json()
+    try:
+        response = client.legacyRequest('POST', 'email', sendAction, idempotent=False, data=reqData)
+        reason = demoFunctions.readLegacyResponse(response)[1]
+    except RequestFailed as e:
+        reason = e.reason
+    sent = reason is None
 
-    if response.status_code == 200 and json.get('@attributes').get('stat') == 'ok':
+    if sent:
         print('Successfully sent email to {prospectId}'.format(prospectId = recipient['prospectId']))
+        metrics.count('emails.sent')
+        journal.record('sent', recipient['prospectId'])
     else:
-        print('Could not send email to {prospectId}'.format(prospectId = recipient['prospectId']))
-        print(json)
-        sys.exit(40)
+        # keep going with the other recipients, this one can be looked into (and sent again) later
+        demoFunctions.deadLetter(config, 'email.send', {'prospectId': recipient['prospectId'], \
+                                                        'email_template_id': reqData['email_template_id']}, reason)
+    return sent
+
+def sendAndClear(recipient, prospectFields):
+    """Sends the email to a recipient whose fields were updated, then cleans the fields up.
+
+    Returns:
+        whether the email was sent
+    """
+    # now that the prospect has been updated, lets send the email (unless a previous run already did)
+    if not journal.has('sent', recipient['prospectId']) and not sendEmail(recipient):
+        # the fields are left in place, so --resume can send this one again without updating it first
+        return False
 
     # a really good idea is to now clean the Prospect Fields so that they aren't left with dirty data
-    # which could mess up a send later on
-    for k,v in prospectFields.items():
-        if k == 'id': continue # we don't want to wipe this value out
-        prospectFields[k]=''
-    demoFunctions.updateProspect(config, recipient['prospectId'], prospectFields)
+    # which could mess up a send later on. With a field state store, this can be turned off: the next
+    # update then blanks whatever the prospect no longer needs
+    if clearAfterSend and demoFunctions.updateProspectCleaningListingFields(config, recipient['prospectId'], prospectFields):
+        journal.record('cleared', recipient['prospectId'])
+    return True
+
+def sendToRecipient(recipientListings):
+    started = time.perf_counter()
+    # the listings we want to share with the recipient were picked along with the recipient
+    recipient, listings = recipientListings
+    print('for {firstName} {lastName}, we will show them {itemCount} listings' \
+            .format(firstName = recipient['firstName'], \
+                    lastName = recipient['lastName'], \
+                    itemCount = len(listings)))
+
+    # lets update the prospect to have the right listing info!
+    # first we need to build our Prospect Update Request data
+    prospectFields = demoFunctions.prepareProspectFields(config, listings, recipient['agent'])
+    # in incremental mode, a recipient whose email would be the same as last time can be left out
+    payloadHash = demoFunctions.incrementalPayloadHash(config, prospectFields)
+    if demoFunctions.skipUnchangedPayload(config, recipient['prospectId'], payloadHash):
+        print('the email for {prospectId} did not change, skipping it'.format(prospectId = recipient['prospectId']))
+        return
+
+    # once we have all our Pardot Field updates ready, let's tell the API to make the Prospect Update.
+    # With a field state store, only the fields that changed since last time are sent
+    if not journal.has('updated', recipient['prospectId']):
+        if not demoFunctions.updateProspectListingFields(config, recipient['prospectId'], prospectFields):
+            # the failure has been saved to the dead letter file, sending now would show the wrong listings
+            return
+        journal.record('updated', recipient['prospectId'])
+
+    if sendAndClear(recipient, prospectFields):
+        demoFunctions.recordSentPayloads(config, [(recipient['prospectId'], payloadHash)])
+        tracker.record(time.perf_counter() - started)
+
+def sendInBulk():
+    """Sends the email to every recipient with as few API calls as possible.
+
+    The prospects are updated in batches, which also add them to the bulk List
+    (`bulk_list_id`), then the email is sent to that List in a single call. Only
+    the prospects the batch update rejected, even after a retry, are updated and
+    sent to one at a time. Taking the prospects off the List again is queued
+    along with cleaning their fields, for 6-runCleanupQueue.py.
+    """
+    cleanupQueue = CleanupQueue(config.get('Cleanup', 'queue_path', fallback='.cache/cleanupQueue.sqlite'))
+
+    # the run whose list email has not gone out yet, if a resumed run left one. Once the email went out,
+    # anything still to do (say, prospects the interrupted run never got to) needs an email of its own
+    unsentRuns = journal.keys('run') - journal.keys('listSent')
+    resumedRun = bool(unsentRuns)
+    runId = next(iter(unsentRuns)) if unsentRuns else uuid.uuid4().hex
+    if not resumedRun:
+        journal.record('run', runId)
+    # the prospects on the List for this run's email, journaled once their batch update went through
+    listedStep = 'listed.' + runId
+
+    def queueCleanups(prospects):
+        cleanups = []
+        for prospect in prospects:
+            cleared = demoFunctions.listingFieldsToClean(config, prospect['id'], prospect) if clearAfterSend else {}
+            cleared[membershipField] = 0 # off the List, so the next bulk send only goes to its own recipients
+            cleared['id'] = prospect['id']
+            cleanups.append(cleared)
+        cleanupQueue.add(runId, cleanups)
+
+    def batchUpdated(batch):
+        queueCleanups(batch)
+        # their emails count as sent once the list email goes out
+        demoFunctions.recordPendingPayloads(config, runId, [(prospect['id'], payloadHashes.pop(prospect['id'], None)) \
+                                                            for prospect in batch])
+        journal.recordMany(listedStep, [prospect['id'] for prospect in batch])
+
+    dispatcher = BatchDispatcher(config, onUpdated=batchUpdated)
+    listedSteps = ['listed.' + run for run in journal.keys('run')]
+    alreadyListed = lambda recipient: any(journal.has(step, recipient['prospectId']) for step in listedSteps) \
+                                      or alreadyDone(recipient)
+    listedCount = 0
+    # when each prospect was picked up, to report how long it took until the email went out
+    queuedAt = {}
+    for recipient, listings in recipientsWithListings(recipientService, listingService, skip=alreadyListed):
+        started = time.perf_counter()
+        print('for {firstName} {lastName}, we will show them {itemCount} listings' \
+                .format(firstName = recipient['firstName'], \
+                        lastName = recipient['lastName'], \
+                        itemCount = len(listings)))
+        prospectFields = demoFunctions.prepareProspectFields(config, listings, recipient['agent'])
+        # in incremental mode, recipients whose email would be the same as last time are left off the List
+        payloadHash = demoFunctions.incrementalPayloadHash(config, prospectFields)
+        if demoFunctions.skipUnchangedPayload(config, recipient['prospectId'], payloadHash):
+            continue
+        if payloadHash is not None:
+            payloadHashes[recipient['prospectId']] = payloadHash
+        # with a field state store, only the fields that changed since last time are sent, and
+        # the prospect joins the List in the same update
+        prospectFields = demoFunctions.listingFieldChanges(config, recipient['prospectId'], prospectFields)
+        prospectFields[membershipField] = 1
+        prospectFields['id'] = recipient['prospectId']
+        dispatcher.add(prospectFields)
+        queuedAt[recipient['prospectId']] = started
+        listedCount += 1
+
+    # wait for the last batches, then give any prospect that failed a second chance
+    dispatcher.join()
+    if dispatcher.failed:
+        print('retrying {count} prospects that could not be updated'.format(count = len(dispatcher.failed)))
+        dispatcher.retryFailed()
+    dispatcher.close()
+    print('updated {batchCount} batches, ending with a batch size of {batchSize}' \
+            .format(batchCount = dispatcher.batchCount, batchSize = dispatcher.batchSize()))
+
+    # only prospects rejected on their own (in an ok response) are known not to be on the List. A batch
+    # that failed as a whole (an error, or no response at all) may still have been applied, so its
+    # prospects may get the list email: rather than risk emailing them twice, they are left in the dead
+    # letter file for someone to check, and taking them off the List is queued with the rest
+    rejected = [failure for failure in dispatcher.failed if str(failure[0]['id']) not in dispatcher.batchFailedIds]
+    unconfirmed = [failure for failure in dispatcher.failed if str(failure[0]['id']) in dispatcher.batchFailedIds]
+    if unconfirmed:
+        queueCleanups([prospect for prospect, reason in unconfirmed])
+        for prospect, reason in unconfirmed:
+            demoFunctions.deadLetter(config, 'email.bulkUnconfirmed', prospect, \
+                                     'its batch update failed ({reason}) but may have been applied, so it may be on list ' \
+                                     '{listId}: check whether it got the email before sending it one to one' \
+                                     .format(reason = reason, listId = bulkListId))
+
+    sent = True
+    if resumedRun or listedCount > len(dispatcher.failed):
+        # a single API call to send the email to everyone on the List
+        print('done updating prospects, sending email to list {listId} now'.format(listId = bulkListId))
+        sendStarted = time.perf_counter()
+        sent = demoFunctions.sendListEmail(config, bulkListId)
+        if sent:
+            demoFunctions.confirmPendingPayloads(config, runId)
+            journal.record('listSent', runId)
+            # everyone the email went to, including the prospects listed before the run was resumed
+            sentAt = time.perf_counter()
+            for prospectId in journal.keys(listedStep):
+                tracker.record(sentAt - queuedAt.get(prospectId, sendStarted))
+        demoFunctions.scheduleListCleanups(config, cleanupQueue, runId, sent, membership=True)
+    cleanupQueue.close()
+
+    if rejected and sent:
+        # these prospects are not on the List, so they get the email one to one instead
+        print('sending one to one to {count} prospects whose batch update was rejected'.format(count = len(rejected)))
+        runConcurrently(rejected, sendFallback, workers)
+    elif dispatcher.failed and not sent:
+        # the prospects that were updated are waiting on the list email, --resume sends it and then these
+        print('{count} prospects could not be updated, run again with --resume'.format(count = len(dispatcher.failed)))
+
+def sendFallback(failure):
+    started = time.perf_counter()
+    prospect, reason = failure
+    recipient = {'prospectId': prospect['id']}
+    # the fields the batch update tried to send, without joining the List
+    prospectFields = {k: v for k, v in prospect.items() if k not in ('id', membershipField)}
+    if not journal.has('updated', prospect['id']):
+        if prospectFields and not demoFunctions.updateProspect(config, prospect['id'], prospectFields):
+            return
+        demoFunctions.recordListingFields(config, [(prospect['id'], prospectFields)])
+        journal.record('updated', prospect['id'])
+
+    if sendAndClear(recipient, prospectFields):
+        demoFunctions.recordSentPayloads(config, [(prospect['id'], payloadHashes.pop(prospect['id'], None))])
+        tracker.record(time.perf_counter() - started)
+
+if args.bulk:
+    sendInBulk()
+else:
+    # get a list of people that need emails, along with their listings!
+    # (leaving out those a resumed run already finished)
+    runConcurrently(recipientsWithListings(recipientService, listingService, skip=alreadyDone), sendToRecipient, workers)
 
+journal.close()
+tracker.printSummary('recipients')
+client.printStats()
+demoFunctions.reportDeadLetters(config)
+demoFunctions.writeMetrics(config, __file__, profiler)
 print('Script executed successfully')
\ No newline at end of file
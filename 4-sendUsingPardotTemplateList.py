@@ -1,100 +1,148 @@
 #!/usr/bin/env python3
-import demoFunctions, requests, sys
-from dataServices import RecipientService, ListingService
+import argparse, demoFunctions, sys, uuid
+from batchDispatcher import BatchDispatcher
+from cleanupQueue import CleanupQueue
+from dataServices import RecipientService, ListingService, recipientsWithListings
+
+parser = argparse.ArgumentParser(description='Sends the Pardot template to a list, after updating every prospect')
+parser.add_argument('--resume', action='store_true', help='pick up where the previous run stopped')
+parser.add_argument('--shard', type=int, default=0, help='only update the prospects of this shard (see runSharded.py)')
+parser.add_argument('--shards', type=int, default=1, help='the number of shards; with more than 1, the email is '\
+                    'not sent, runSharded.py sends it once every shard is done')
+parser.add_argument('--run-id', help='the run the clean ups belong to, shared by every shard')
+parser.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sample'], \
+                    help='profile the run, with cProfile (the default) or by sampling stacks')
+args = parser.parse_args()
 
 # read our configuration
 config = demoFunctions.readConfig()
-recipientService = RecipientService(config)
+demoFunctions.configureShard(config, __file__, args.shard, args.shards)
+profiler = demoFunctions.startProfiling(config, __file__, args.profile)
+# the email template and the listing fields come from the same [Field Naming] config, make sure they
+# still agree before sending anything (see buildEmailTemplate.py)
+if not demoFunctions.checkEmailTemplate(config):
+    sys.exit(20)
+recipientService = RecipientService(config, args.shard, args.shards)
 listingService = ListingService(config)
 
 # login to the org
 demoFunctions.authenticate(config)
+client = demoFunctions.getClient(config)
+
+# once the email is sent, the listing fields get cleaned up. Rather than keeping every batch in memory
+# until the email has been delivered, the clean ups are saved to a queue (as soon as each batch is
+# updated), which 6-runCleanupQueue.py works through once they are due
+clearAfterSend = config.getboolean('Field State', 'clear_after_send', fallback=True)
+cleanupQueue = CleanupQueue(config.get('Cleanup', 'queue_path', fallback='.cache/cleanupQueue.sqlite'))
+
+# every updated prospect is journaled, so an interrupted run can be picked up with --resume. A resumed
+# run keeps the id of the run it resumes, so the clean ups queued before the interruption go with it
+journal = demoFunctions.openRunJournal(config, __file__, args.resume)
+runId = next(iter(journal.keys('run')), None)
+if runId is None:
+    runId = args.run_id or uuid.uuid4().hex
+    journal.record('run', runId)
+elif journal.has('listSent', runId):
+    print('the email was already sent by the run being resumed, nothing left to do')
+    sys.exit(0)
+
+def queueCleanup(batch):
+    cleanups = []
+    for prospect in batch:
+        # a really good idea is to clean the Prospect Fields so that they aren't left with dirty data
+        # which could mess up a send later on. With a field state store, only filled fields are cleaned
+        cleared = demoFunctions.listingFieldsToClean(config, prospect['id'], prospect)
+        if cleared:
+            cleared['id'] = prospect['id'] # we don't want to wipe this value out
+            cleanups.append(cleared)
+    if cleanups:
+        cleanupQueue.add(runId, cleanups)
+
+# clean ups older runs still have queued for the prospects of this send would blank the fields the email
+# relies on, once they are due. Each prospect's clean up is replaced by the one of this run instead
+olderCleanups = cleanupQueue.prospectIds(runId)
+
+def batchUpdated(batch):
+    replaced = [prospect['id'] for prospect in batch if str(prospect['id']) in olderCleanups]
+    if replaced:
+        cleanupQueue.cancel(replaced, runId)
+    if clearAfterSend:
+        queueCleanup(batch)
+    journal.recordMany('updated', [prospect['id'] for prospect in batch])
 
-# get a list of people that need emails!
-recipients = recipientService.getRecipientsNeedingWeeklyEmail()
-maxBatchSize =2
-batchSize = 0
-batchProspects = []
-batches = []
+# prospects are packed into batches (of up to 50, the most the API allows) which are updated a
+# few at a time in the background, while we keep preparing the next ones
+dispatcher = BatchDispatcher(config, onUpdated=batchUpdated)
 
-for recipient in recipients:
-    # get the listings we want to share with this recipient
-    listings = listingService.getListingsForRecipientId(recipient['id'])
+# get a list of people that need emails, along with the listings we want to share with them!
+# (leaving out those a resumed run already updated)
+alreadyUpdated = lambda recipient: journal.has('updated', recipient['prospectId'])
+unchanged = []
+for recipient, listings in recipientsWithListings(recipientService, listingService, skip=alreadyUpdated):
     print('for {firstName} {lastName}, we will show them {itemCount} listings' \
             .format(firstName = recipient['firstName'], \
                     lastName = recipient['lastName'], \
                     itemCount = len(listings)))
 
     prospectFields = demoFunctions.prepareProspectFields(config, listings, recipient['agent'])
-    prospectFields['id'] = recipient['prospectId']
-    batchProspects.append(prospectFields)
-    batchSize = batchSize + 1
-    if batchSize == maxBatchSize:
-        # we need to update the batch in Pardot
-        print('updating batch of {batchSize} Prospects'.format(batchSize = maxBatchSize))
-        demoFunctions.updateBatch(config, batchProspects)
-        batches.append(batchProspects)
-        batchProspects = []
-        batchSize = 0
-
-# once we've processed all recipients, we may have an incomplete batch
-if batchSize > 0:
-    print('updating final batch of {batchSize} Prospects'.format(batchSize = batchSize))
-    # we need to update the batch in Pardot
-    demoFunctions.updateBatch(config, batchProspects)
-    batches.append(batchProspects)
-    batchProspects = []
-    batchSize=0
-
-print('done updating prospects, sending email now')
-
-
-# a single API call to send the email to the List
-apiUrl = '{pardotUrl}/api/email/version/{legacyVersion}/do/send/?format=json' \
-        .format(pardotUrl = config['Pardot']['url'], \
-                legacyVersion = config['Pardot']['legacy_api_version'])
-print(apiUrl)
-reqData = {
-    # required fields for a one-to-one, providing complete HTML Content and Sender Details 
-    # (not specifying Pardot User Id)
-    'campaign_id': config['Pardot']['campaign_id'],
-    'email_template_id': config['Pardot']['email_template_id'],
-    'list_ids[]': config['Pardot']['sending_list_id']
-}
-reqHeaders = {
-    'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-    'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-}
-print(reqData)
-response = requests.post(url=apiUrl, data=reqData, headers=reqHeaders)
-json = response.json()
-
-if response.status_code == 200 and json.get('@attributes').get('stat') == 'ok':
-    print('Successfully sent email to list {pardotListId}'.format(\
-        pardotListId = config['Pardot']['sending_list_id'] ))
+    # with a field state store, only the fields that changed since last time are sent
+    prospectFields = demoFunctions.listingFieldChanges(config, recipient['prospectId'], prospectFields)
+    if prospectFields:
+        prospectFields['id'] = recipient['prospectId']
+        dispatcher.add(prospectFields)
+    else:
+        # nothing to update, but the prospect still gets the email, so it still needs its clean up
+        unchanged.append({'id': recipient['prospectId']})
+        if len(unchanged) == 50:
+            batchUpdated(unchanged)
+            unchanged = []
+if unchanged:
+    batchUpdated(unchanged)
+
+# wait for the last batches, then give any prospect that failed a second chance
+dispatcher.join()
+if dispatcher.failed:
+    print('retrying {count} prospects that could not be updated'.format(count = len(dispatcher.failed)))
+    dispatcher.retryFailed()
+dispatcher.close()
+print('updated {batchCount} batches, ending with a batch size of {batchSize}' \
+        .format(batchCount = dispatcher.batchCount, batchSize = dispatcher.batchSize()))
+
+if dispatcher.failed:
+    # sending now would email these prospects without their listings
+    for prospect, reason in dispatcher.failed:
+        demoFunctions.deadLetter(config, 'prospect.batchUpdate', prospect, reason)
+
+if args.shards > 1:
+    # the email goes out once every shard is done, see runSharded.py
+    journal.close()
+    cleanupQueue.close()
+    client.printStats()
+    demoFunctions.reportDeadLetters(config)
+    demoFunctions.writeMetrics(config, __file__, profiler)
+    if dispatcher.failed:
+        sys.exit(5)
+    print('Script executed successfully')
+    sys.exit(0)
+
+if dispatcher.failed:
+    demoFunctions.deadLetter(config, 'email.listSend', {'list_ids[]': config['Pardot']['sending_list_id']}, \
+                             '{count} prospects could not be updated, email not sent'.format(count = len(dispatcher.failed)))
+    sent = False
 else:
-    print('Could not send email to list {pardotListId}'.format(\
-        pardotListId = config['Pardot']['sending_list_id'] ))
-    print(json)
-    sys.exit(30)
-
-print('email sent, simulating time delay until email is actually sent by Pardot')
-print('clearing the values too soon could result in a bunch of blank emails!')
-print('')
-print('please press RETURN once the emails have been delivered')
-input()
-
-print('now resuming with the field clean up')
-# now lets clean the prospect data up
-print('batch count: {batchCount}'.format(batchCount=len(batches)))
-for batch in batches:
-    print('batch has {prospectCount} prospects'.format(prospectCount = len(batch)))
-    for prospect in batch:
-        # a really good idea is to now clean the Prospect Fields so that they aren't left with dirty data
-        # which could mess up a send later on
-        for k,v in prospect.items():
-            if k == 'id': continue # we don't want to wipe this value out
-            prospect[k]=''
-    demoFunctions.updateBatch(config, batch)
+    # a single API call to send the email to the List
+    print('done updating prospects, sending email now')
+    sent = demoFunctions.sendListEmail(config)
+    if sent:
+        journal.record('listSent', runId)
+
+demoFunctions.scheduleListCleanups(config, cleanupQueue, runId, sent)
+cleanupQueue.close()
+journal.close()
 
+client.printStats()
+demoFunctions.reportDeadLetters(config)
+demoFunctions.writeMetrics(config, __file__, profiler)
+if not sent:
+    sys.exit(5)
 print('Script executed successfully')
\ No newline at end of file
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import demoFunctions, csv, os
+import demoFunctions, sys
+from fieldSchema import customFieldDefinitions, formatFieldName
 
 # read our configuration
 config = demoFunctions.readConfig()
@@ -7,16 +8,28 @@ config = demoFunctions.readConfig()
 # login to the org
 demoFunctions.authenticate(config)
 
-# get a list of the fields to remove
-with open('config/fields.csv','r') as csvFile:
-    csvReader = csv.reader(csvFile)
-    for row in csvReader:
-        fieldApiName = row[0]
-        fieldId = int(row[1])
-        print('removing Custom field {fieldApiName} with id {fieldId}' \
-                .format(fieldApiName = fieldApiName, fieldId = fieldId))
+# get a list of the fields to remove: the ones in config/fields.csv, along with any field of this
+# demo that exists without being listed there (say, when script 1 was interrupted)
+existing = demoFunctions.queryCustomFields(config)
+if existing is None:
+    sys.exit(50)
+fields = {apiName: fieldId for apiName, fieldId in demoFunctions.readFieldsManifest().items() \
+          if existing.get(apiName) == fieldId} # fields deleted by an earlier run are already gone
+for fieldName, rowNum in customFieldDefinitions(int(config['Field Naming']['listing_count_max'])):
+    apiName = formatFieldName(config['Field Naming']['api_format'], fieldName, rowNum)
+    if apiName in existing:
+        fields.setdefault(apiName, existing[apiName])
+print('removing {fieldCount} custom fields'.format(fieldCount = len(fields)))
 
-        demoFunctions.deleteCustomField(config, fieldApiName, fieldId)
+# remove them a few at a time (see [Concurrency] in config/app.ini)
+workers = config.getint('Concurrency', 'workers', fallback=1)
+remaining = demoFunctions.deleteCustomFields(config, fields, workers)
 
-os.remove('config/fields.csv')
-print('Done removing fields, file config/fields.csv removed')
\ No newline at end of file
+# keep the fields that could not be removed, so this script can be run again for them
+demoFunctions.writeFieldsManifest({apiName: fieldId for apiName, fieldId in fields.items() if apiName in remaining})
+demoFunctions.reportDeadLetters(config)
+if remaining:
+    print('{count} fields could not be removed, they are still listed in config/fields.csv' \
+            .format(count = len(remaining)))
+else:
+    print('Done removing fields, file config/fields.csv removed')
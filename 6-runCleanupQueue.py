@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Cleans up Prospects queued by 4-sendUsingPardotTemplateList.py, once they are due.
+
+Run it on a schedule (cron, for example) or keep it running with --watch. Clean
+ups are sent as bulk batch updates; any Prospect that could not be cleaned up
+stays in the queue and is retried later, up to max_attempts times before it is
+saved to the dead letter file instead.
+
+    python 6-runCleanupQueue.py            # clean up whatever is due, then exit
+    python 6-runCleanupQueue.py --watch    # keep going until nothing is scheduled
+    python 6-runCleanupQueue.py --now      # don't wait, clean up everything queued
+"""
+import argparse, demoFunctions, time
+from batchDispatcher import BatchDispatcher
+from cleanupQueue import CleanupQueue
+
+parser = argparse.ArgumentParser(description='Cleans up Prospects once their email has been delivered')
+parser.add_argument('--watch', action='store_true', help='keep waiting for clean ups until none is scheduled')
+parser.add_argument('--now', action='store_true', help='clean up everything queued, even if not due yet')
+parser.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sample'], \
+                    help='profile the run, with cProfile (the default) or by sampling stacks')
+args = parser.parse_args()
+
+# read our configuration
+config = demoFunctions.readConfig()
+profiler = demoFunctions.startProfiling(config, __file__, args.profile)
+cleanupQueue = CleanupQueue(config.get('Cleanup', 'queue_path', fallback='.cache/cleanupQueue.sqlite'))
+retryDelaySeconds = config.getfloat('Cleanup', 'retry_delay_minutes', fallback=15) * 60
+maxAttempts = config.getint('Cleanup', 'max_attempts', fallback=5)
+pollSeconds = config.getfloat('Cleanup', 'poll_seconds', fallback=60)
+
+# login to the org
+demoFunctions.authenticate(config)
+client = demoFunctions.getClient(config)
+
+if args.now:
+    cleanupQueue.makeAllDue()
+
+cleanedCount = 0
+while True:
+    # claim a chunk of due batches, and clean them all up in one go
+    due = cleanupQueue.claimDue(limit=100)
+    if due:
+        dispatcher = BatchDispatcher(config)
+        for batchId, prospects in due:
+            for prospect in prospects:
+                dispatcher.add(prospect)
+        dispatcher.close()
+
+        failures = {str(prospect['id']): reason for prospect, reason in dispatcher.failed}
+        for prospect, reason in dispatcher.failed:
+            print('Could not clean prospect {prospectId}: {reason}'.format(prospectId = prospect['id'], reason = reason))
+        for batchId, prospects in due:
+            failedProspects = [prospect for prospect in prospects if str(prospect['id']) in failures]
+            if cleanupQueue.finish(batchId, failedProspects, retryDelaySeconds, maxAttempts):
+                # given up on, rather than retried forever
+                for prospect in failedProspects:
+                    demoFunctions.deadLetter(config, 'prospect.cleanup', prospect, '{reason}, after {attempts} attempts' \
+                                             .format(reason = failures[str(prospect['id'])], attempts = maxAttempts))
+            cleanedCount += len(prospects) - len(failedProspects)
+        continue
+
+    batchCount, dueAt = cleanupQueue.pending()
+    if not args.watch or batchCount == 0:
+        break
+    if dueAt is None:
+        # what is left belongs to runs whose email was not sent, which only become due once it is
+        print('{batchCount} clean up batches are waiting for their email to be sent, nothing is scheduled' \
+                .format(batchCount = batchCount))
+        break
+    # nothing due yet: wait for the next batch to become due (checking at least every poll_seconds)
+    waitSeconds = min(pollSeconds, max(1, dueAt - time.time()))
+    print('{batchCount} clean up batches waiting, checking again in {seconds:.0f}s' \
+            .format(batchCount = batchCount, seconds = waitSeconds))
+    time.sleep(waitSeconds)
+
+batchCount, dueAt = cleanupQueue.pending()
+cleanupQueue.close()
+print('cleaned up {cleanedCount} prospects, {batchCount} batches left in the queue' \
+        .format(cleanedCount = cleanedCount, batchCount = batchCount))
+client.printStats()
+demoFunctions.reportDeadLetters(config)
+demoFunctions.writeMetrics(config, __file__, profiler)
+print('Script executed successfully')
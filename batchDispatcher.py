@@ -0,0 +1,141 @@
+"""Packs Prospect updates into batches and sends several batches at once.
+
+The Pardot API accepts up to 50 Prospects in a batch update. `BatchDispatcher`
+fills batches up to that limit (or a smaller payload size limit), keeps a few
+of them in flight at once and, as responses come back, tunes the batch size:
+smaller when batches fail or get slow, larger again while they are fast.
+
+Every Prospect the API rejects is kept, along with the reason, so it can be
+retried (see retryFailed) or reported at the end of the run. Prospects whose
+whole batch failed (an error response, or no response at all) are also noted
+in `batchFailedIds`: Pardot may still have applied their update.
+"""
+import demoFunctions, metrics, threading, time
+from batchPayload import BatchPayload
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# the most Prospects the Pardot API accepts in a single batch update
+API_MAX_BATCH_SIZE = 50
+
+class BatchDispatcher:
+    def __init__(self, config, onUpdated=None):
+        """
+        Args:
+            config:
+                The configuration dict loaded by demoFunctions.readConfig
+            onUpdated:
+                Optionally, called (from a sending thread) with the list of
+                Prospects of each batch that was updated. When given, updated
+                batches are handed to it rather than kept in `updated`
+        """
+        self._config = config
+        self._onUpdated = onUpdated
+        self._maxBatchSize = max(1, min(API_MAX_BATCH_SIZE, config.getint('Batching', 'max_batch_size', fallback=API_MAX_BATCH_SIZE)))
+        self._maxPayloadBytes = config.getint('Batching', 'max_payload_bytes', fallback=500000)
+        self._targetSeconds = config.getfloat('Batching', 'target_latency', fallback=2.0)
+        self._workers = config.getint('Batching', 'workers', fallback=config.getint('Concurrency', 'workers', fallback=1))
+        self._batchSize = self._maxBatchSize
+        self._apiVersion = config['Pardot']['legacy_api_version']
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self._workers))
+        self._inFlight = set()
+        self._lock = threading.Lock()
+        self._batch = BatchPayload(self._apiVersion)
+
+        self.updated = [] # batches (lists of Prospects) that were updated
+        self.failed = []  # (prospect, reason) for every Prospect that could not be updated
+        # ids (as text) of the failed Prospects whose whole batch failed, rather than the Prospect
+        # alone being rejected in an ok response. Their update may or may not have been applied
+        self.batchFailedIds = set()
+        self.batchCount = 0
+
+    def add(self, prospect):
+        """Queues a Prospect (a dict of fields, including its `id`) for a batch update.
+
+        Sending happens in the background; this only blocks while the most
+        batches allowed are already in flight.
+        """
+        # each Prospect is encoded once, here, and its size decides whether it still fits the batch
+        with metrics.timer('batch.encode'):
+            piece = self._batch.encodeProspect(prospect)
+        if self._batch and self._batch.size + len(piece) > self._maxPayloadBytes:
+            self.flush()
+        self._batch.add(prospect, piece)
+        if len(self._batch) >= self._batchSize:
+            self.flush()
+
+    def flush(self):
+        """Sends whatever is in the current, partially filled batch."""
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = BatchPayload(self._apiVersion)
+        # keep a bounded number of batches in flight, surfacing any unexpected error
+        while len(self._inFlight) >= self._workers * 2:
+            done, self._inFlight = wait(self._inFlight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self._inFlight.add(self._executor.submit(self._send, batch))
+
+    def join(self):
+        """Sends the last batch, then waits for every batch in flight."""
+        self.flush()
+        inFlight, self._inFlight = self._inFlight, set()
+        for future in wait(inFlight).done:
+            future.result()
+
+    def retryFailed(self):
+        """Sends every failed Prospect again, once.
+
+        Returns:
+            the number of Prospects that still failed
+        """
+        retries = [prospect for prospect, reason in self.failed]
+        self.failed = []
+        self.batchFailedIds = set()
+        for prospect in retries:
+            self.add(prospect)
+        self.join()
+        return len(self.failed)
+
+    def close(self):
+        """Waits for every batch in flight, then stops the sending threads."""
+        self.join()
+        self._executor.shutdown()
+
+    def batchSize(self):
+        return self._batchSize
+
+    def _send(self, payload):
+        batch = payload.prospects
+        print('updating batch of {batchSize} Prospects'.format(batchSize = len(batch)))
+        started = time.perf_counter()
+        failures, jsonResponse = demoFunctions.sendBatchUpdate(self._config, batch, payload.encode())
+        seconds = time.perf_counter() - started
+
+        with self._lock:
+            self.batchCount += 1
+            if failures:
+                print('{count} of {batchSize} Prospects could not be updated: {response}' \
+                        .format(count = len(failures), batchSize = len(batch), response = jsonResponse))
+                self.failed.extend((prospect, failures[str(prospect['id'])]) for prospect in batch \
+                                   if str(prospect['id']) in failures)
+                if jsonResponse is None or jsonResponse.get('@attributes', {}).get('stat') != 'ok':
+                    self.batchFailedIds.update(failures)
+            updated = [prospect for prospect in batch if str(prospect['id']) not in failures]
+            if updated and self._onUpdated is None:
+                self.updated.append(updated)
+            self._tune(seconds, len(failures) == len(batch))
+        demoFunctions.recordListingFields(self._config, [(prospect['id'], prospect) for prospect in updated])
+        if updated and self._onUpdated is not None:
+            self._onUpdated(updated)
+
+    def _tune(self, seconds, batchFailed):
+        """Adjusts the batch size after each response: halve on failure, shrink
+        when slower than the target latency, otherwise grow gradually."""
+        if batchFailed:
+            self._batchSize = max(1, self._batchSize // 2)
+        elif seconds > self._targetSeconds:
+            self._batchSize = max(1, int(self._batchSize * 0.75))
+        else:
+            self._batchSize = min(self._maxBatchSize, self._batchSize + 5)
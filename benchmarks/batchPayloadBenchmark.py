@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Compares ways of encoding Prospect batch updates, and checks the payloads are right.
+
+The "encoding twice" approach is how batches used to be encoded: every
+Prospect encoded once to measure it while filling the batch, then the whole
+batch encoded again to send it. The builder approaches use
+batchPayload.BatchPayload, encoding each Prospect once, with the json module
+and (when installed) with orjson.
+
+Before timing anything, the payloads of both API versions are checked: a list
+of Prospects for version 4, Prospects keyed by id (without the id among their
+fields) for version 3, and the same text from both JSON encoders.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/batchPayloadBenchmark.py --recipients 100000
+"""
+import argparse, configparser, json, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batchPayload
+from batchPayload import BatchPayload, encodeBatch
+from dataServices import ListingService
+from fieldSchema import FieldNameTable
+
+BATCH_SIZE = 50
+
+def encodingTwice(batches):
+    """Encodes batches the way the batch dispatcher and updateBatch used to."""
+    for batch in batches:
+        size = 0
+        for prospect in batch:
+            size += len(json.dumps(prospect))
+        json.dumps({'prospects': batch})
+
+def builder(batches, apiVersion, encoder):
+    for batch in batches:
+        payload = BatchPayload(apiVersion, encoder)
+        for prospect in batch:
+            payload.add(prospect)
+        payload.encode()
+
+def checkPayloads(batch):
+    """Checks the shape of both API versions, and that both encoders agree."""
+    version4 = json.loads(encodeBatch(batch, 4))
+    assert version4 == {'prospects': batch}, 'version 4 payload should be a list of prospects'
+
+    version3 = json.loads(encodeBatch(batch, 3))
+    expected = {'prospects': {str(prospect['id']): {k: v for k, v in prospect.items() if k != 'id'} for prospect in batch}}
+    assert version3 == expected, 'version 3 payload should be prospects keyed by id'
+    assert all('id' not in fields for fields in version3['prospects'].values())
+
+    # non ASCII values and characters JSON escapes must survive both encoders the same way
+    tricky = [dict(batch[0], id=1, AgentName='Zoë "the closer" \\ O\'Brien\n☃')]
+    for apiVersion in (3, 4):
+        texts = [BatchPayload(apiVersion, encoder) for encoder in encoders().values()]
+        for payload in texts:
+            payload.add(tricky[0])
+        assert len(set(payload.encode() for payload in texts)) == 1, 'encoders should give the same text'
+        assert json.loads(texts[0].encode())['prospects']
+
+def encoders():
+    available = {'json': batchPayload.stdlibDumps}
+    if batchPayload.orjson is not None:
+        available['orjson'] = batchPayload.orjsonDumps
+    return available
+
+def timeIt(label, prospectCount, func):
+    started = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - started
+    print('{label:<28} {seconds:.3f}s, {rate:.0f} prospects/s'.format(label = label, seconds = seconds, \
+                                                                      rate = prospectCount / seconds))
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks encoding Prospect batch updates')
+    parser.add_argument('--recipients', type=int, default=100000)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config/app.ini' if os.path.isfile('config/app.ini') else 'config/app.ini.sample')
+    listingService = ListingService(config)
+    table = FieldNameTable(config)
+    recipientIds = [str(i) for i in range(args.recipients)]
+    recipientsListings = [({'prospectId': 10000000 + int(recipientId), 'agent': 'Agent'}, listings) \
+                          for recipientId, listings in zip(recipientIds, listingService.getListingsForRecipientIds(recipientIds))]
+    prospects = table.prospectFieldsBatch(recipientsListings)
+    batches = [prospects[i:i + BATCH_SIZE] for i in range(0, len(prospects), BATCH_SIZE)]
+
+    checkPayloads(batches[0])
+    print('version 3 and 4 payloads are shaped correctly')
+
+    twice = timeIt('encoding twice', len(prospects), lambda: encodingTwice(batches))
+    for name, encoder in encoders().items():
+        for apiVersion in (4, 3):
+            seconds = timeIt('builder, {name}, version {version}'.format(name = name, version = apiVersion), len(prospects), \
+                             lambda: builder(batches, apiVersion, encoder))
+            print('    speed up: {speedUp:.1f}x'.format(speedUp = twice / seconds))
+    if batchPayload.orjson is None:
+        print('orjson is not installed, pip install orjson to compare it')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Compares reading recipients from each kind of data source, and checks they agree.
+
+The same synthetic recipients are written as a CSV file, a JSON Lines file, a
+SQLite database and (when pyarrow is installed) a Parquet file. Each source is
+then read in full, and with a filter picking the recipients needing the weekly
+email, reporting the time taken and the peak memory allocated while reading.
+
+Before timing anything, every source is checked to provide the same rows, and
+the same filtered recipients, as the CSV file.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/dataSourceBenchmark.py --recipients 200000
+"""
+import argparse, csv, datetime, json, os, random, sqlite3, sys, tempfile, time, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dataSources
+from dataSources import matches, openSource, parseFilter
+
+COLUMNS = ['id', 'prospectId', 'firstName', 'lastName', 'agent', 'minPrice', 'maxPrice', 'minBedrooms', 'zipCodes', \
+           'weeklyEmail', 'lastEmailedAt']
+WEEKLY_FILTER = 'weeklyEmail = 1 and lastEmailedAt < {week_ago} and minPrice >= 200000'
+
+def recipientRows(count, rng):
+    today = datetime.date.today()
+    for i in range(count):
+        minPrice = rng.choice(['', 200000, 300000, 500000])
+        yield {'id': i + 1, 'prospectId': 10000000 + i, 'firstName': rng.choice(['Shaak', 'Luminara', 'Zam', 'Aayla']),
+               'lastName': rng.choice(['Ti', 'Unduli', 'Wessell', 'Secura']), 'agent': rng.choice(['Deniece', 'James']),
+               'minPrice': minPrice, 'maxPrice': rng.choice(['', (minPrice or 100000) + 400000]),
+               'minBedrooms': rng.choice(['', 2, 3, 4]), 'zipCodes': ' '.join(rng.sample(['30306', '30311', '30316'], rng.randint(0, 2))),
+               'weeklyEmail': rng.choice([0, 1]), 'lastEmailedAt': (today - datetime.timedelta(days=rng.randrange(30))).isoformat()}
+
+def writeSources(directory, rows):
+    """Writes the rows in every format, providing the path of each."""
+    paths = {name: os.path.join(directory, 'recipients.' + name) for name in ('csv', 'jsonl', 'sqlite', 'parquet')}
+    with open(paths['csv'], 'w', newline='') as csvFile:
+        writer = csv.DictWriter(csvFile, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    # the other formats keep missing values as null, and numbers as numbers
+    typed = [{key: (None if value == '' else value) for key, value in row.items()} for row in rows]
+    with open(paths['jsonl'], 'w') as jsonFile:
+        for row in typed:
+            jsonFile.write(json.dumps(row) + '\n')
+    connection = sqlite3.connect(paths['sqlite'])
+    connection.execute('CREATE TABLE recipients (id INTEGER, prospectId INTEGER, firstName TEXT, lastName TEXT, agent TEXT, '
+                       'minPrice INTEGER, maxPrice INTEGER, minBedrooms INTEGER, zipCodes TEXT, weeklyEmail INTEGER, '
+                       'lastEmailedAt TEXT)')
+    connection.executemany('INSERT INTO recipients VALUES ({marks})'.format(marks = ', '.join('?' * len(COLUMNS))), \
+                           [[row[column] for column in COLUMNS] for row in typed])
+    connection.commit()
+    connection.close()
+    if dataSources.pyarrow is not None:
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(typed), paths['parquet'], row_group_size=10000)
+    else:
+        del paths['parquet']
+    return paths
+
+def checkSources(sources, where):
+    """Checks every source provides the rows of the CSV file, with and without the filter."""
+    expected = list(sources['csv'].rows())
+    expectedIds = [row['prospectId'] for row in expected if matches(row, where)]
+    assert expectedIds, 'the filter should pick some recipients'
+    assert len(expectedIds) < len(expected), 'the filter should leave some recipients out'
+    for name, source in sources.items():
+        assert list(source.rows()) == expected, '{name} should provide the same rows as the CSV file'.format(name = name)
+        filteredIds = [row['prospectId'] for row in source.rows(where)]
+        assert filteredIds == expectedIds, '{name} should pick the same recipients as the CSV file'.format(name = name)
+
+def timeIt(label, func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = func()
+    seconds = time.perf_counter() - started
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{label:<24} {count:>8} rows {seconds:7.3f}s, peak {peak:6.1f}MB allocated' \
+            .format(label = label, count = count, seconds = seconds, peak = peakBytes / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks reading recipients from each kind of data source')
+    parser.add_argument('--recipients', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    where = parseFilter(WEEKLY_FILTER)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = writeSources(directory, list(recipientRows(args.recipients, random.Random(args.seed))))
+        sources = {name: openSource(path, 'recipients', args.batch_size) for name, path in paths.items()}
+        checkSources(sources, where)
+        print('every source provides the same recipients, filtered or not')
+
+        for name, source in sources.items():
+            timeIt('{name}, everything'.format(name = name), lambda: sum(len(batch) for batch in source.batches()))
+            timeIt('{name}, weekly filter'.format(name = name), lambda: sum(len(batch) for batch in source.batches(where)))
+    if dataSources.pyarrow is None:
+        print('pyarrow is not installed, pip install pyarrow to compare Parquet')
+
+if __name__ == '__main__':
+    main()
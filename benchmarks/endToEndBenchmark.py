@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Runs scripts 2, 3 and 4 end to end against the mock API, with synthetic data.
+
+For every audience size, recipients and listings are generated into a scratch
+directory and each script runs there, in its own process, against
+mockPardotServer.py. For each run, the benchmark reports throughput
+(recipients a second), API latency percentiles (as seen by the script), the
+number of API calls and the peak memory (RSS) of the script.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/endToEndBenchmark.py --recipients 1000 10000 --latency-ms 20
+
+Results can be saved, then compared with a later run to catch regressions
+(the benchmark fails when throughput drops, or memory grows, by more than
+--max-regression percent):
+
+    python benchmarks/endToEndBenchmark.py --recipients 10000 --output baseline.json
+    python benchmarks/endToEndBenchmark.py --recipients 10000 --compare baseline.json
+"""
+import argparse, configparser, csv, json, os, random, shutil, socket, subprocess, sys, tempfile, time, urllib.request
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    '2': '2-sendCompleteHtmlToProspects.py',
+    '3': '3-sendUsingPardotTemplateOneToOne.py',
+    '4': '4-sendUsingPardotTemplateList.py',
+}
+FIRST_NAMES = ['Shaak', 'Luminara', 'Zam', 'Aayla', 'Plo', 'Kit', 'Depa', 'Saesee']
+LAST_NAMES = ['Ti', 'Unduli', 'Wessell', 'Secura', 'Koon', 'Fisto', 'Billaba', 'Tiin']
+AGENTS = ['Deniece', 'James', 'Maria', 'Chen']
+STREETS = ['Lake Manor Way', 'Peachtree St', 'Ponce De Leon Ave', 'Moreland Ave', 'Piedmont Rd']
+ZIP_CODES = ['30306', '30307', '30308', '30311', '30316', '30318', '30324', '30349']
+
+def writeListings(path, count, rng):
+    with open(path, 'w', newline='') as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(['id', 'price', 'bedrooms', 'bathrooms', 'sqft', 'fullAddress', 'listing_url', 'image_url'])
+        for i in range(count):
+            listingId = 'M{n:05d}-{m:05d}'.format(n = i, m = rng.randrange(100000))
+            writer.writerow([listingId,
+                             '${price:,}'.format(price = rng.randrange(150, 1500) * 1000),
+                             rng.randint(1, 6),
+                             rng.choice([1, 1.5, 2, 2.5, 3, 3.5, 4]),
+                             rng.randrange(700, 6000),
+                             '{n} {street}, Atlanta, GA {zipCode}'.format(n = rng.randrange(100, 9999), \
+                                                                          street = rng.choice(STREETS), \
+                                                                          zipCode = rng.choice(ZIP_CODES)),
+                             'https://www.example.com/listing/{listingId}'.format(listingId = listingId),
+                             'https://www.example.com/images/{listingId}.jpg'.format(listingId = listingId)])
+
+def writeRecipients(path, count, rng):
+    with open(path, 'w', newline='') as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(['id', 'prospectId', 'firstName', 'lastName', 'agent', 'minPrice', 'maxPrice', 'minBedrooms', 'zipCodes'])
+        for i in range(count):
+            minPrice = rng.choice(['', 200000, 300000, 500000])
+            writer.writerow([i + 1, 10000000 + i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(AGENTS),
+                             minPrice,
+                             rng.choice(['', (minPrice or 100000) + 400000]),
+                             rng.choice(['', 2, 3, 4]),
+                             ' '.join(rng.sample(ZIP_CODES, rng.randint(0, 3)))])
+
+def writeConfig(path, mockUrl, args):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_DIRECTORY, 'config', 'app.ini.sample'))
+    for key in ('username', 'password', 'security_token', 'consumer_key', 'consumer_secret'):
+        config['Salesforce'][key] = 'benchmark'
+    config['Salesforce']['url'] = mockUrl
+    config['Pardot']['url'] = mockUrl
+    for key in ('business_unit_id', 'email_template_id', 'campaign_id', 'sending_list_id'):
+        config['Pardot'][key] = '1'
+    config['Http']['stats_path'] = 'stats.json'
+    config['Concurrency']['workers'] = str(args.workers)
+    with open(path, 'w') as configFile:
+        config.write(configFile)
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def startMock(args):
+    port = freePort()
+    command = [sys.executable, os.path.join(REPO_DIRECTORY, 'mockPardotServer.py'), '--port', str(port),
+               '--latency-ms', str(args.latency_ms), '--error-rate', str(args.error_rate),
+               '--max-concurrent', str(args.max_concurrent)]
+    mock = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    for attempt in range(100):
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return mock, 'http://localhost:{port}'.format(port = port)
+        except OSError:
+            time.sleep(0.05)
+    mock.kill()
+    raise RuntimeError('the mock API server did not start')
+
+def mockCalls(mockUrl):
+    with urllib.request.urlopen(mockUrl + '/mock/stats') as response:
+        return json.load(response)['calls']
+
+def runScript(directory, script):
+    """Runs a script in its directory, returning its wall time, exit status and peak RSS."""
+    with open(os.path.join(directory, 'output.log'), 'w') as output:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIRECTORY, script)], cwd=directory, \
+                                   stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # unlike getrusage(RUSAGE_CHILDREN), this is the peak of this one script (and its children)
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peakRssMb = usage.ru_maxrss / 1024 # kilobytes on Linux
+        else:
+            process.wait()
+            peakRssMb = None
+        seconds = time.perf_counter() - started
+    return seconds, process.returncode, peakRssMb
+
+def benchmark(args, mockUrl, scratchDirectory, recipientCount):
+    rng = random.Random(args.seed)
+    dataDirectory = os.path.join(scratchDirectory, 'data-{count}'.format(count = recipientCount))
+    os.makedirs(dataDirectory)
+    writeListings(os.path.join(dataDirectory, 'listings.csv'), args.listings, rng)
+    writeRecipients(os.path.join(dataDirectory, 'recipients.csv'), recipientCount, rng)
+
+    results = {}
+    for scriptNumber in args.scripts:
+        # each script gets a directory of its own, so caches and field state don't carry over
+        directory = os.path.join(scratchDirectory, 'script{number}-{count}'.format(number = scriptNumber, count = recipientCount))
+        os.makedirs(os.path.join(directory, 'config'))
+        os.symlink(dataDirectory, os.path.join(directory, 'data'))
+        os.symlink(os.path.join(REPO_DIRECTORY, 'templates'), os.path.join(directory, 'templates'))
+        writeConfig(os.path.join(directory, 'config', 'app.ini'), mockUrl, args)
+
+        callsBefore = mockCalls(mockUrl)
+        seconds, returncode, peakRssMb = runScript(directory, SCRIPTS[scriptNumber])
+        statsPath = os.path.join(directory, 'stats.json')
+        endpoints = {}
+        if os.path.isfile(statsPath):
+            with open(statsPath) as statsFile:
+                endpoints = json.load(statsFile)
+        results[scriptNumber] = {
+            'recipients': recipientCount,
+            'seconds': seconds,
+            'recipients_per_second': recipientCount / seconds,
+            'api_calls': mockCalls(mockUrl) - callsBefore,
+            'peak_rss_mb': peakRssMb,
+            'exit_code': returncode,
+            'endpoints': {endpoint: {key: stats[key] for key in ('count', 'errors', 'p50_ms', 'p99_ms')} \
+                          for endpoint, stats in endpoints.items()}
+        }
+        printResult(scriptNumber, results[scriptNumber])
+        if returncode != 0:
+            print('    script {number} failed, see {log}'.format(number = scriptNumber, log = os.path.join(directory, 'output.log')))
+    return results
+
+def printResult(scriptNumber, result):
+    print('script {number} with {recipients} recipients: {seconds:.1f}s, {recipients_per_second:.0f} recipients/s, '\
+            '{api_calls} API calls, peak RSS {rss}'.format(number = scriptNumber, \
+                rss = 'n/a' if result['peak_rss_mb'] is None else '{:.0f}MB'.format(result['peak_rss_mb']), **result))
+    for endpoint, stats in sorted(result['endpoints'].items()):
+        print('    {endpoint}: {count} requests ({errors} errors), p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms' \
+                .format(endpoint = endpoint, **stats))
+
+def regressions(results, baseline, maxRegression):
+    """Lists every result that is more than maxRegression percent worse than the baseline."""
+    found = []
+    limit = maxRegression / 100
+    for size, scripts in results.items():
+        for scriptNumber, result in scripts.items():
+            before = baseline.get(size, {}).get(scriptNumber)
+            if before is None:
+                continue
+            if result['recipients_per_second'] < before['recipients_per_second'] * (1 - limit):
+                found.append('script {number} with {size} recipients: {now:.0f} recipients/s, was {before:.0f}' \
+                             .format(number = scriptNumber, size = size, now = result['recipients_per_second'], \
+                                     before = before['recipients_per_second']))
+            if result['peak_rss_mb'] and before.get('peak_rss_mb') and result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + limit):
+                found.append('script {number} with {size} recipients: peak RSS {now:.0f}MB, was {before:.0f}MB' \
+                             .format(number = scriptNumber, size = size, now = result['peak_rss_mb'], \
+                                     before = before['peak_rss_mb']))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks scripts 2, 3 and 4 against the mock Pardot API')
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1000], help='audience sizes to run')
+    parser.add_argument('--listings', type=int, default=5000, help='number of listings to generate')
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=sorted(SCRIPTS))
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=0, help='average latency of the mock API')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of mock API calls failing with a 503')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='concurrent calls allowed by the mock API')
+    parser.add_argument('--seed', type=int, default=2021)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with results saved by an earlier --output')
+    parser.add_argument('--max-regression', type=float, default=10, help='percent worse than --compare allowed')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory, to look at logs')
+    args = parser.parse_args()
+
+    mock, mockUrl = startMock(args)
+    scratchDirectory = tempfile.mkdtemp(prefix='endToEndBenchmark-')
+    try:
+        results = {str(count): benchmark(args, mockUrl, scratchDirectory, count) for count in args.recipients}
+    finally:
+        mock.terminate()
+        mock.wait()
+        if args.keep:
+            print('scratch directory kept in {directory}'.format(directory = scratchDirectory))
+        else:
+            shutil.rmtree(scratchDirectory)
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+    failed = [result for scripts in results.values() for result in scripts.values() if result['exit_code'] != 0]
+    found = []
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            found = regressions(results, json.load(baselineFile), args.max_regression)
+        for regression in found:
+            print('REGRESSION ' + regression)
+    if failed or found:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Compares building Prospect field payloads with and without the field name table.
+
+The "formatting" approach is how payloads used to be built, formatting every
+field name for every listing of every recipient. The "slot loop" approach
+loops over the field names the table worked out, slot by slot, as the table
+used to. The table approaches use the payload builder
+fieldSchema.FieldNameTable compiles, one recipient at a time and in batches.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/fieldsBenchmark.py --recipients 100000
+"""
+import argparse, configparser, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataServices import ListingService
+from fieldSchema import FieldNameTable, LISTING_FIELDS, formatFieldName
+
+def formattingProspectFields(config, listings, agentName):
+    """Builds the payload the way prepareProspectFields used to, formatting every name."""
+    prospectFields = {}
+    fieldNameFormat = config['Field Naming']['api_format']
+    prospectFields[formatFieldName(fieldNameFormat, 'Count', '')] = len(listings)
+    prospectFields[formatFieldName(fieldNameFormat, 'AgentName', '')] = agentName
+    listingNumber = 1
+    for listing in listings:
+        for field, listingKey in LISTING_FIELDS:
+            prospectFields[formatFieldName(fieldNameFormat, field, listingNumber)] = listing[listingKey]
+        listingNumber = listingNumber + 1
+    return prospectFields
+
+def slotLoopProspectFields(table, listings, agentName):
+    """Builds the payload the way FieldNameTable used to, before its builder was compiled."""
+    prospectFields = {table.countField: len(listings), table.agentNameField: agentName}
+    listingValues = table._listingValues
+    for fieldNames, listing in zip(table.slotFields, listings):
+        prospectFields.update(zip(fieldNames, listingValues(listing)))
+    return prospectFields
+
+def timeIt(label, recipientCount, func):
+    started = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - started
+    print('{label:<22} {seconds:.3f}s, {rate:.0f} recipients/s'.format(label = label, seconds = seconds, \
+                                                                       rate = recipientCount / seconds))
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks building Prospect field payloads')
+    parser.add_argument('--recipients', type=int, default=100000)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config/app.ini' if os.path.isfile('config/app.ini') else 'config/app.ini.sample')
+    listingService = ListingService(config)
+    recipientIds = [str(i) for i in range(args.recipients)]
+    # plain dicts, so the benchmark measures payload building rather than listing storage
+    work = [({'id': recipientId, 'prospectId': recipientId, 'agent': 'Agent'}, [dict(listing) for listing in listings]) \
+            for recipientId, listings in zip(recipientIds, listingService.getListingsForRecipientIds(recipientIds))]
+    table = FieldNameTable(config)
+
+    for recipient, listings in work[:1000]:
+        expected = formattingProspectFields(config, listings, 'Agent')
+        assert table.prospectFields(listings, 'Agent') == expected
+        assert list(table.prospectFields(listings, 'Agent')) == list(expected), 'fields should be in the same order'
+        assert slotLoopProspectFields(table, listings, 'Agent') == expected
+
+    formatting = timeIt('formatting every name', len(work), \
+                        lambda: [formattingProspectFields(config, listings, recipient['agent']) for recipient, listings in work])
+    timeIt('slot loop', len(work), \
+           lambda: [slotLoopProspectFields(table, listings, recipient['agent']) for recipient, listings in work])
+    tabled = timeIt('field name table', len(work), \
+                    lambda: [table.prospectFields(listings, recipient['agent']) for recipient, listings in work])
+    batched = timeIt('field name table batch', len(work), lambda: table.prospectFieldsBatch(work))
+    print('speed up: {single:.1f}x per recipient, {batch:.1f}x batched'.format(single = formatting / tabled, \
+                                                                             batch = formatting / batched))
+
+if __name__ == '__main__':
+    main()
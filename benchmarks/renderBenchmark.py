@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Measures how expensive it is to render the complete HTML email template.
+
+Renders the email for a number of fake recipients, each with their own set of
+listings, and reports renders per second, p50/p99 render latency and how much
+memory each render allocates. Also reports how long loading the template takes
+with and without the compiled module cache.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/renderBenchmark.py --recipients 5000
+
+Use --max-p99-ms to make the benchmark fail (exit code 1) when a template
+change makes rendering slower than an agreed budget.
+
+The render cache is measured too: with --listing-sets, recipients share that
+many different sets of listings (as they do when listings are recommended from
+a small pool), and every cached render is checked against a full render.
+"""
+import argparse, configparser, os, shutil, sys, tempfile, time, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emailRenderer
+from concurrency import percentile
+from dataServices import ListingService
+
+def readBenchmarkConfig():
+    config = configparser.ConfigParser()
+    config.read('config/app.ini' if os.path.isfile('config/app.ini') else 'config/app.ini.sample')
+    return config
+
+def timeTemplateLoad(template, moduleDirectory):
+    started = time.perf_counter()
+    emailRenderer.loadTemplate(template, moduleDirectory)
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks rendering of the complete HTML email')
+    parser.add_argument('--recipients', type=int, default=2000, help='number of emails to render')
+    parser.add_argument('--template', default='templates/completeHtmlTemplate.html')
+    parser.add_argument('--max-p99-ms', type=float, help='fail when p99 render latency is above this')
+    parser.add_argument('--listing-sets', type=int, help='recipients share this many sets of listings (default: one each)')
+    parser.add_argument('--cache-size', type=int, default=1000, help='sets of listings kept by the render cache')
+    args = parser.parse_args()
+
+    config = readBenchmarkConfig()
+    listingService = ListingService(config)
+    listingSets = [listingService.getListingsForRecipientId(str(i)) for i in range(args.listing_sets or args.recipients)]
+    work = [({'id': str(i), 'firstName': 'Recipient', 'lastName': str(i), 'agent': 'Agent {}'.format(i % 50)}, \
+             listingSets[i % len(listingSets)]) for i in range(args.recipients)]
+
+    # cold start: compiling the template versus loading the already compiled module
+    moduleDirectory = tempfile.mkdtemp(prefix='mako-')
+    try:
+        uncached = timeTemplateLoad(args.template, None)
+        compileAndCache = timeTemplateLoad(args.template, moduleDirectory)
+        cached = timeTemplateLoad(args.template, moduleDirectory)
+    finally:
+        shutil.rmtree(moduleDirectory)
+    print('template load: {uncached:.1f}ms without cache, {compiled:.1f}ms compiling into cache, '\
+            '{cached:.1f}ms from cache'.format(uncached = uncached * 1000, \
+                                                 compiled = compileAndCache * 1000, \
+                                                 cached = cached * 1000))
+
+    # warm up, then time every render
+    for recipientListings in work[:50]:
+        emailRenderer.renderEmail(recipientListings)
+    seconds = []
+    started = time.perf_counter()
+    for recipientListings in work:
+        renderStarted = time.perf_counter()
+        emailRenderer.renderEmail(recipientListings)
+        seconds.append(time.perf_counter() - renderStarted)
+    elapsed = time.perf_counter() - started
+    seconds.sort()
+    p99 = percentile(seconds, 99) * 1000
+    print('{count} renders in {elapsed:.2f}s: {perSecond:.0f} renders/s, p50 {p50:.3f}ms, p99 {p99:.3f}ms' \
+            .format(count = len(work), elapsed = elapsed, perSecond = len(work) / elapsed, \
+                    p50 = percentile(seconds, 50) * 1000, p99 = p99))
+
+    # allocations are measured in a separate pass, as tracing slows rendering down
+    sample = work[:min(len(work), 500)]
+    peaks = []
+    emailBytes = 0
+    tracemalloc.start()
+    for recipientListings in sample:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        html = emailRenderer.renderEmail(recipientListings)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        emailBytes += len(html)
+        del html
+    tracemalloc.stop()
+    print('allocations: {peak:.0f} bytes peak per render on average, for an average email of {emailSize:.0f} bytes' \
+            .format(peak = sum(peaks) / len(peaks), emailSize = emailBytes / len(sample)))
+
+    # the render cache, checked against full renders
+    emailRenderer.loadTemplate(args.template, None, args.cache_size)
+    hits = 0
+    started = time.perf_counter()
+    for recipientListings in work:
+        html, hit = emailRenderer.renderEmailCached(recipientListings)
+        hits += hit
+    cachedElapsed = time.perf_counter() - started
+    for recipientListings in work[:min(len(work), 500)]:
+        assert emailRenderer.renderEmailCached(recipientListings)[0] == emailRenderer.renderEmail(recipientListings), \
+            'a cached render should match the full render'
+    print('render cache: {perSecond:.0f} renders/s ({speedUp:.1f}x), {hitRate:.1f}% hits with {sets} sets of listings' \
+            .format(perSecond = len(work) / cachedElapsed, speedUp = elapsed / cachedElapsed, \
+                    hitRate = 100 * hits / len(work), sets = len(listingSets)))
+
+    if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+        print('p99 render latency {p99:.3f}ms is above the budget of {budget:.3f}ms' \
+                .format(p99 = p99, budget = args.max_p99_ms))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Compares picking listings one recipient at a time with picking them in batches.
+
+Run it from the root of the project, for example:
+
+    python benchmarks/selectionBenchmark.py --recipients 1000000 --chunk-size 1000
+
+Both approaches use a seeded random generator, so every run picks the same
+listings and results can be compared between runs.
+"""
+import argparse, configparser, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataServices import ListingService
+
+def readBenchmarkConfig(seed):
+    config = configparser.ConfigParser()
+    config.read('config/app.ini' if os.path.isfile('config/app.ini') else 'config/app.ini.sample')
+    if not config.has_section('Data'):
+        config.add_section('Data')
+    config['Data']['listing_seed'] = str(seed)
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks listing selection for many recipients')
+    parser.add_argument('--recipients', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=2021)
+    args = parser.parse_args()
+    recipientIds = [str(i) for i in range(args.recipients)]
+
+    listingService = ListingService(readBenchmarkConfig(args.seed))
+    started = time.perf_counter()
+    perRecipientListings = 0
+    for recipientId in recipientIds:
+        perRecipientListings += len(listingService.getListingsForRecipientId(recipientId))
+    perRecipient = time.perf_counter() - started
+
+    listingService = ListingService(readBenchmarkConfig(args.seed))
+    started = time.perf_counter()
+    batchedListings = 0
+    for start in range(0, len(recipientIds), args.chunk_size):
+        matrix = listingService.getListingIndexesForRecipientIds(recipientIds[start:start + args.chunk_size])
+        batchedListings += len(matrix.indexes)
+    batched = time.perf_counter() - started
+
+    print('per recipient: {seconds:.2f}s for {recipients} recipients ({listings} listings), {rate:.0f} recipients/s' \
+            .format(seconds = perRecipient, recipients = args.recipients, listings = perRecipientListings, \
+                    rate = args.recipients / perRecipient))
+    print('batched:       {seconds:.2f}s for {recipients} recipients ({listings} listings), {rate:.0f} recipients/s' \
+            .format(seconds = batched, recipients = args.recipients, listings = batchedListings, \
+                    rate = args.recipients / batched))
+    print('speed up: {speedUp:.1f}x'.format(speedUp = perRecipient / batched))
+
+if __name__ == '__main__':
+    main()
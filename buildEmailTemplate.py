@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Generates the listing slots of the Pardot email template from the configured fields.
+
+templates/pardotEmailTemplate.html shows each listing in a slot of its own,
+using that slot's fields (`{{Recipient.PD2021_Listing1_Price}}` and so on).
+Rather than writing every slot by hand, the HTML of a single slot is kept in
+templates/pardotListingSlot.html, with `$Price`, `$ListingUrl` (and the other
+fields of fieldSchema.LISTING_FIELDS) standing for the slot's field names and
+`$slot` for its number. This script writes one slot for each listing up to
+listing_count_max, named with the api_format from the `[Field Naming]` section
+of config/app.ini, between the listing slot comments of the template.
+
+Run it whenever the listing slot or the field naming changes, then copy the
+template into Pardot:
+
+    python buildEmailTemplate.py
+    python buildEmailTemplate.py --check    # only report whether it is up to date
+"""
+import argparse, demoFunctions, os, sys
+from fieldSchema import renderSlotBlocks
+
+TEMPLATE_FILENAME = 'templates/pardotEmailTemplate.html'
+SLOT_TEMPLATE_FILENAME = 'templates/pardotListingSlot.html'
+START_MARKER = '<!-- listing slots: generated from templates/pardotListingSlot.html by buildEmailTemplate.py -->'
+END_MARKER = '<!-- /listing slots -->'
+
+parser = argparse.ArgumentParser(description='Generates the listing slots of the Pardot email template')
+parser.add_argument('--check', action='store_true', help='only check the template is up to date, without changing it')
+args = parser.parse_args()
+
+# read our configuration
+config = demoFunctions.readConfig()
+table = demoFunctions.getFieldNameTable(config)
+
+with open(TEMPLATE_FILENAME, 'r') as templateFile:
+    template = templateFile.read()
+with open(SLOT_TEMPLATE_FILENAME, 'r') as slotFile:
+    slotTemplate = slotFile.read()
+if START_MARKER not in template or END_MARKER not in template:
+    print('{filename} is missing the listing slot comments, add them around the listing slots first:\n    {start}\n    {end}' \
+            .format(filename = TEMPLATE_FILENAME, start = START_MARKER, end = END_MARKER))
+    sys.exit(1)
+
+# the slots go on the lines between the two comments, which keep their own lines (and indentation)
+start = template.index('\n', template.index(START_MARKER)) + 1
+end = template.rindex('\n', 0, template.index(END_MARKER)) + 1
+generated = template[:start] + renderSlotBlocks(table, slotTemplate) + template[end:]
+
+if generated == template:
+    print('{filename} is up to date, with {slots} listing slots'.format(filename = TEMPLATE_FILENAME, slots = table.maxListings))
+elif args.check:
+    print('{filename} is out of date, run buildEmailTemplate.py to generate its {slots} listing slots' \
+            .format(filename = TEMPLATE_FILENAME, slots = table.maxListings))
+    sys.exit(1)
+else:
+    with open(TEMPLATE_FILENAME + '.tmp', 'w') as templateFile:
+        templateFile.write(generated)
+    os.replace(TEMPLATE_FILENAME + '.tmp', TEMPLATE_FILENAME)
+    print('generated {slots} listing slots in {filename}, copy it into your Pardot email template' \
+            .format(slots = table.maxListings, filename = TEMPLATE_FILENAME))
+
+if not demoFunctions.checkEmailTemplate(config):
+    sys.exit(1)
@@ -0,0 +1,172 @@
+"""A persistent queue of Prospect clean ups waiting for an email to be delivered.
+
+Clearing the listing fields too soon after a list send results in blank emails,
+as Pardot may not have finished sending. Rather than keeping every batch in
+memory until someone confirms delivery, 4-sendUsingPardotTemplateList.py saves
+the clean up batches here (in a SQLite file) and exits. Once they are due,
+6-runCleanupQueue.py sends them as bulk batch updates, on its own schedule.
+
+Each entry holds one batch of Prospects (their `id` and the fields to blank),
+the run it belongs to and when it becomes due. Entries of a run only get a due
+time once the email has been sent, and entries are claimed before they are
+worked on, so several workers can share the same queue. A new send to a
+Prospect drops whatever clean up an older run still has queued for it.
+"""
+import json, os, sqlite3, threading, time
+
+# a claim older than this is considered abandoned (the worker probably died)
+CLAIM_TIMEOUT_SECONDS = 3600
+
+class CleanupQueue:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS cleanup_batch ('
+                                 'id INTEGER PRIMARY KEY, run_id TEXT NOT NULL, prospects TEXT NOT NULL, '
+                                 'due_at REAL, claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS cleanup_batch_due ON cleanup_batch (due_at)')
+
+    def add(self, runId, prospects):
+        """Saves a batch of Prospect clean ups, not due until the run is scheduled.
+
+        Args:
+            runId:
+                Identifies the send the clean ups belong to
+            prospects:
+                A list of dicts, each with the Prospect `id` and the fields to
+                blank
+        """
+        with self._lock:
+            self._connection.execute('INSERT INTO cleanup_batch (run_id, prospects) VALUES (?, ?)', \
+                                     (runId, json.dumps(prospects)))
+
+    def schedule(self, runId, dueAt):
+        """Makes every batch of a run due at a given time (seconds since the epoch)."""
+        with self._lock:
+            self._connection.execute('UPDATE cleanup_batch SET due_at = ? WHERE run_id = ? AND due_at IS NULL', \
+                                     (dueAt, runId))
+
+    def prospectIds(self, exceptRunId):
+        """Provides the ids (as text) of every Prospect with a clean up queued by another run."""
+        with self._lock:
+            rows = self._connection.execute('SELECT prospects FROM cleanup_batch WHERE run_id != ?', \
+                                            (exceptRunId,)).fetchall()
+        return set(str(prospect['id']) for prospects, in rows for prospect in json.loads(prospects))
+
+    def cancel(self, prospectIds, exceptRunId):
+        """Drops the clean ups other runs queued for some Prospects.
+
+        A new send to a Prospect replaces the clean up of its previous send,
+        which would otherwise blank the fields the new email relies on.
+        Batches already claimed by a worker are left alone.
+
+        Args:
+            prospectIds:
+                The ids of the Prospects whose clean ups to drop
+            exceptRunId:
+                The run whose clean ups are kept (the one sending now)
+        Returns:
+            the number of clean ups dropped
+        """
+        prospectIds = set(str(prospectId) for prospectId in prospectIds)
+        dropped = 0
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute('SELECT id, prospects FROM cleanup_batch WHERE run_id != ? '
+                                                'AND (claimed_at IS NULL OR claimed_at < ?)', \
+                                                (exceptRunId, time.time() - CLAIM_TIMEOUT_SECONDS)).fetchall()
+                for batchId, prospects in rows:
+                    prospects = json.loads(prospects)
+                    kept = [prospect for prospect in prospects if str(prospect['id']) not in prospectIds]
+                    if len(kept) == len(prospects):
+                        continue
+                    dropped += len(prospects) - len(kept)
+                    if kept:
+                        self._connection.execute('UPDATE cleanup_batch SET prospects = ? WHERE id = ?', \
+                                                 (json.dumps(kept), batchId))
+                    else:
+                        self._connection.execute('DELETE FROM cleanup_batch WHERE id = ?', (batchId,))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return dropped
+
+    def makeAllDue(self):
+        """Makes every queued batch due right away, including those of unfinished runs."""
+        with self._lock:
+            now = time.time()
+            self._connection.execute('UPDATE cleanup_batch SET due_at = ? WHERE due_at IS NULL OR due_at > ?', (now, now))
+
+    def claimDue(self, limit):
+        """Claims batches that are due, so no other worker picks them up.
+
+        Args:
+            limit:
+                The most batches to claim
+        Returns:
+            a list of (batchId, prospects) tuples
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute('SELECT id, prospects FROM cleanup_batch '
+                                                'WHERE due_at IS NOT NULL AND due_at <= ? '
+                                                'AND (claimed_at IS NULL OR claimed_at < ?) '
+                                                'ORDER BY due_at, id LIMIT ?', \
+                                                (now, time.time() - CLAIM_TIMEOUT_SECONDS, limit)).fetchall()
+                self._connection.executemany('UPDATE cleanup_batch SET claimed_at = ? WHERE id = ?', \
+                                             [(time.time(), batchId) for batchId, prospects in rows])
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return [(batchId, json.loads(prospects)) for batchId, prospects in rows]
+
+    def finish(self, batchId, failedProspects, retryDelaySeconds, maxAttempts=None):
+        """Removes a claimed batch, or keeps just its failed Prospects for a later retry.
+
+        Args:
+            batchId:
+                The id of a batch provided by claimDue
+            failedProspects:
+                The Prospects of the batch that could not be cleaned up
+            retryDelaySeconds:
+                How long to wait before those Prospects are due again
+            maxAttempts:
+                The most times a batch is attempted before its failed Prospects
+                are given up on (None to keep retrying them)
+        Returns:
+            whether the failed Prospects were given up on, and removed
+        """
+        with self._lock:
+            if not failedProspects:
+                self._connection.execute('DELETE FROM cleanup_batch WHERE id = ?', (batchId,))
+                return False
+            attempts, = self._connection.execute('SELECT attempts FROM cleanup_batch WHERE id = ?', (batchId,)).fetchone()
+            if maxAttempts is not None and attempts + 1 >= maxAttempts:
+                self._connection.execute('DELETE FROM cleanup_batch WHERE id = ?', (batchId,))
+                return True
+            self._connection.execute('UPDATE cleanup_batch SET prospects = ?, due_at = ?, claimed_at = NULL, '
+                                     'attempts = attempts + 1 WHERE id = ?', \
+                                     (json.dumps(failedProspects), time.time() + retryDelaySeconds, batchId))
+            return False
+
+    def pending(self):
+        """Summarizes what is left in the queue.
+
+        Returns:
+            a tuple of the number of batches still queued and the earliest due
+            time among them (None when none is scheduled yet)
+        """
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*), MIN(due_at) FROM cleanup_batch').fetchone()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
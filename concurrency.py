@@ -0,0 +1,270 @@
+"""Small helpers for running the demo with many API requests in flight.
+
+Pardot limits how many requests a Business Unit can make at once and per day,
+so running concurrently always comes with two things: a limit on the number of
+workers, and a global requests-per-second ceiling shared by every worker.
+"""
+import collections, os, queue, random, struct, threading, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class RateLimiter:
+    """A thread-safe token bucket, allowing `ratePerSecond` acquisitions a second.
+
+    A rate of 0 (or less) disables the limit entirely.
+    """
+    def __init__(self, ratePerSecond, burst=1):
+        self._rate = float(ratePerSecond)
+        self._capacity = max(1.0, float(burst))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the caller is allowed to make one more request."""
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                waitSeconds = (1 - self._tokens) / self._rate
+            time.sleep(waitSeconds)
+
+class SharedRateLimiter:
+    """A token bucket shared by every process using the same state file.
+
+    When a run is split over several processes (see runSharded.py), each
+    process gets its own client, so a RateLimiter per process would let the
+    processes together go well over the limit. This bucket lives in a small
+    file instead, updated under a file lock, so `ratePerSecond` holds across
+    all of them. Without `fcntl` (on Windows), it only holds within a process.
+    """
+    _STATE = struct.Struct('dd') # tokens, time of the last update
+
+    def __init__(self, path, ratePerSecond, burst=1):
+        self._rate = float(ratePerSecond)
+        self._capacity = max(1.0, float(burst))
+        self._lock = threading.Lock()
+        self._fd = None
+        if self._rate > 0:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self):
+        """Blocks until the caller is allowed to make one more request."""
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    state = os.pread(self._fd, self._STATE.size, 0)
+                    now = time.time()
+                    tokens, updated = self._STATE.unpack(state) if len(state) == self._STATE.size else (self._capacity, now)
+                    tokens = min(self._capacity, tokens + max(0.0, now - updated) * self._rate)
+                    acquired = tokens >= 1
+                    if acquired:
+                        tokens -= 1
+                    os.pwrite(self._fd, self._STATE.pack(tokens, now), 0)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+            if acquired:
+                return
+            time.sleep((1 - tokens) / self._rate)
+
+class LatencySample:
+    """Keeps latencies for percentiles, in bounded memory however long a run goes on.
+
+    The count, total and maximum are exact. Percentiles come from a uniform
+    random sample (a reservoir) of at most `size` latencies, which puts the
+    p99 within a fraction of a percentile of the true one while memory stays
+    the same for a thousand requests or a hundred million. Not thread safe,
+    callers hold their own lock.
+    """
+    def __init__(self, size=10000):
+        self._size = size
+        self._reservoir = []
+        self._random = random.Random()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self._reservoir) < self._size:
+            self._reservoir.append(seconds)
+        else:
+            # every latency so far ends up in the reservoir with the same chance, size / count
+            index = self._random.randrange(self.count)
+            if index < self._size:
+                self._reservoir[index] = seconds
+
+    def percentiles(self, *percents):
+        """Provides the (nearest-rank) percentiles of the latencies kept, 0 for none at all."""
+        if not self._reservoir:
+            return [0.0 for percent in percents]
+        seconds = sorted(self._reservoir)
+        return [percentile(seconds, percent) for percent in percents]
+
+class ThroughputTracker:
+    """Records how long each unit of work took, to report throughput and tail latency."""
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._seconds = LatencySample()
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._seconds.add(seconds)
+
+    def summary(self):
+        """Summarizes the work recorded so far.
+
+        Returns:
+            a dict with the count, elapsed seconds, items per second and
+            p50/p99/max latency in milliseconds
+        """
+        elapsed = time.perf_counter() - self._started
+        with self._lock:
+            count, maxSeconds = self._seconds.count, self._seconds.max
+            p50, p99 = self._seconds.percentiles(50, 99)
+        return {
+            'count': count,
+            'elapsed': elapsed,
+            'per_second': count / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': 1000 * p50,
+            'p99_ms': 1000 * p99,
+            'max_ms': 1000 * maxSeconds
+        }
+
+    def printSummary(self, label):
+        print('{count} {label} in {elapsed:.1f}s ({per_second:.1f}/s), '\
+                'p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, max {max_ms:.1f}ms' \
+                .format(label = label, **self.summary()))
+
+def runConcurrently(items, func, workers):
+    """Calls `func` for every item, keeping up to `workers` calls in flight.
+
+    Items are pulled from `items` lazily, so only a handful of them are held
+    in memory at any time. The first exception raised by `func` (including
+    the SystemExit raised by `sys.exit`) is re-raised in the calling thread.
+
+    Args:
+        items:
+            Any iterable of work items
+        func:
+            The function to call with each item
+        workers:
+            The number of threads to use. With 1 (or less), items are simply
+            processed one after another in the calling thread
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in wait(pending).done:
+            future.result()
+
+def runProcessThenSend(items, process, send, processes, workers, queueSize, initializer=None, initargs=()):
+    """Runs CPU heavy work in a process pool while threads send the results.
+
+    Each item is handed to `process` in one of `processes` worker processes
+    (so `process` must be a module level function, and items and results must
+    be picklable). As results come back, in the same order as `items`, they
+    are put on a bounded queue which `workers` threads drain by calling
+    `send(item, result)`.
+
+    Memory stays flat no matter how many items there are: at most
+    `processes * 2` items are being processed and `queueSize` results are
+    waiting to be sent. When the senders fall behind, the queue fills up and
+    processing pauses until there is room again.
+
+    Args:
+        items:
+            Any iterable of work items
+        process:
+            The function called with each item in a worker process
+        send:
+            The function called with each item and its result, in a thread
+        processes:
+            The number of worker processes
+        workers:
+            The number of sending threads
+        queueSize:
+            The most results allowed to wait for a sending thread
+        initializer:
+            Optionally, a function run once in each worker process
+        initargs:
+            Arguments for the initializer
+    """
+    sendQueue = queue.Queue(maxsize=max(1, queueSize))
+    errors = []
+
+    def sender():
+        while True:
+            entry = sendQueue.get()
+            if entry is None:
+                return
+            if errors:
+                continue # keep draining so the producer never blocks forever
+            try:
+                send(*entry)
+            except BaseException as error:
+                errors.append(error)
+
+    senders = [threading.Thread(target=sender, daemon=True) for i in range(max(1, workers))]
+    for thread in senders:
+        thread.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=initializer, initargs=initargs) as pool:
+            pending = collections.deque()
+            for item in items:
+                if errors:
+                    break
+                pending.append((item, pool.submit(process, item)))
+                if len(pending) >= processes * 2:
+                    item, future = pending.popleft()
+                    sendQueue.put((item, future.result()))
+            while pending and not errors:
+                item, future = pending.popleft()
+                sendQueue.put((item, future.result()))
+            for item, future in pending:
+                future.cancel()
+    finally:
+        for thread in senders:
+            sendQueue.put(None)
+        for thread in senders:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+def percentile(sortedValues, percent):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    index = max(0, -(-len(sortedValues) * percent // 100) - 1)
+    return sortedValues[int(index)]
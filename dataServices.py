@@ -6,29 +6,211 @@ that this could be done, such as a "Real Estate Customer" database
 (perhaps mySql?) and a Listings Recommendation Engine.
 
 This demo/sample implementation simply loads data from sample CSVs,
-encapsulating the demo into a nice little package.
+encapsulating the demo into a nice little package. The `[Data]` section of
+config/app.ini can point either service at a JSON Lines file, a SQLite
+database or Parquet files instead (see dataSources).
 """
-import csv, os, random
+import array, bisect, heapq, itertools, metrics, random, re, zlib
+from dataSources import openSource, parseFilter
+from listingStore import ListingStore, parseNumber
+
+ZIP_CODE_PATTERN = re.compile(r'\b(\d{5})(?:-\d{4})?\s*$')
+
+class ListingIndexMatrix:
+    """Listing positions for a batch of recipients, one variable length row each.
+
+    Stored the compact way: every row back to back in a single `indexes`
+    array, with `offsets[i]` and `offsets[i + 1]` marking where row i starts
+    and ends.
+    """
+    __slots__ = ('offsets', 'indexes')
+
+    def __init__(self, offsets, indexes):
+        self.offsets = offsets
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, i):
+        return self.indexes[self.offsets[i]:self.offsets[i + 1]]
+
+class ListingRecommender:
+    """Finds the best Listings for a Recipient's preferences, without scanning every listing.
+
+    Three indexes are built once over the ListingStore:
+
+    - every listing position, sorted by price (plus the sorted prices), so a
+      price range is found with two binary searches
+    - a bucket of listing positions per number of bedrooms
+    - an inverted index from ZIP code (parsed from fullAddress) to listings
+
+    A query starts from whichever of those gives the fewest candidates, then
+    checks only those candidates against the rest of the preferences. When
+    that is the price range, candidates are visited closest to the target
+    price first, so the query stops as soon as it has k matches.
+    """
+    def __init__(self, listings):
+        self._listings = listings
+        self._prices = listings.column('price')
+        self._bedrooms = listings.column('bedrooms')
+
+        self._priceOrder = array.array('q', sorted(range(len(listings)), key=self._prices.__getitem__))
+        self._sortedPrices = array.array('q', (self._prices[i] for i in self._priceOrder))
+
+        self._bedroomBuckets = {}
+        for i, bedrooms in enumerate(self._bedrooms):
+            self._bedroomBuckets.setdefault(bedrooms, array.array('q')).append(i)
+        self._bedroomCounts = sorted(self._bedroomBuckets)
+
+        self._zipCodes = []
+        self._zipIndex = {}
+        for i in range(len(listings)):
+            match = ZIP_CODE_PATTERN.search(listings.value(i, 'fullAddress'))
+            zipCode = match.group(1) if match else None
+            self._zipCodes.append(zipCode)
+            if zipCode:
+                self._zipIndex.setdefault(zipCode, array.array('q')).append(i)
+
+    def topListings(self, preferences, k):
+        """Finds the k listings best matching a Recipient's preferences.
+
+        Listings must fall within the price range, have at least the minimum
+        number of bedrooms and be in one of the ZIP codes (when those are
+        given). Matches are ranked by how close their price is to the middle
+        of the recipient's price range.
+
+        Args:
+            preferences:
+                A dict with any of minPrice, maxPrice, minBedrooms (numbers)
+                and zipCodes (a set of ZIP codes), as provided by
+                recipientPreferences
+            k:
+                The most listings to provide
+        Returns:
+            an array of up to k listing positions, best match first
+        """
+        minPrice = preferences.get('minPrice')
+        maxPrice = preferences.get('maxPrice')
+        minBedrooms = preferences.get('minBedrooms')
+        zipCodes = preferences.get('zipCodes')
+
+        if minPrice is not None and maxPrice is not None:
+            target = (minPrice + maxPrice) / 2
+        else:
+            target = maxPrice if maxPrice is not None else (minPrice or 0)
+        if k <= 0:
+            return array.array('q')
+
+        # price range, as a slice of the listings sorted by price
+        low = bisect.bisect_left(self._sortedPrices, minPrice) if minPrice is not None else 0
+        high = bisect.bisect_right(self._sortedPrices, maxPrice) if maxPrice is not None else len(self._sortedPrices)
+        sources = [(max(0, high - low), None)]
+        if zipCodes:
+            zipLists = [self._zipIndex.get(zipCode, ()) for zipCode in zipCodes]
+            sources.append((sum(len(l) for l in zipLists), lambda: itertools.chain.from_iterable(zipLists)))
+        if minBedrooms is not None:
+            bedroomLists = [self._bedroomBuckets[bedrooms] for bedrooms in \
+                            self._bedroomCounts[bisect.bisect_left(self._bedroomCounts, minBedrooms):]]
+            sources.append((sum(len(l) for l in bedroomLists), lambda: itertools.chain.from_iterable(bedroomLists)))
+        candidates = min(sources, key=lambda source: source[0])[1]
+
+        prices = self._prices
+        bedrooms = self._bedrooms
+        def isMatch(i):
+            return (minPrice is None or prices[i] >= minPrice) \
+                   and (maxPrice is None or 0 <= prices[i] <= maxPrice) \
+                   and (minBedrooms is None or bedrooms[i] >= minBedrooms) \
+                   and (not zipCodes or self._zipCodes[i] in zipCodes)
+
+        if candidates is not None:
+            matches = filter(isMatch, candidates())
+            return array.array('q', heapq.nsmallest(k, matches, key=lambda i: (abs(prices[i] - target), i)))
+
+        # the price range has the fewest candidates. They are already sorted by price, so walking out
+        # from the target price meets them closest first, and the walk can stop after the k-th match
+        # (once the price moves further away, as listings as close as the k-th still rank by position)
+        found = []
+        for position in self._closestFirst(low, high, target):
+            i = self._priceOrder[position]
+            distance = abs(prices[i] - target)
+            if len(found) >= k and distance > found[k - 1][0]:
+                break
+            if isMatch(i):
+                found.append((distance, i))
+        found.sort()
+        return array.array('q', (i for distance, i in found[:k]))
+
+    def _closestFirst(self, low, high, target):
+        """Provides the positions in [low, high) of the listings sorted by price, closest price to target first."""
+        sortedPrices = self._sortedPrices
+        right = bisect.bisect_left(sortedPrices, target, low, high)
+        left = right - 1
+        while left >= low or right < high:
+            if right >= high or (left >= low and target - sortedPrices[left] <= sortedPrices[right] - target):
+                yield left
+                left -= 1
+            else:
+                yield right
+                right += 1
+
+    def topListingsForBatch(self, preferencesList, k):
+        """Finds the k best listings for each set of preferences of a batch.
+
+        Returns:
+            a ListingIndexMatrix with one row for each set of preferences
+        """
+        offsets = array.array('q', [0])
+        indexes = array.array('q')
+        for preferences in preferencesList:
+            indexes.extend(self.topListings(preferences, k))
+            offsets.append(len(indexes))
+        return ListingIndexMatrix(offsets, indexes)
+
+def recipientPreferences(recipient):
+    """Reads a Recipient's listing preferences, from the optional recipient columns.
+
+    The columns are minPrice, maxPrice, minBedrooms and zipCodes (separated
+    by spaces). Any of them can be left empty.
+
+    Returns:
+        a dict of preferences, or None when the recipient has none at all
+    """
+    preferences = {}
+    for name in ('minPrice', 'maxPrice', 'minBedrooms'):
+        value = parseNumber(recipient.get(name), 'q')
+        if value >= 0:
+            preferences[name] = value
+    zipCodes = set((recipient.get('zipCodes') or '').split())
+    if zipCodes:
+        preferences['zipCodes'] = zipCodes
+    return preferences or None
 
 class ListingService:
     def __init__(self, config):
         self._maxListings = int(config['Field Naming']['listing_count_max'])
         self._minListings = int(config['Field Naming']['listing_count_min'])
+        self._snapshotPath = config.get('Data', 'listing_snapshot', fallback=None)
+        self._source = openSource(config.get('Data', 'listings_source', fallback='data/listings.csv'), \
+                                  config.get('Data', 'listings_table', fallback='listings'))
+        # with a seed, the same listings are picked every run
+        seed = config.get('Data', 'listing_seed', fallback='')
+        self._random = random.Random(int(seed)) if seed else random.Random()
         self._listings = self._readListings()
+        self._recommender = None
 
     def _readListings(self):
-        """Reads the Listings from the CSV file.
+        """Reads the Listings from their source into a compact, columnar store.
+
+        When listing_snapshot is set in config/app.ini, the listings are
+        loaded from a memory-mapped binary snapshot of the source, which is
+        rebuilt whenever the source changes.
 
         Returns:
-            an array of listings, with each listing in a dict format
+            a ListingStore, handing out each listing in a dict-like format
         """
-        listings = []
-        
-        with open('data/listings.csv','r') as csvFile:
-            csvReader = csv.DictReader(csvFile)
-            for row in csvReader:
-                listings.append(row)
-        return listings
+        with metrics.timer('listings.load'):
+            return ListingStore.load(self._source, self._snapshotPath)
 
     def getListingsForRecipientId(self, recipientId):
         """Provides a random set of Listings, ignoring the Recipient entirely.
@@ -39,36 +221,202 @@ class ListingService:
         Returns:
             an array of listings, randomly selected.
         """
-        numberOfListings = random.randint(self._minListings, self._maxListings)
+        numberOfListings = self._random.randint(self._minListings, self._maxListings)
         listings = []
         for i in range(0,numberOfListings):
-            randomListingIndex = random.randint(0, len(self._listings)-1)
+            randomListingIndex = self._random.randint(0, len(self._listings)-1)
             listings.append(self._listings[randomListingIndex])
         return listings
 
+    def getListingIndexesForRecipientIds(self, recipientIds):
+        """Picks random Listings for a whole batch of Recipients in one go.
+
+        Rather than a couple of random calls per listing, the number of
+        listings for every recipient is drawn in a single call, followed by a
+        single call drawing every listing position for the batch.
+
+        Args:
+            recipientIds:
+                The ids of the recipients in the batch (ignored, just like
+                getListingsForRecipientId does)
+        Returns:
+            a ListingIndexMatrix with one row of listing positions for each
+            recipient, each row between listing_count_min and
+            listing_count_max long
+        """
+        counts = self._random.choices(range(self._minListings, self._maxListings + 1), k=len(recipientIds))
+        offsets = array.array('q', [0])
+        offsets.extend(itertools.accumulate(counts))
+        indexes = array.array('q', self._random.choices(range(len(self._listings)), k=offsets[-1]))
+        return ListingIndexMatrix(offsets, indexes)
+
+    def getListingsForRecipientIds(self, recipientIds):
+        """Provides a random set of Listings for each Recipient of a batch.
+
+        Returns:
+            a list with an array of listings for each recipient id, in the
+            same order as recipientIds
+        """
+        matrix = self.getListingIndexesForRecipientIds(recipientIds)
+        listings = self._listings
+        return [[listings[i] for i in matrix.row(row)] for row in range(len(matrix))]
+
+    def getListingsForRecipients(self, recipients):
+        """Provides the Listings for each Recipient of a batch.
+
+        Recipients with listing preferences get the listing_count_max listings
+        best matching those preferences (topped up with random listings when
+        fewer than listing_count_min match). Everyone else gets a random set
+        of listings, just like getListingsForRecipientIds.
+
+        Returns:
+            a list with an array of listings for each recipient, in the same
+            order as recipients
+        """
+        with metrics.timer('listings.select'):
+            return self._selectListingsForRecipients(recipients)
+
+    def _selectListingsForRecipients(self, recipients):
+        preferencesList = [recipientPreferences(recipient) for recipient in recipients]
+        randomMatrix = self.getListingIndexesForRecipientIds([recipient['id'] for recipient in recipients])
+        if any(preferencesList) and self._recommender is None:
+            with metrics.timer('listings.index'):
+                self._recommender = ListingRecommender(self._listings)
+
+        listings = self._listings
+        recipientsListings = []
+        for row, preferences in enumerate(preferencesList):
+            if preferences is None:
+                positions = randomMatrix.row(row)
+            else:
+                positions = list(self._recommender.topListings(preferences, self._maxListings))
+                while len(positions) < min(self._minListings, len(listings)):
+                    position = self._random.randrange(len(listings))
+                    if position not in positions:
+                        positions.append(position)
+            recipientsListings.append([listings[i] for i in positions])
+        return recipientsListings
+
+def shardOf(prospectId, shards):
+    """Works out which shard a Prospect belongs to, the same way in every process.
+
+    Python's own hash() of a string changes from one process to the next, so
+    a CRC32 of the Prospect id is used instead.
+    """
+    return zlib.crc32(str(prospectId).encode('utf-8')) % shards
+
 class RecipientService:
-    def __init__(self, config):
-        self._recipients = self._readRecipients()
+    def __init__(self, config, shard=0, shards=1):
+        """
+        Args:
+            config:
+                The configuration dict loaded by demoFunctions.readConfig
+            shard:
+                With more than one shard, only the recipients of this shard
+                (numbered from 0) are provided, see shardOf
+            shards:
+                The number of shards the recipients are split into
+        """
+        self._shard = shard
+        self._shards = shards
+        self._streaming = config.getboolean('Data', 'stream_recipients', fallback=False)
+        self._chunkSize = config.getint('Data', 'recipient_chunk_size', fallback=1000)
+        self._source = openSource(config.get('Data', 'recipients_source', fallback='data/recipients.csv'), \
+                                  config.get('Data', 'recipients_table', fallback='recipients'), self._chunkSize)
+        # which recipients need the weekly email, checked by the source itself when it can
+        self._where = parseFilter(config.get('Data', 'recipients_filter', fallback=''))
+        # when streaming, nothing is read until recipients are actually needed
+        self._recipients = None if self._streaming else self._readRecipients()
 
     def _readRecipients(self):
-        """Reads the Recipients from the CSV file.
+        """Reads the Recipients needing the weekly email from their source.
 
         Returns:
             an array of Recipients, with each recipient in a dict format
         """
         recipients = []
         
-        with open('data/recipients.csv','r') as csvFile:
-            csvReader = csv.DictReader(csvFile)
-            for row in csvReader:
+        with metrics.timer('recipients.read'):
+            for row in self._inShard(self._source.rows(self._where)):
                 recipients.append(row)
 
+        metrics.count('recipients', len(recipients))
         return recipients
+
+    def _streamRecipientChunks(self):
+        """Reads the Recipients needing the weekly email from their source, a chunk at a time.
+
+        Only one chunk of recipients is held in memory at any time, no matter
+        how big the source is.
+
+        Returns:
+            a generator of lists of Recipients, each holding at most
+            recipient_chunk_size recipients in a dict format
+        """
+        rows = self._inShard(self._source.rows(self._where))
+        while True:
+            with metrics.timer('recipients.read'):
+                chunk = list(itertools.islice(rows, self._chunkSize))
+            if not chunk:
+                return
+            metrics.count('recipients', len(chunk))
+            yield chunk
+
+    def _inShard(self, rows):
+        if self._shards <= 1:
+            return rows
+        return (row for row in rows if shardOf(row['prospectId'], self._shards) == self._shard)
+
+    def getRecipientChunksNeedingWeeklyEmail(self):
+        """Provides the recipients needing the weekly email, grouped in chunks.
+
+        Returns:
+            an iterable of lists of Recipients, each holding at most
+            recipient_chunk_size recipients in a dict format
+        """
+        if self._streaming:
+            return self._streamRecipientChunks()
+        return (self._recipients[i:i + self._chunkSize] for i in range(0, len(self._recipients), self._chunkSize))
     
     def getRecipientsNeedingWeeklyEmail(self):
-        """Simply provides all recipients in the CSV, each time it is called.
+        """Provides the recipients needing the weekly email, each time it is called.
+
+        That is every recipient in the source, or only those matching the
+        recipients_filter in config/app.ini.
+
+        When stream_recipients is enabled in config/app.ini, the recipients
+        are read lazily as they are consumed, so sending can start right away
+        and memory use stays flat.
 
         Returns:
-            an array of Recipients, with each recipient in a dict format
+            an iterable of Recipients, with each recipient in a dict format
         """
-        return self._recipients
\ No newline at end of file
+        if self._streaming:
+            return itertools.chain.from_iterable(self._streamRecipientChunks())
+        return self._recipients
+
+def recipientsWithListings(recipientService, listingService, skip=None):
+    """Pairs every Recipient needing the weekly email with the Listings to show them.
+
+    Recipients are worked through a chunk at a time, picking the listings for
+    a whole chunk at once.
+
+    Args:
+        recipientService:
+            Provides the recipients, see RecipientService
+        listingService:
+            Picks the listings, see ListingService
+        skip:
+            Optionally, called with each recipient. Recipients it returns
+            True for (for example, already done in a resumed run) are left
+            out before any listings are picked for them
+    Returns:
+        a generator of (recipient, listings) tuples
+    """
+    for chunk in recipientService.getRecipientChunksNeedingWeeklyEmail():
+        if skip is not None:
+            chunk = [recipient for recipient in chunk if not skip(recipient)]
+            if not chunk:
+                continue
+        chunkListings = listingService.getListingsForRecipients(chunk)
+        yield from zip(chunk, chunkListings)
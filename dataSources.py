@@ -0,0 +1,299 @@
+"""Reads Recipients and Listings from CSV, JSON Lines, SQLite or Parquet.
+
+The demo reads its data from `data/recipients.csv` and `data/listings.csv`,
+but real recipients tend to live in a database, and listings in large exports.
+Each kind of source reads rows a batch at a time, so a table is never held in
+memory as a whole:
+
+- CSV (`.csv`) and JSON Lines (`.jsonl`, one JSON object per line) files are
+  read line by line
+- SQLite databases (`.db`, `.sqlite`, `.sqlite3`) are queried with a cursor
+  that steps through the results as batches are fetched
+- Parquet files, or directories of them (`.parquet`), are read a record batch
+  at a time, with pyarrow (`pip install pyarrow`)
+
+Rows are handed out as dicts of text, just like `csv.DictReader` does, with an
+empty string for missing values, whichever source they come from.
+
+A source can also be asked for only the rows matching a filter, such as the
+recipients needing the weekly email, for example:
+
+    weeklyEmail = 1 and lastEmailedAt < {week_ago}
+
+A filter is one or more conditions joined by `and`, each comparing a column
+with `=`, `!=`, `<`, `<=`, `>` or `>=`, or checking it `is empty` or
+`is not empty`. Values that look like numbers are compared as numbers,
+anything else as text (so dates should be written as YYYY-MM-DD).
+`{today}` and `{week_ago}` stand for those dates. SQLite and Parquet sources
+push the filter down to the database or the file reader, so rows that don't
+match are never read into Python; CSV and JSON Lines sources check each row
+as it is read.
+"""
+import abc, csv, datetime, itertools, json, operator, os, pathlib, re, sqlite3
+
+try:
+    import pyarrow, pyarrow.dataset as pyarrowDataset
+except ImportError:
+    pyarrow = pyarrowDataset = None
+
+OPERATORS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+CONDITION_PATTERN = re.compile(r'^\s*(\w+)\s*(?:(!=|<=|>=|=|<|>)\s*(.*?)|is\s+(not\s+)?empty)\s*$', re.IGNORECASE)
+
+def parseFilter(text):
+    """Parses a filter, such as `weeklyEmail = 1 and lastEmailedAt < {week_ago}`.
+
+    Args:
+        text:
+            The filter, as written in config/app.ini. Empty for no filter
+    Returns:
+        a list of (column, operator, value) conditions, every one of which a
+        row must match. The operator is one of OPERATORS, `empty` or
+        `notEmpty` (with a value of None)
+    """
+    if not text or not text.strip():
+        return []
+    today = datetime.date.today()
+    dates = {'today': today.isoformat(), 'week_ago': (today - datetime.timedelta(days=7)).isoformat()}
+    conditions = []
+    for part in re.split(r'\s+and\s+', text.strip(), flags=re.IGNORECASE):
+        match = CONDITION_PATTERN.match(part)
+        if match is None:
+            raise ValueError('could not understand the filter condition "{part}"'.format(part = part))
+        column, op, value, negated = match.groups()
+        if op is None:
+            conditions.append((column, 'notEmpty' if negated else 'empty', None))
+        else:
+            conditions.append((column, op, _literal(value.strip().strip('\'"').format(**dates))))
+    return conditions
+
+def _literal(value):
+    """Provides a filter value as a number when it looks like one, otherwise as text."""
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() and '.' not in value else number
+
+def _text(value):
+    """Formats a value read from a source the way a CSV file would hold it."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def matches(row, conditions):
+    """Checks a row (a dict of text) against parsed filter conditions."""
+    for column, op, value in conditions:
+        cell = row.get(column)
+        cell = '' if cell is None else cell
+        if op == 'empty' or op == 'notEmpty':
+            if (cell == '') != (op == 'empty'):
+                return False
+            continue
+        if cell == '':
+            return False # like SQL, a missing value matches no comparison
+        if isinstance(value, str):
+            cell = _text(cell)
+        else:
+            try:
+                cell = float(cell)
+            except ValueError:
+                cell, value = _text(cell), _text(value)
+        if not OPERATORS[op](cell, value):
+            return False
+    return True
+
+class DataSource(abc.ABC):
+    """Reads the rows of a table, a batch at a time. See openSource."""
+    def __init__(self, path, batchSize=1000):
+        self.path = path
+        self._batchSize = max(1, batchSize)
+
+    def batches(self, where=None, columns=None):
+        """Reads the rows of the table, a batch at a time.
+
+        Args:
+            where:
+                Optionally, the conditions (see parseFilter) a row must match
+            columns:
+                Optionally, the only columns the rows need
+        Returns:
+            a generator of lists of rows, each holding at most batchSize rows
+            as dicts of text
+        """
+        rows = self.rows(where, columns)
+        while True:
+            batch = list(itertools.islice(rows, self._batchSize))
+            if not batch:
+                return
+            yield batch
+
+    @abc.abstractmethod
+    def rows(self, where=None, columns=None):
+        """Reads the rows of the table one by one, see batches."""
+
+    def identity(self):
+        """Describes the data the source holds right now, to tell whether a snapshot of it is stale.
+
+        The description holds the kind of source, its path and the size and
+        modification time of every file it reads, so any change to it (being
+        pointed at another file, an older copy being restored, or writes only
+        in SQLite's write-ahead log so far) gives a different identity.
+
+        Returns:
+            the identity, as text
+        """
+        files = [[path, os.path.getsize(path), os.stat(path).st_mtime_ns] for path in self._files()]
+        return json.dumps({'kind': type(self).__name__, 'path': os.path.abspath(self.path), 'files': files})
+
+    def _files(self):
+        """Provides every file the data is read from."""
+        if os.path.isdir(self.path):
+            return sorted(entry.path for entry in os.scandir(self.path) if entry.is_file())
+        return [self.path]
+
+class CsvSource(DataSource):
+    def rows(self, where=None, columns=None):
+        with open(self.path, 'r', newline='') as csvFile:
+            for row in csv.DictReader(csvFile):
+                if not where or matches(row, where):
+                    yield row
+
+class JsonLinesSource(DataSource):
+    def rows(self, where=None, columns=None):
+        with open(self.path, 'r') as jsonFile:
+            for line in jsonFile:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                row = dict(zip(row.keys(), map(_text, row.values())))
+                if not where or matches(row, where):
+                    yield row
+
+class SqliteSource(DataSource):
+    def __init__(self, path, table, batchSize=1000):
+        """
+        Args:
+            path:
+                The SQLite database file
+            table:
+                The table (or view) to read
+            batchSize:
+                The rows fetched from the database at a time
+        """
+        super().__init__(path, batchSize)
+        self._table = table
+
+    def identity(self):
+        return json.dumps(dict(json.loads(super().identity()), table = self._table))
+
+    def _files(self):
+        # committed writes may still only be in the write-ahead log, rather than in the database file
+        return [path for path in (self.path, self.path + '-wal') if os.path.isfile(path)]
+
+    def rows(self, where=None, columns=None):
+        sql, parameters = self.query(where, columns)
+        # read only, so a run never locks out whatever keeps the database up to date
+        connection = sqlite3.connect(pathlib.Path(os.path.abspath(self.path)).as_uri() + '?mode=ro', uri=True)
+        try:
+            cursor = connection.execute(sql, parameters)
+            names = [description[0] for description in cursor.description]
+            while True:
+                # SQLite steps through the query as rows are fetched, so only a batch is ever held
+                fetched = cursor.fetchmany(self._batchSize)
+                if not fetched:
+                    return
+                for row in fetched:
+                    yield dict(zip(names, map(_text, row)))
+        finally:
+            connection.close()
+
+    def query(self, where=None, columns=None):
+        """Builds the SELECT statement reading the table, with the filter as its WHERE clause.
+
+        Returns:
+            a tuple of the SQL and its parameters
+        """
+        selected = ', '.join(_quote(column) for column in columns) if columns else '*'
+        clauses = []
+        parameters = []
+        for column, op, value in where or []:
+            if op == 'empty':
+                clauses.append("({column} IS NULL OR {column} = '')".format(column = _quote(column)))
+            elif op == 'notEmpty':
+                clauses.append("({column} IS NOT NULL AND {column} != '')".format(column = _quote(column)))
+            else:
+                clauses.append('{column} {op} ?'.format(column = _quote(column), op = op))
+                parameters.append(value)
+        sql = 'SELECT {selected} FROM {table}'.format(selected = selected, table = _quote(self._table))
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        return sql, parameters
+
+def _quote(identifier):
+    return '"{name}"'.format(name = identifier.replace('"', '""'))
+
+class ParquetSource(DataSource):
+    def rows(self, where=None, columns=None):
+        if pyarrowDataset is None:
+            raise ImportError('reading {path} needs pyarrow, pip install pyarrow'.format(path = self.path))
+        dataset = pyarrowDataset.dataset(self.path, format='parquet')
+        if columns:
+            columns = [column for column in columns if column in dataset.schema.names]
+        # the filter is checked by the reader (skipping whole row groups when their statistics
+        # rule them out), and only the columns needed are decoded
+        for recordBatch in dataset.to_batches(columns=columns, filter=self.expression(dataset.schema, where), \
+                                              batch_size=self._batchSize):
+            for row in recordBatch.to_pylist():
+                yield dict(zip(row.keys(), map(_text, row.values())))
+
+    def expression(self, schema, where):
+        """Turns filter conditions into a pyarrow expression, or None without any."""
+        expression = None
+        for column, op, value in where or []:
+            field = pyarrowDataset.field(column)
+            columnType = schema.field(column).type
+            isText = pyarrow.types.is_string(columnType) or pyarrow.types.is_large_string(columnType)
+            if op == 'empty':
+                condition = field.is_null() | (field == '') if isText else field.is_null()
+            elif op == 'notEmpty':
+                condition = field.is_valid() & (field != '') if isText else field.is_valid()
+            else:
+                if isText:
+                    value = _text(value)
+                elif pyarrow.types.is_boolean(columnType):
+                    value = _text(value).lower() in ('1', 'true')
+                elif pyarrow.types.is_temporal(columnType):
+                    value = pyarrow.scalar(value).cast(columnType)
+                condition = OPERATORS[op](field, value)
+            expression = condition if expression is None else expression & condition
+        return expression
+
+def openSource(path, table=None, batchSize=1000):
+    """Opens a data source, picking its kind from the file extension.
+
+    Args:
+        path:
+            The file (or, for Parquet, directory) holding the data
+        table:
+            The table to read, for a SQLite database
+        batchSize:
+            The rows read at a time
+    Returns:
+        a DataSource
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return CsvSource(path, batchSize)
+    if extension in ('.jsonl', '.ndjson'):
+        return JsonLinesSource(path, batchSize)
+    if extension in ('.db', '.sqlite', '.sqlite3'):
+        if not table:
+            raise ValueError('reading {path} needs the table to read'.format(path = path))
+        return SqliteSource(path, table, batchSize)
+    if extension == '.parquet':
+        return ParquetSource(path, batchSize)
+    raise ValueError('{path} is not a CSV, JSON Lines, SQLite or Parquet file'.format(path = path))
@@ -0,0 +1,73 @@
+"""Collects whatever could not be done during a run, instead of stopping it.
+
+A single failed update or send used to end the script, halfway through a large
+audience. Failures are now appended to a dead letter file (one JSON object per
+line) and the run carries on. Each line says what was being done (`kind`, for
+example `prospect.update`), to what (`item`) and why it failed (`reason`), so
+the failures can be looked into, and retried, once the run is over.
+"""
+import datetime, json, os, threading
+
+class DeadLetterFile:
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self.count = 0
+
+    def add(self, kind, item, reason):
+        """Appends a failure to the file (created on the first failure).
+
+        Args:
+            kind:
+                What was being done, such as `prospect.update` or `email.send`
+            item:
+                A JSON friendly description of what it was done to, for
+                example the Prospect id and fields
+            reason:
+                Why it failed, usually the error from the API
+        """
+        line = json.dumps({'at': datetime.datetime.now(datetime.timezone.utc).isoformat(), \
+                           'kind': kind, 'reason': reason, 'item': item}, default=str)
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self._path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self._path, 'a')
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.count += 1
+
+    def mergeFrom(self, path):
+        """Appends the failures collected in another dead letter file, for
+        example by one shard of a sharded run, then removes that file.
+
+        Returns:
+            the number of failures appended
+        """
+        if not os.path.isfile(path):
+            return 0
+        with open(path) as otherFile:
+            lines = [line if line.endswith('\n') else line + '\n' for line in otherFile if line.strip()]
+        with self._lock:
+            if lines:
+                if self._file is None:
+                    directory = os.path.dirname(self._path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self._file = open(self._path, 'a')
+                self._file.writelines(lines)
+                self._file.flush()
+                self.count += len(lines)
+        os.remove(path)
+        return len(lines)
+
+    def path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
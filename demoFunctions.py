@@ -4,7 +4,22 @@ This file simply provides functions that can be reused. In a real production
 codebase, it would be best to separate different types of logic into their
 own dedicated classes so that they can be reused a little bit better.
 """
-import configparser, json, requests, sys
+import configparser, contextlib, csv, hashlib, metrics, os, threading, time
+from batchPayload import encodeBatch
+from concurrency import runConcurrently
+from deadLetters import DeadLetterFile
+from fieldSchema import FieldNameTable, formatFieldName
+from fieldStateStore import FieldStateStore, payloadHash
+from pardotClient import PardotClient, RequestFailed
+from runJournal import RunJournal
+from tokenCache import TokenCache
+
+_clients = {}
+_fieldNameTables = {}
+_fieldStateStores = {}
+_tokenCaches = {}
+_deadLetterFiles = {}
+_clientsLock = threading.Lock()
 
 def readConfig():
     """Reads configuration from `config/app.ini`, making it available to app
@@ -21,12 +36,304 @@ def readConfig():
     print('Configuration loaded')
     return config
 
-def authenticate(config):
+def getClient(config):
+    """Provides the shared PardotClient for a configuration.
+
+    The same client (and therefore the same pool of keep-alive connections) is
+    handed out to every helper and script working with this configuration.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        the PardotClient for this configuration
+    """
+    with _clientsLock:
+        client = _clients.get(id(config))
+        if client is None:
+            client = _clients[id(config)] = PardotClient(config, \
+                reauthenticate=lambda rejectedToken: authenticate(config, rejectedToken))
+    return client
+
+def getFieldNameTable(config):
+    """Provides the FieldNameTable for a configuration, built on first use.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        the FieldNameTable holding every Prospect field name
+    """
+    with _clientsLock:
+        table = _fieldNameTables.get(id(config))
+        if table is None:
+            table = _fieldNameTables[id(config)] = FieldNameTable(config)
+    return table
+
+def getFieldStateStore(config):
+    """Provides the FieldStateStore for a configuration, opened on first use.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        the FieldStateStore, or None when no `path` is set in the
+        `[Field State]` section of config/app.ini
+    """
+    with _clientsLock:
+        if id(config) not in _fieldStateStores:
+            path = config.get('Field State', 'path', fallback='')
+            _fieldStateStores[id(config)] = FieldStateStore(path) if path else None
+        return _fieldStateStores[id(config)]
+
+def getTokenCache(config):
+    """Provides the TokenCache for a configuration, opened on first use.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        the TokenCache, or None when no `path` is set in the `[Token Cache]`
+        section of config/app.ini
+    """
+    with _clientsLock:
+        if id(config) not in _tokenCaches:
+            path = config.get('Token Cache', 'path', fallback='')
+            ttlSeconds = config.getfloat('Token Cache', 'ttl_minutes', fallback=90) * 60
+            _tokenCaches[id(config)] = TokenCache(path, ttlSeconds) if path else None
+        return _tokenCaches[id(config)]
+
+def getDeadLetters(config):
+    """Provides the DeadLetterFile for a configuration, where failures are collected.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        the DeadLetterFile at `path` in the `[Dead Letters]` section of
+        config/app.ini
+    """
+    with _clientsLock:
+        deadLetters = _deadLetterFiles.get(id(config))
+        if deadLetters is None:
+            path = config.get('Dead Letters', 'path', fallback='logs/deadLetters.jsonl')
+            deadLetters = _deadLetterFiles[id(config)] = DeadLetterFile(path)
+    return deadLetters
+
+def deadLetter(config, kind, item, reason):
+    """Reports a failure and saves it to the dead letter file, so the run can carry on.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        kind:
+            What was being done, such as `prospect.update`
+        item:
+            What it was done to, for example the Prospect id and fields
+        reason:
+            Why it failed, usually the JSON response from the API
+    """
+    print('Could not complete {kind}: {reason}'.format(kind = kind, reason = reason))
+    metrics.count('deadLetters.' + kind)
+    getDeadLetters(config).add(kind, item, reason)
+
+def failureReason(response):
+    """Describes why a Legacy API response was not ok, for the dead letter file."""
+    try:
+        json = response.json()
+    except ValueError:
+        return 'HTTP status {}'.format(response.status_code)
+    return (json.get('err') if isinstance(json, dict) else None) or json or 'HTTP status {}'.format(response.status_code)
+
+def readLegacyResponse(response):
+    """Reads a Legacy API response, telling whether the request worked.
+
+    Every Legacy API call goes through here, so that a response that isn't
+    the JSON the API normally answers with (such as an empty body or an HTML
+    error page, once retries have run out on a server error) is treated as a
+    failure to save to the dead letter file, rather than stopping the run.
+
+    Args:
+        response:
+            The response from PardotClient.legacyRequest
+    Returns:
+        a tuple of the JSON response (None when it could not be read) and
+        None when the request worked, or why it did not
+    """
+    try:
+        json = response.json()
+    except ValueError:
+        return None, 'HTTP status {}, the response was not JSON'.format(response.status_code)
+    if not isinstance(json, dict) or not isinstance(json.get('@attributes'), dict):
+        return None, 'HTTP status {}, the response had no @attributes'.format(response.status_code)
+    if response.status_code != 200 or json['@attributes'].get('stat') != 'ok':
+        return json, failureReason(response)
+    return json, None
+
+def reportDeadLetters(config):
+    """Tells the console how many failures were saved during the run, if any."""
+    deadLetters = getDeadLetters(config)
+    if deadLetters.count:
+        print('{count} failures were saved to {path}'.format(count = deadLetters.count, path = deadLetters.path()))
+    deadLetters.close()
+
+def shardFilePath(path, shard, shards):
+    """Provides the path of a file for one shard, for example `logs/deadLetters.shard2of4.jsonl`.
+
+    With a single shard, the path is left as it is.
+    """
+    if shards <= 1:
+        return path
+    base, extension = os.path.splitext(path)
+    return '{base}.shard{shard}of{shards}{extension}'.format(base = base, shard = shard, shards = shards, \
+                                                             extension = extension)
+
+def shardStatsPath(config, scriptPath, shard, shards):
+    """Provides where a shard of a script saves its API latency stats, for runSharded.py to merge."""
+    directory = config.get('Sharding', 'directory', fallback='.cache/shards')
+    scriptName = os.path.splitext(os.path.basename(scriptPath))[0]
+    return shardFilePath(os.path.join(directory, scriptName + '.stats.json'), shard, shards)
+
+def configureShard(config, scriptPath, shard, shards):
+    """Sets a script up to work on a single shard of the recipients.
+
+    Every shard runs in its own process (see runSharded.py), so the files
+    written during a run (dead letters, journal and stats) get a name of
+    their own for each shard. Must be called before anything else uses the
+    configuration.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        scriptPath:
+            The script being run (its `__file__`)
+        shard:
+            The shard to work on, numbered from 0
+        shards:
+            The number of shards the recipients are split into. With 1,
+            nothing changes
+    """
+    if shards <= 1:
+        return
+    print('Working on shard {shard} of {shards}'.format(shard = shard, shards = shards))
+    config.read_dict({
+        'Sharding': {'shard': str(shard), 'shards': str(shards)},
+        'Dead Letters': {'path': shardFilePath(config.get('Dead Letters', 'path', fallback='logs/deadLetters.jsonl'), \
+                                               shard, shards)},
+        'Http': {'stats_path': shardStatsPath(config, scriptPath, shard, shards)}
+    })
+    os.makedirs(os.path.dirname(config['Http']['stats_path']) or '.', exist_ok=True)
+
+def shardMetricsPath(config, scriptPath, shard, shards):
+    """Provides where a shard of a script saves its metrics, for runSharded.py to merge."""
+    directory = config.get('Sharding', 'directory', fallback='.cache/shards')
+    scriptName = os.path.splitext(os.path.basename(scriptPath))[0]
+    return shardFilePath(os.path.join(directory, scriptName + '.metrics.json'), shard, shards)
+
+def metricsPath(config, scriptPath):
+    """Provides where a script saves its metrics at the end of a run (see writeMetrics).
+
+    That is `<script>.metrics.json` (or `.prom`, in the Prometheus format) in
+    the `directory` of the `[Metrics]` section of config/app.ini. The shards
+    of a sharded run always save JSON next to their other files instead.
+    """
+    shard, shards = config.getint('Sharding', 'shard', fallback=0), config.getint('Sharding', 'shards', fallback=1)
+    if shards > 1:
+        return shardMetricsPath(config, scriptPath, shard, shards)
+    directory = config.get('Metrics', 'directory', fallback='logs')
+    scriptName = os.path.splitext(os.path.basename(scriptPath))[0]
+    extension = '.prom' if config.get('Metrics', 'format', fallback='json') == 'prometheus' else '.json'
+    return os.path.join(directory, scriptName + '.metrics' + extension)
+
+def startProfiling(config, scriptPath, mode):
+    """Starts profiling a script, when asked to with `--profile`.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        scriptPath:
+            The script being run (its `__file__`)
+        mode:
+            `cprofile`, `sample` or None to not profile at all (see
+            metrics.Profiler)
+    Returns:
+        the started Profiler, to hand to writeMetrics, or None
+    """
+    if not mode:
+        return None
+    profiler = metrics.Profiler(mode)
+    profiler.start()
+    return profiler
+
+def writeMetrics(config, scriptPath, profiler=None):
+    """Prints where the time of a run went, and saves it (see metricsPath).
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        scriptPath:
+            The script being run (its `__file__`)
+        profiler:
+            Optionally, the Profiler started by startProfiling. It is stopped
+            and its profile saved next to the metrics
+    """
+    scriptName = os.path.splitext(os.path.basename(scriptPath))[0]
+    if profiler is not None:
+        # next to the metrics: a .prof file for pstats, or the folded stacks of the sampling profiler
+        shard, shards = config.getint('Sharding', 'shard', fallback=0), config.getint('Sharding', 'shards', fallback=1)
+        profilePath = os.path.join(config.get('Metrics', 'directory', fallback='logs'), \
+                                   scriptName + ('.folded' if profiler.mode == 'sample' else '.prof'))
+        profiler.stop(shardFilePath(profilePath, shard, shards))
+    path = metricsPath(config, scriptPath)
+    summary = metrics.summary()
+    metrics.printSummary(summary)
+    metrics.writeSummary(summary, path, {'script': scriptName})
+    print('metrics saved to {path}'.format(path = path))
+
+def openRunJournal(config, scriptPath, resume):
+    """Opens the journal recording the progress of a script.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        scriptPath:
+            The script being run (its `__file__`), each script has its own
+            journal in the `directory` of the `[Journal]` section of
+            config/app.ini
+        resume:
+            Pick up where the previous run stopped, rather than starting over
+    Returns:
+        the RunJournal
+    """
+    directory = config.get('Journal', 'directory', fallback='.cache/journal')
+    scriptName = os.path.splitext(os.path.basename(scriptPath))[0]
+    # each shard of a sharded run keeps a journal of its own
+    shard, shards = config.getint('Sharding', 'shard', fallback=0), config.getint('Sharding', 'shards', fallback=1)
+    journal = RunJournal(shardFilePath(os.path.join(directory, scriptName + '.journal'), shard, shards), resume)
+    if resume:
+        print('Resuming the previous run of {scriptName}'.format(scriptName = scriptName))
+    return journal
+
+def authenticate(config, rejectedToken=None):
     """Authenticates to Salesforce API using Username/Password Oauth Flow.
 
     Once authenticated, the accessToken is stored IN MEMORY in the config dict
     accessible by config['Salesforce']['access_token']
 
+    With a token cache configured (see `[Token Cache]` in config/app.ini), a
+    token saved by an earlier run (or another worker) is used instead of
+    logging in again, and a new token is saved for the next run.
+
     If possible, it is highly recommended to NOT use the Username/Password
     Oauth Flow, as it requires your code/configuration to have sensitive
     information such as password and security token. We recommend using the
@@ -37,28 +344,56 @@ def authenticate(config):
         config:
             The configuration dict that could have been loaded from the
             readConfig method above in this file
+        rejectedToken:
+            An access token the API just rejected. It is never handed out
+            again, even if it is still in the cache
+    Raises:
+        RequestFailed: no access token could be had, so the run (or the
+        request that needed a new token) cannot go on
     """
-    print('Authenticating to Salesforce')
-    authReqData = {
-        'grant_type':'password',
-        'client_id':config['Salesforce']['consumer_key'],
-        'client_secret':config['Salesforce']['consumer_secret'],
-        'username': config['Salesforce']['username'],
-        'password': config['Salesforce']['password'] + config['Salesforce']['security_token']
-    }
-    tokenUrl = config['Salesforce']['url'] + '/services/oauth2/token'
+    tokenCache = getTokenCache(config)
+    cacheKey = hashlib.sha256('{url} {username} {consumerKey}'.format(url = config['Salesforce']['url'], \
+                                                                      username = config['Salesforce']['username'], \
+                                                                      consumerKey = config['Salesforce']['consumer_key']) \
+                              .encode('utf-8')).hexdigest()
+    # only one thread or process logs in at a time, the others pick up its token
+    with tokenCache.locked() if tokenCache else contextlib.nullcontext():
+        accessToken = tokenCache.get(cacheKey) if tokenCache else None
+        if accessToken and accessToken != rejectedToken:
+            print('Using cached access token, ready to make API requests')
+            config['Salesforce']['access_token'] = accessToken
+            return
 
-    response = requests.post(tokenUrl, data=authReqData)
+        print('Authenticating to Salesforce')
+        authReqData = {
+            'grant_type':'password',
+            'client_id':config['Salesforce']['consumer_key'],
+            'client_secret':config['Salesforce']['consumer_secret'],
+            'username': config['Salesforce']['username'],
+            'password': config['Salesforce']['password'] + config['Salesforce']['security_token']
+        }
+        tokenUrl = config['Salesforce']['url'] + '/services/oauth2/token'
 
-    # print(response.json()) # uncomment this line to view the response JSON if you are having troubles
-    if response.status_code == 200:
-        print('Got access token, ready to make API requests')
-        config['Salesforce']['access_token'] = response.json().get('access_token')
-    else:
-        print('Had trouble getting access token. Make sure User and Connected App are correctly configured '\
-            + 'in config/app.ini')
-        print('Status:{}, {}: {}'.format(response.status_code, response.json().get('error'), response.json().get('error_description') ))
-        sys.exit(1)
+        response = getClient(config).request('POST', tokenUrl, 'oauth2/token', data=authReqData)
+
+        # print(response.json()) # uncomment this line to view the response JSON if you are having troubles
+        if response.status_code == 200:
+            print('Got access token, ready to make API requests')
+            config['Salesforce']['access_token'] = response.json().get('access_token')
+            if tokenCache:
+                tokenCache.put(cacheKey, config['Salesforce']['access_token'])
+        else:
+            print('Had trouble getting access token. Make sure User and Connected App are correctly configured '\
+                + 'in config/app.ini')
+            try:
+                error = response.json()
+                reason = 'Status:{}, {}: {}'.format(response.status_code, error.get('error'), error.get('error_description'))
+            except (ValueError, AttributeError):
+                reason = 'Status:{}'.format(response.status_code)
+            print(reason)
+            # this may be a worker thread getting a new token (see PardotClient), so rather than
+            # exiting, fail the request that needed the token and let the caller deal with it
+            raise RequestFailed('could not get an access token, ' + reason)
 
 # ****************************************************************************
 # These functions support the set up and tear down of the demo. Useful to look
@@ -67,9 +402,8 @@ def authenticate(config):
 def createCustomField(config, fieldName, rowNum):
     """Creates a single Custom Field via Pardot API.
 
-    Upon successful creation of a Custom Field, the file config/fields.csv
-    will be created/appended to include details for the field, so that it can
-    be removed later on
+    The caller is expected to keep track of the id of the new Custom Field
+    (see writeFieldsManifest), so that it can be removed later on
 
     Args:
         config:
@@ -82,57 +416,151 @@ def createCustomField(config, fieldName, rowNum):
             As custom fields might be created for multiple line items, 
             this arg is used to include the line item number in the
             Label and API name of the Custom Field
+    Returns:
+        the Pardot ID of the new Custom Field, or None when it could not be
+        created (the failure is saved to the dead letter file)
     """
-    fieldApiName = config['Field Naming']['api_format'].replace('{d}', str(rowNum)).replace('{field}', fieldName)
-    fieldLabel = config['Field Naming']['human_format'].replace('{d}', str(rowNum)).replace('{field}', fieldName)
-
-    apiUrl = '{pardotUrl}/api/customField/version/{legacyVersion}/do/create?format=json' \
-            .format(pardotUrl=config['Pardot']['url'], \
-                    legacyVersion=config['Pardot']['legacy_api_version'])
+    fieldApiName = formatFieldName(config['Field Naming']['api_format'], fieldName, rowNum)
+    fieldLabel = formatFieldName(config['Field Naming']['human_format'], fieldName, rowNum)
 
     reqData = {
         'name': fieldLabel,
         'field_id': fieldApiName
     }
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-    }
-    response = requests.post(url=apiUrl, data=reqData, headers=reqHeaders)
-    json = response.json()
+    try:
+        response = getClient(config).legacyRequest('POST', 'customField', 'create', data=reqData)
+    except RequestFailed as e:
+        deadLetter(config, 'customField.create', reqData, e.reason)
+        return None
+    json, reason = readLegacyResponse(response)
 
-    if response.status_code == 200 and json.get('@attributes').get('stat') == 'ok':
+    if reason is None:
         print('Successfully created {fieldName}'.format(fieldName=fieldApiName))
-        fieldId = json.get('customField').get('id')
-        # store the created field in a CSV so that it can be later deleted
-        f = open('config/fields.csv','a')
-        f.write('{fieldName},{fieldId}\n'.format(fieldName=fieldApiName, fieldId=fieldId))
-        f.close()
-    else:
-        print('Could not create custom field')
-        print(json)
-        sys.exit(2)
+        return json.get('customField').get('id')
+    deadLetter(config, 'customField.create', reqData, reason)
+    return None
 
-def createCustomFields(config, fieldNames, rowNum):
+def createCustomFields(config, fields, workers=1):
     """Creates a list of Custom Fields via Pardot API.
 
     This function simply wraps the previous createCustomField function,
-    creating 1 field at a time.
+    creating up to `workers` fields at a time.
 
     Args:
         config:
             The configuration dict that could have been loaded from the
             readConfig method above in this file
-        fieldNames:
-            A list of field names that will be created, used for both
-            Label and API name of the Custom Field
-        rowNum:
-            As custom fields might be created for multiple line items, 
-            this arg is used to include the line item number in the
-            Label and API name of the Custom Field
+        fields:
+            A list of (fieldName, rowNum) tuples, see createCustomField
+        workers:
+            How many fields to create at once
+    Returns:
+        a dict mapping the API name of each field that was created to its
+        Pardot ID. Fields that could not be created are left out
+    """
+    created = {}
+    createdLock = threading.Lock()
+    def create(field):
+        fieldName, rowNum = field
+        fieldId = createCustomField(config, fieldName, rowNum)
+        if fieldId is not None:
+            with createdLock:
+                created[formatFieldName(config['Field Naming']['api_format'], fieldName, rowNum)] = fieldId
+    runConcurrently(fields, create, workers)
+    return created
+
+def queryCustomFields(config):
+    """Finds every Custom Field that already exists in Pardot.
+
+    Fields are queried 200 at a time (the most the API returns at once), in
+    order of their id.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        a dict mapping the API name of every Custom Field to its Pardot ID,
+        or None when the fields could not be queried
+    """
+    fields = {}
+    lastId = 0
+    while True:
+        params = {'id_greater_than': lastId, 'sort_by': 'id', 'sort_order': 'ascending', 'limit': 200}
+        try:
+            response = getClient(config).legacyRequest('GET', 'customField', 'query', params=params)
+        except RequestFailed as e:
+            print('Could not query custom fields: {reason}'.format(reason = e.reason))
+            return None
+        json, reason = readLegacyResponse(response)
+        if reason is not None:
+            print('Could not query custom fields: {reason}'.format(reason = reason))
+            return None
+        page = json.get('result', {}).get('customField') or []
+        if isinstance(page, dict):
+            page = [page] # a single result is not wrapped in a list
+        for field in page:
+            fields[field['field_id']] = int(field['id'])
+            lastId = max(lastId, int(field['id']))
+        if len(page) < params['limit']:
+            return fields
+
+def readFieldsManifest():
+    """Reads the Custom Fields created by this demo from config/fields.csv.
+
+    Returns:
+        a dict mapping the API name of each field to its Pardot ID, in the
+        order they were created. Empty when there is no config/fields.csv
+    """
+    if not os.path.isfile('config/fields.csv'):
+        return {}
+    with open('config/fields.csv', 'r', newline='') as csvFile:
+        return {row[0]: int(row[1]) for row in csv.reader(csvFile) if row}
+
+def writeFieldsManifest(fields):
+    """Saves the Custom Fields created by this demo to config/fields.csv, in one go.
+
+    The file is replaced as a whole, so it is never left half written. When
+    there are no fields left, it is removed.
+
+    Args:
+        fields:
+            A dict mapping the API name of each field to its Pardot ID
+    """
+    if not fields:
+        if os.path.isfile('config/fields.csv'):
+            os.remove('config/fields.csv')
+        return
+    with open('config/fields.csv.tmp', 'w', newline='') as csvFile:
+        csv.writer(csvFile).writerows(fields.items())
+    os.replace('config/fields.csv.tmp', 'config/fields.csv')
+
+def checkEmailTemplate(config):
+    """Checks templates/pardotEmailTemplate.html uses the configured fields, and says what is off.
+
+    A template using a field this demo does not fill (say, a listing slot
+    beyond listing_count_max) sends emails with blanks in them, while
+    configured fields the template does not use (a larger listing_count_max
+    than the template has slots) are updated for nothing. Either way, run
+    buildEmailTemplate.py to generate the listing slots from the fields.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+    Returns:
+        False when the template uses fields that are not configured
     """
-    for fieldName in fieldNames:
-        createCustomField(config, fieldName, rowNum)
+    with metrics.timer('template.check'), open('templates/pardotEmailTemplate.html', 'r') as templateFile:
+        missing, unused = getFieldNameTable(config).checkTemplate(templateFile.read())
+    if unused:
+        print('the email template does not use {count} of the fields: {fields}' \
+                .format(count = len(unused), fields = ', '.join(unused)))
+    if missing:
+        print('the email template uses {count} fields that are not configured: {fields}. Run buildEmailTemplate.py ' \
+                'to generate its listing slots from [Field Naming] in config/app.ini' \
+                .format(count = len(missing), fields = ', '.join(missing)))
+    return not missing
 
 def deleteCustomField(config, fieldApiName, fieldId):
     """Deletes a single Custom Field via Pardot API.
@@ -147,22 +575,45 @@ def deleteCustomField(config, fieldApiName, fieldId):
             output
         fieldId:
             The Custom Field Id for the Custom Field in Pardot.
+    Returns:
+        True when the field was deleted. Otherwise, the failure is saved to the
+        dead letter file
     """
-    apiUrl = '{pardotUrl}/api/customField/version/{legacyVersion}/do/delete/id/{fieldId}?format=json' \
-            .format(pardotUrl = config['Pardot']['url'], \
-                    legacyVersion=config['Pardot']['legacy_api_version'], \
-                    fieldId=fieldId)
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-    }
-    response = requests.delete(url=apiUrl,headers=reqHeaders)
+    item = {'field_id': fieldApiName, 'id': fieldId}
+    try:
+        response = getClient(config).legacyRequest('DELETE', 'customField', 'delete/id/{fieldId}'.format(fieldId=fieldId))
+    except RequestFailed as e:
+        deadLetter(config, 'customField.delete', item, e.reason)
+        return False
     if response.status_code == 204:
         print('Successfully deleted {fieldName}'.format(fieldName=fieldApiName))
-    else:
-        print('Could not create custom field {fieldName}'.format(fieldName=fieldApiName))
-        print(json)
-        sys.exit(3)
+        return True
+    deadLetter(config, 'customField.delete', item, failureReason(response))
+    return False
+
+def deleteCustomFields(config, fields, workers=1):
+    """Deletes a list of Custom Fields via Pardot API, up to `workers` at a time.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        fields:
+            A dict mapping the API name of each field to its Pardot ID
+        workers:
+            How many fields to delete at once
+    Returns:
+        a dict with the fields that could not be deleted
+    """
+    remaining = {}
+    remainingLock = threading.Lock()
+    def delete(field):
+        fieldApiName, fieldId = field
+        if not deleteCustomField(config, fieldApiName, fieldId):
+            with remainingLock:
+                remaining[fieldApiName] = fieldId
+    runConcurrently(list(fields.items()), delete, workers)
+    return remaining
 # ****************************************************************************
 # End of functions that support the set up and tear down of the demo
 # ****************************************************************************
@@ -182,24 +633,25 @@ def updateProspect(config, prospectId, prospectFields):
         prospectFields:
             A dict which represents Pardot Field API Name and Value key/pairs,
             which we want to update for the Prospect Record
+    Returns:
+        True when the Prospect was updated. Otherwise, the failure is saved to
+        the dead letter file
     """
-    # now we can prepare the API request
-    apiUrl = '{pardotUrl}/api/prospect/version/{legacyVersion}/do/update/id/{prospectId}?format=json' \
-            .format(pardotUrl = config['Pardot']['url'], \
-                    legacyVersion = config['Pardot']['legacy_api_version'], \
-                    prospectId = prospectId)
-
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
-    }
-    response = requests.post(url=apiUrl, data=prospectFields, headers=reqHeaders)
-    json = response.json()
+    item = dict(prospectFields, id=prospectId)
+    # now we can send the API request
+    try:
+        response = getClient(config).legacyRequest('POST', 'prospect', 'update/id/{prospectId}'.format(prospectId=prospectId), \
+                                                   data=prospectFields)
+    except RequestFailed as e:
+        deadLetter(config, 'prospect.update', item, e.reason)
+        return False
+    reason = readLegacyResponse(response)[1]
 
-    if response.status_code != 200 or json.get('@attributes').get('stat') != 'ok':
-        print('Could not update prospect {}'.format(prospectId))
-        print(json)
-        sys.exit(4)
+    if reason is not None:
+        deadLetter(config, 'prospect.update', item, reason)
+        return False
+    metrics.count('prospects.updated')
+    return True
 
 def prepareProspectFields(config, listings, agentName):
     """Prepares Prospect Field values for a bunch of listings, for later update.
@@ -208,6 +660,9 @@ def prepareProspectFields(config, listings, agentName):
     (such as Agent Name and Number of Listings) as well as the fields for
     allowing all Listing info to be present.
 
+    The field names themselves are only worked out once per configuration
+    (see fieldSchema.FieldNameTable), so this just copies values into place.
+
     Args:
         config:
             The configuration dict that could have been loaded from the
@@ -222,50 +677,202 @@ def prepareProspectFields(config, listings, agentName):
         a dict containing the Prospect Field Name (key) and Value for each
         Pardot field that needs to be updated
     """
-    # first we need to build our Prospect Update Request data
-    prospectFields = {}
-    fieldNameFormat = config['Field Naming']['api_format']
-
-    # these 2 fields are not line-item dependant, so we keep them out of a loop
-    listingCountFieldName = fieldNameFormat.format(field='Count', lineItemNumber='')
-    prospectFields[listingCountFieldName] = len(listings)
-
-    agentNameFieldName = fieldNameFormat.format(field='AgentName', lineItemNumber='')
-    prospectFields[agentNameFieldName] = agentName
-    
-    # now we loop through the listings
-    listingNumber=1
-    for listing in listings:
-        # here we "build" the field name, taking into consideration the 
-        # - "line item field" 
-        # - "listing number", or the LineItemNumber
-        priceFieldName = fieldNameFormat.format(field='Price', lineItemNumber=listingNumber)
-        prospectFields[priceFieldName] = listing['price']
-        # repeat for each field
-        bedroomsFieldName = fieldNameFormat.format(field='Bedrooms', lineItemNumber=listingNumber)
-        prospectFields[bedroomsFieldName] = listing['bedrooms']
-
-        bathroomsFieldName = fieldNameFormat.format(field='Bathrooms', lineItemNumber=listingNumber)
-        prospectFields[bathroomsFieldName] = listing['bathrooms']
-
-        sqftFieldName = fieldNameFormat.format(field='Sqft', lineItemNumber=listingNumber)
-        prospectFields[sqftFieldName] = listing['sqft']
-
-        addressFieldName = fieldNameFormat.format(field='Address', lineItemNumber=listingNumber)
-        prospectFields[addressFieldName] = listing['fullAddress']
-
-        listingUrlFieldName = fieldNameFormat.format(field='ListingUrl', lineItemNumber=listingNumber)
-        prospectFields[listingUrlFieldName] = listing['listing_url']
-
-        imageUrlFieldName = fieldNameFormat.format(field='ImageUrl', lineItemNumber=listingNumber)
-        prospectFields[imageUrlFieldName] = listing['image_url']
-        
-        listingNumber = listingNumber + 1
-    return prospectFields
+    with metrics.timer('fields.prepare'):
+        return getFieldNameTable(config).prospectFields(listings, agentName)
+
+def prepareProspectFieldsBatch(config, recipientsListings):
+    """Prepares Prospect Field values for many recipients at once, ready for updateBatch.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        recipientsListings:
+            An iterable of (recipient, listings) tuples
+    Returns:
+        a list with a dict of Prospect Field values (including the Prospect
+        `id`) for each recipient
+    """
+    with metrics.timer('fields.prepare'):
+        return getFieldNameTable(config).prospectFieldsBatch(recipientsListings)
+
+def listingFieldChanges(config, prospectId, prospectFields):
+    """Works out which listing fields actually need to be sent to a Prospect.
+
+    With a field state store (see getFieldStateStore), that is only the fields
+    whose value changed since they were last written, plus blanks for fields
+    that hold a value but are no longer needed. Without one, every field is
+    sent, as always.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        prospectId:
+            The Pardot ID of the Prospect that we are updating.
+        prospectFields:
+            A dict which represents every Pardot Field API Name and Value
+            the Prospect should end up with
+    Returns:
+        a dict of the fields (and values) to send, which may be empty
+    """
+    store = getFieldStateStore(config)
+    if store is None:
+        return {k: v for k, v in prospectFields.items() if k != 'id'}
+    with metrics.timer('fieldState.diff'):
+        return store.changedFields(prospectId, prospectFields)
+
+def listingFieldsToClean(config, prospectId, prospectFields):
+    """Works out which fields need to be blanked to clean a Prospect up.
+
+    With a field state store, that is only the fields that hold a value.
+    Without one, every field in prospectFields is blanked.
+
+    Returns:
+        a dict mapping each field to clean to ''
+    """
+    store = getFieldStateStore(config)
+    if store is None:
+        return {k: '' for k in prospectFields if k != 'id'} # we don't want to wipe the id out
+    return store.filledFields(prospectId)
+
+def recordListingFields(config, writes):
+    """Records fields that were successfully written, when there is a field state store.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        writes:
+            A list of (prospectId, prospectFields) tuples
+    """
+    store = getFieldStateStore(config)
+    if store is not None:
+        # only listing fields are remembered, not list memberships or anything else sent along
+        fieldNames = getFieldNameTable(config).fieldNames
+        writes = [(prospectId, prospectFields if prospectFields.keys() <= fieldNames else \
+                   {k: v for k, v in prospectFields.items() if k in fieldNames}) for prospectId, prospectFields in writes]
+        with metrics.timer('fieldState.record'):
+            store.recordMany(writes)
+
+def listMembershipField(listId):
+    """Provides the Prospect field that adds a Prospect to a List (set to 1) or
+    removes it (set to 0), in a regular or batch Prospect update."""
+    return 'list_{listId}'.format(listId = listId)
+
+def incrementalPayloadHash(config, payload):
+    """Provides the hash of what a recipient's email is made from, in incremental mode.
+
+    With `enabled` in the `[Incremental]` section of config/app.ini (and a
+    field state store to keep the hashes in), recipients whose email would be
+    the same as the last one they were sent can be left out, see
+    skipUnchangedPayload.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        payload:
+            What the email is made from, such as the fields the Prospect is
+            updated with (see fieldStateStore.payloadHash)
+    Returns:
+        the hash, or None when not running incrementally
+    """
+    if not config.getboolean('Incremental', 'enabled', fallback=False) or getFieldStateStore(config) is None:
+        return None
+    return payloadHash(payload)
+
+def skipUnchangedPayload(config, prospectId, digest):
+    """Decides whether a recipient whose email did not change is left out of the run.
+
+    An email is unchanged when its hash is the one last sent to the Prospect,
+    less than `resend_after_days` ago (when set). What happens to unchanged
+    emails is up to the `unchanged` policy of the `[Incremental]` section:
+    `skip` leaves the recipient out, `send` sends it again anyway (only
+    updating the fields that changed, with a field state store).
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        prospectId:
+            The Pardot ID of the Prospect about to be sent to
+        digest:
+            The hash provided by incrementalPayloadHash
+    Returns:
+        True when the recipient should be left out
+    """
+    if digest is None:
+        return False
+    sent = getFieldStateStore(config).sentPayload(prospectId)
+    if sent is None or sent[0] != digest:
+        metrics.count('recipients.changed')
+        return False
+    resendAfterDays = config.getfloat('Incremental', 'resend_after_days', fallback=0)
+    if resendAfterDays > 0 and time.time() - sent[1] >= resendAfterDays * 86400:
+        metrics.count('recipients.changed')
+        return False
+    metrics.count('recipients.unchanged')
+    return config.get('Incremental', 'unchanged', fallback='skip') == 'skip'
+
+def recordSentPayloads(config, payloads):
+    """Records the hash of emails that were sent, in incremental mode.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        payloads:
+            A list of (prospectId, hash) tuples, hashes being None when not
+            running incrementally
+    """
+    payloads = [(prospectId, digest) for prospectId, digest in payloads if digest is not None]
+    if payloads:
+        getFieldStateStore(config).recordSent(payloads)
+
+def recordPendingPayloads(config, runId, payloads):
+    """Records the hash of emails waiting on a list send, see recordSentPayloads
+    and confirmPendingPayloads."""
+    payloads = [(prospectId, digest) for prospectId, digest in payloads if digest is not None]
+    if payloads:
+        getFieldStateStore(config).recordPending(runId, payloads)
+
+def confirmPendingPayloads(config, runId):
+    """Records the emails waiting on a run's list send as sent, once it went out."""
+    store = getFieldStateStore(config)
+    if store is not None and config.getboolean('Incremental', 'enabled', fallback=False):
+        store.confirmPending(runId)
+
+def updateProspectListingFields(config, prospectId, prospectFields):
+    """Updates a Prospect's listing fields, sending only what changed.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        prospectId:
+            The Pardot ID of the Prospect that we are updating.
+        prospectFields:
+            A dict which represents Pardot Field API Name and Value key/pairs,
+            which we want to update for the Prospect Record
+    Returns:
+        False when the update failed (see updateProspect). When nothing
+        changed, no update is needed and True is returned
+    """
+    changes = listingFieldChanges(config, prospectId, prospectFields)
+    if not changes:
+        return True
+    if not updateProspect(config, prospectId, changes):
+        return False
+    recordListingFields(config, [(prospectId, changes)])
+    return True
 
 def updateProspectCleaningListingFields(config, prospectId, prospectFields):
     """Clears out the value of each Custom Field that was previously calculated.
 
+    With a field state store, only the fields actually holding a value are
+    cleared.
+
     Args:
         config:
             The configuration dict that could have been loaded from the
@@ -275,11 +882,16 @@ def updateProspectCleaningListingFields(config, prospectId, prospectFields):
         prospectFields:
             A dict which represents Pardot Field API Name and Value key/pairs,
             which we want to clear for the Prospect Record
+    Returns:
+        False when the update failed (see updateProspect)
     """
-    for k,v in prospectFields.items():
-        if k == 'id': continue # we don't want to wipe this out
-        prospectFields[k]=''
-    updateProspect(config, prospectId, prospectFields)
+    cleared = listingFieldsToClean(config, prospectId, prospectFields)
+    if not cleared:
+        return True
+    if not updateProspect(config, prospectId, cleared):
+        return False
+    recordListingFields(config, [(prospectId, cleared)])
+    return True
 
 def updateBatch(config, batchProspects):
     """Uses the Pardot API to update a list of Prospects in a single API call.
@@ -295,32 +907,132 @@ def updateBatch(config, batchProspects):
             readConfig method above in this file
         batchProspects:
             A batch of Prospects. Should not exceed 50
+    Returns:
+        a dict mapping the id of each Prospect that could not be updated to
+        the reason why. These are also saved to the dead letter file
     """
-    reqData = {'prospects': batchProspects }
-    if(int(config['Pardot']['legacy_api_version']) == 3):
-        # we need to adjust the data structure of the request for API version 3
-        # I apologize, I don't have an environment to test this, so it may have bugs.
-        # If it does, let me know and we can work it out!
-        reqData = {'prospects': {}}
-        for prospect in batchProspects:  # loop thru each prospect
-            pData = {prospect['id']: {}} # create dict for the actual Prospect
-            for k,v in prospect.items(): # loop thru each field
-                if k == 'id': continue   # we don't want this in the values
-                pData[prospect['id']][k] = v # prospect ID is the key for the dict
-
-    apiUrl = '{pardotUrl}/api/prospect/version/{legacyVersion}/do/batchUpdate?format=json' \
-            .format(pardotUrl = config['Pardot']['url'], \
-                    legacyVersion = config['Pardot']['legacy_api_version'])
-
-    reqHeaders = {
-        'Authorization': 'Bearer '+ config['Salesforce']['access_token'],
-        'Pardot-Business-Unit-Id': config['Pardot']['business_unit_id']
+    failures, jsonResponse = sendBatchUpdate(config, batchProspects)
+
+    for prospect in batchProspects:
+        if str(prospect['id']) in failures:
+            deadLetter(config, 'prospect.batchUpdate', prospect, failures[str(prospect['id'])])
+    return failures
+
+def sendBatchUpdate(config, batchProspects, prospectsJson=None):
+    """Sends a batch update, reporting which Prospects could not be updated.
+
+    Unlike updateBatch, failures are not saved to the dead letter file, so
+    the caller can decide what to do with (for example, retry) them.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        batchProspects:
+            A batch of Prospects. Should not exceed 50
+        prospectsJson:
+            Optionally, the batch already encoded for the API version in use
+            (see batchPayload.BatchPayload). Otherwise it is encoded here
+    Returns:
+        a tuple of a dict mapping the id of each Prospect that could not be
+        updated to the reason why (empty when the whole batch worked), and the
+        JSON response
+    """
+    if prospectsJson is None:
+        # API version 3 wants the prospects keyed by id rather than in a list, see batchPayload
+        with metrics.timer('batch.encode'):
+            prospectsJson = encodeBatch(batchProspects, config['Pardot']['legacy_api_version'])
+    try:
+        response = getClient(config).legacyRequest('POST', 'prospect', 'batchUpdate', data={'prospects': prospectsJson})
+    except RequestFailed as e:
+        return {str(prospect['id']): e.reason for prospect in batchProspects}, None
+    jsonResponse, reason = readLegacyResponse(response)
+
+    if reason is not None:
+        return {str(prospect['id']): reason for prospect in batchProspects}, jsonResponse
+
+    # the batch went through, though some Prospects may still have been rejected. Errors are
+    # keyed by Prospect id, or by the position of the Prospect in the batch
+    failures = {}
+    prospectIds = [str(prospect['id']) for prospect in batchProspects]
+    for key, reason in (jsonResponse.get('errors') or {}).items():
+        if key in prospectIds:
+            failures[key] = reason
+        elif key.isdigit() and int(key) < len(prospectIds):
+            failures[prospectIds[int(key)]] = reason
+    metrics.count('prospects.updated', len(batchProspects) - len(failures))
+    return failures, jsonResponse
+
+def sendListEmail(config, listId=None):
+    """Sends the Pardot Email Template to a whole List, in a single API call.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        listId:
+            The Pardot List to send to. Defaults to the sending_list_id in
+            the `[Pardot]` section of config/app.ini
+    Returns:
+        True when the email was sent. Otherwise, the failure is saved to the
+        dead letter file
+    """
+    listId = listId or config['Pardot']['sending_list_id']
+    client = getClient(config)
+    print(client.legacyApiUrl('email', 'send/'))
+    reqData = {
+        # required fields for a one-to-one, providing complete HTML Content and Sender Details
+        # (not specifying Pardot User Id)
+        'campaign_id': config['Pardot']['campaign_id'],
+        'email_template_id': config['Pardot']['email_template_id'],
+        'list_ids[]': listId
     }
-    prospectsString = json.dumps(reqData)
-    response = requests.post(url=apiUrl, data={'prospects': prospectsString}, headers=reqHeaders)
-    jsonResponse = response.json()
-
-    if response.status_code != 200 or jsonResponse.get('@attributes').get('stat') != 'ok':
-        print('Could not update batch')
-        print(jsonResponse)
-        sys.exit(5)
\ No newline at end of file
+    print(reqData)
+    try:
+        response = client.legacyRequest('POST', 'email', 'send/', idempotent=False, data=reqData)
+        reason = readLegacyResponse(response)[1]
+    except RequestFailed as e:
+        reason = e.reason
+    sent = reason is None
+
+    if sent:
+        metrics.count('emails.listSent')
+        print('Successfully sent email to list {pardotListId}'.format(\
+            pardotListId = listId ))
+    else:
+        deadLetter(config, 'email.listSend', reqData, reason)
+    return sent
+
+def scheduleListCleanups(config, cleanupQueue, runId, sent, membership=False):
+    """Decides when the clean ups queued for a list send are due, and says so.
+
+    Args:
+        config:
+            The configuration dict that could have been loaded from the
+            readConfig method above in this file
+        cleanupQueue:
+            The CleanupQueue the clean ups of the run were saved to
+        runId:
+            The run the clean ups belong to
+        sent:
+            Whether the email was sent
+        membership:
+            Whether the clean ups also take the Prospects off the List they
+            were sent to, which is due even when clear_after_send is off
+    """
+    if not sent:
+        # the prospects that were updated keep their listings (and their clean ups wait), so that the run
+        # can be finished with --resume. To give up on it instead, clean up with 6-runCleanupQueue.py --now
+        print('email not sent, run again with --resume once the failures are sorted out')
+    elif not membership and not config.getboolean('Field State', 'clear_after_send', fallback=True):
+        # with a field state store, the clean up can be turned off: the next run then blanks whatever each
+        # prospect no longer needs, along with updating what changed
+        print('email sent, leaving the listing fields in place until the next run')
+    else:
+        # clearing the values too soon could result in a bunch of blank emails, so the clean ups only
+        # become due once Pardot has had time to deliver the email
+        delayMinutes = config.getfloat('Cleanup', 'delay_minutes', fallback=60)
+        cleanupQueue.schedule(runId, time.time() + delayMinutes * 60)
+        batchCount, _ = cleanupQueue.pending()
+        print('email sent, {batchCount} clean up batches queued. They are due in {delay:g} minutes, '\
+                'run 6-runCleanupQueue.py to clean the prospects up'.format(batchCount = batchCount, delay = delayMinutes))
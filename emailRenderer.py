@@ -0,0 +1,121 @@
+"""Renders the complete HTML email sent by 2-sendCompleteHtmlToProspects.py.
+
+Rendering happens in worker processes, so the template is loaded once per
+process by `loadTemplate` (used as the process pool initializer) and then
+reused for every recipient that process renders.
+
+When given a module directory, Mako keeps the compiled template there as a
+regular Python module. It is only recompiled when the template file is newer
+than the compiled module, so most runs skip compilation entirely.
+
+Most of an email only depends on its listings; the recipient only shows up in
+a few places (the agent's name, for example). When many recipients get the
+same listings, each set of listings is rendered once, with a placeholder
+wherever a recipient value goes, and kept in a bounded cache (least recently
+used sets are dropped first). Every other recipient with the same listings
+only needs their values put in place of the placeholders. This relies on the
+template only printing recipient values, never making decisions on them.
+
+A set of listings is only cached the second time it comes up: when every
+recipient gets listings of their own, caching would only add work.
+"""
+import collections, time
+from mako.template import Template
+
+# surrounds the key of each recipient value in a cached render, such as \x00agent\x00
+_PLACEHOLDER_MARK = '\x00'
+
+_template = None
+_renders = collections.OrderedDict()
+_seen = collections.OrderedDict() # sets of listings rendered once, which get cached if they come up again
+_cacheSize = 0
+
+class _RecipientPlaceholders:
+    """Hands the template a placeholder instead of each recipient value."""
+    def __getitem__(self, key):
+        return _PLACEHOLDER_MARK + key + _PLACEHOLDER_MARK
+
+    def get(self, key, default=None):
+        return self[key]
+
+def loadTemplate(filename, moduleDirectory=None, cacheSize=0):
+    """Loads the Mako template used by every later call to renderEmail.
+
+    Args:
+        filename:
+            The path of the Mako template, such as
+            `templates/completeHtmlTemplate.html`
+        moduleDirectory:
+            Optionally, where compiled templates are cached between runs
+            (see `module_directory` in the `[Templates]` section of
+            config/app.ini)
+        cacheSize:
+            How many sets of listings renderEmailCached keeps rendered (see
+            `render_cache_size` in the `[Templates]` section of
+            config/app.ini). 0 turns the cache off
+    """
+    global _template, _cacheSize
+    _template = Template(filename=filename, module_directory=moduleDirectory or None)
+    _renders.clear()
+    _seen.clear()
+    _cacheSize = cacheSize
+
+def renderEmail(recipientListings):
+    """Renders the HTML email for one recipient.
+
+    Args:
+        recipientListings:
+            A (recipient, listings) tuple, with the recipient dict and the
+            list of listings to show them
+    Returns:
+        the complete HTML for the email
+    """
+    recipient, listings = recipientListings
+    return _template.render(listings=listings, recipient=recipient)
+
+def renderEmailCached(recipientListings):
+    """Renders the HTML email for one recipient, like renderEmail, reusing the
+    render of the same listings for an earlier recipient when there is one.
+
+    Returns:
+        a tuple of the complete HTML for the email and whether the render
+        was found in the cache
+    """
+    if not _cacheSize:
+        return renderEmail(recipientListings), False
+    recipient, listings = recipientListings
+    key = tuple(listing['id'] for listing in listings)
+    pieces = _renders.get(key)
+    hit = pieces is not None
+    if hit:
+        _renders.move_to_end(key)
+    elif key not in _seen:
+        # the first time these listings come up, only remember them
+        _seen[key] = None
+        if len(_seen) > _cacheSize:
+            _seen.popitem(last=False)
+        return renderEmail(recipientListings), False
+    else:
+        del _seen[key]
+        # literal HTML and recipient keys take turns: html, key, html, key, ..., html
+        pieces = _template.render(listings=listings, recipient=_RecipientPlaceholders()).split(_PLACEHOLDER_MARK)
+        _renders[key] = pieces
+        if len(_renders) > _cacheSize:
+            _renders.popitem(last=False)
+    html = pieces[:]
+    for i in range(1, len(html), 2):
+        html[i] = str(recipient[html[i]])
+    return ''.join(html), hit
+
+def renderEmailTimed(recipientListings):
+    """Renders the HTML email for one recipient, like renderEmailCached, also
+    saying how long it took (the rendering process can't add to the metrics
+    of the process sending the email).
+
+    Returns:
+        a tuple of the complete HTML for the email, the seconds it took and
+        whether the render was found in the cache
+    """
+    started = time.perf_counter()
+    emailHtml, hit = renderEmailCached(recipientListings)
+    return emailHtml, time.perf_counter() - started, hit
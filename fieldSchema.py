@@ -0,0 +1,193 @@
+"""Describes the Pardot Custom Fields used to flatten Listings onto a Prospect.
+
+Every Prospect gets 2 fields which aren't specific to a listing (Count and
+AgentName), plus 7 fields for each listing "slot", up to listing_count_max.
+Field names come from the `api_format` in the `[Field Naming]` section of
+config/app.ini, where `{field}` is replaced by the field and `{d}` by the slot
+number (or nothing, for the fields that aren't specific to a listing).
+
+This module is the one place the fields are defined. From it come:
+
+- the Custom Fields script 1 creates (customFieldDefinitions)
+- the listing slots of templates/pardotEmailTemplate.html, generated from the
+  block in templates/pardotListingSlot.html by buildEmailTemplate.py
+  (renderSlotBlocks)
+- the function building a recipient's Prospect payload, compiled for the
+  configured fields (compilePayloadBuilder)
+
+and every run can check the template uses the same fields before sending
+anything (FieldNameTable.checkTemplate).
+
+As the set of field names never changes during a run, `FieldNameTable` works
+them all out once, so building the Prospect payload for a recipient is just a
+matter of copying listing values into place.
+"""
+import operator, re, string
+
+# fields which aren't specific to a listing, in the order they are created
+PROSPECT_FIELDS = ('Count', 'AgentName')
+# fields an email template need not show: the number of listings is there for segmentation and
+# automation rules in Pardot, rather than for the body of the email
+NON_TEMPLATE_FIELDS = ('Count',)
+
+# (field, key of the listing value that goes into it), in the order they are created
+LISTING_FIELDS = (
+    ('Price', 'price'),
+    ('Bedrooms', 'bedrooms'),
+    ('Bathrooms', 'bathrooms'),
+    ('Sqft', 'sqft'),
+    ('Address', 'fullAddress'),
+    ('ListingUrl', 'listing_url'),
+    ('ImageUrl', 'image_url'),
+)
+
+def formatFieldName(fieldFormat, field, lineItemNumber):
+    """Builds a single field name or label from one of the `[Field Naming]` formats.
+
+    Args:
+        fieldFormat:
+            The api_format or human_format from config/app.ini
+        field:
+            The trailing piece of the field name, such as `Price`
+        lineItemNumber:
+            The listing slot number, or '' for fields that aren't specific to
+            a listing
+    Returns:
+        the field name
+    """
+    lineItemNumber = str(lineItemNumber)
+    return fieldFormat.replace('{d}', lineItemNumber) \
+                      .replace('{lineItemNumber}', lineItemNumber) \
+                      .replace('{field}', field)
+
+def customFieldDefinitions(maxListings):
+    """Lists every Custom Field the demo needs, in the order they are created.
+
+    Args:
+        maxListings:
+            The listing_count_max from config/app.ini
+    Returns:
+        a list of (field, lineItemNumber) tuples, ready for formatFieldName.
+        The fields that aren't specific to a listing come first, with a
+        lineItemNumber of ''
+    """
+    return [(field, '') for field in PROSPECT_FIELDS] + \
+           [(field, slot) for slot in range(1, maxListings + 1) for field, listingKey in LISTING_FIELDS]
+
+def compilePayloadBuilder(countField, agentNameField, slotFields, listingValues):
+    """Compiles a function building Prospect payloads for the configured fields.
+
+    The function is generated with every field name written into it and one
+    step per listing slot, rather than looping over slots and field names for
+    every recipient, which makes it a couple of times faster.
+
+    Args:
+        countField, agentNameField:
+            The names of the fields which aren't specific to a listing
+        slotFields:
+            A tuple of field names for each listing slot, in LISTING_FIELDS
+            order
+        listingValues:
+            Provides the values of a listing, in LISTING_FIELDS order
+    Returns:
+        a function taking the listings and agent name of a recipient, and
+        returning the dict of Prospect Field values (see
+        FieldNameTable.prospectFields)
+    """
+    lines = ['def prospectFields(listings, agentName):',
+             '    count = len(listings)',
+             '    fields = {{{count!r}: count, {agent!r}: agentName}}'.format(count = countField, agent = agentNameField)]
+    for slot, fieldNames in enumerate(slotFields):
+        lines.append('    if count <= {slot}: return fields'.format(slot = slot))
+        lines.append('    {targets}, = listingValues(listings[{slot}])'.format(slot = slot, \
+                     targets = ', '.join('fields[{name!r}]'.format(name = name) for name in fieldNames)))
+    lines.append('    return fields')
+    namespace = {'listingValues': listingValues}
+    exec(compile('\n'.join(lines), '<fieldSchema payload builder>', 'exec'), namespace)
+    return namespace['prospectFields']
+
+def renderSlotBlocks(table, blockTemplate):
+    """Generates the HTML of every listing slot of the email template.
+
+    Args:
+        table:
+            The FieldNameTable of the configured fields
+        blockTemplate:
+            The HTML of a single slot, where `$Price`, `$ListingUrl` and the
+            other LISTING_FIELDS stand for that slot's field names, and
+            `$slot` for its number
+    Returns:
+        the HTML of every slot, one after the other
+    """
+    blockTemplate = string.Template(blockTemplate)
+    return ''.join(blockTemplate.substitute(dict(zip([field for field, listingKey in LISTING_FIELDS], fieldNames), slot = slot)) \
+                   for slot, fieldNames in enumerate(table.slotFields, 1))
+
+# a Pardot merge field, such as {{Recipient.FirstName}} or {{#if Recipient.FirstName}}
+RECIPIENT_FIELD_PATTERN = re.compile(r'\{\{\{?\s*(?:#\w+\s+)?Recipient\.(\w+)')
+
+class FieldNameTable:
+    """Every Prospect field name, worked out once from the `[Field Naming]` config."""
+    def __init__(self, config):
+        apiFormat = config['Field Naming']['api_format']
+        self.apiFormat = apiFormat
+        self.maxListings = int(config['Field Naming']['listing_count_max'])
+        self.countField = formatFieldName(apiFormat, 'Count', '')
+        self.agentNameField = formatFieldName(apiFormat, 'AgentName', '')
+        # slotFields[0] holds the names of the fields for the first listing, and so on
+        self.slotFields = [tuple(formatFieldName(apiFormat, field, slot) for field, listingKey in LISTING_FIELDS) \
+                           for slot in range(1, self.maxListings + 1)]
+        self._listingValues = operator.itemgetter(*[listingKey for field, listingKey in LISTING_FIELDS])
+        # every field name (plus the Prospect id), to tell listing fields from anything else in a payload
+        self.fieldNames = frozenset(self.allFields() + ['id'])
+        # prospectFields(listings, agentName) builds the Prospect Field values for a recipient's listings:
+        # a dict of every field to update, leaving out listings beyond listing_count_max
+        self.prospectFields = compilePayloadBuilder(self.countField, self.agentNameField, self.slotFields, \
+                                                    self._listingValues)
+
+    def allFields(self):
+        """Provides the name of every field, in the order they are created."""
+        return [formatFieldName(self.apiFormat, field, slot) for field, slot in customFieldDefinitions(self.maxListings)]
+
+    def checkTemplate(self, templateText):
+        """Compares the merge fields of an email template with the configured fields.
+
+        Only merge fields named like the configured fields (see api_format)
+        are checked, so standard Prospect fields such as FirstName are left
+        alone.
+
+        Args:
+            templateText:
+                The HTML of the Pardot email template
+        Returns:
+            a tuple of two sorted lists: the fields the template uses but
+            which are not configured (a listing slot beyond
+            listing_count_max, or a misspelled field), and the configured
+            fields the template does not use (other than NON_TEMPLATE_FIELDS)
+        """
+        pattern = re.escape(self.apiFormat).replace(re.escape('{d}'), r'\d*') \
+                                           .replace(re.escape('{lineItemNumber}'), r'\d*') \
+                                           .replace(re.escape('{field}'), r'\w+')
+        ourField = re.compile(pattern + '$')
+        used = set(name for name in RECIPIENT_FIELD_PATTERN.findall(templateText) if ourField.match(name))
+        configured = set(self.allFields())
+        optional = set(formatFieldName(self.apiFormat, field, '') for field in NON_TEMPLATE_FIELDS)
+        return sorted(used - configured), sorted(configured - used - optional)
+
+    def prospectFieldsBatch(self, recipientsListings):
+        """Builds the Prospect payloads for many recipients at once.
+
+        Args:
+            recipientsListings:
+                An iterable of (recipient, listings) tuples
+        Returns:
+            a list with a dict of Prospect Field values for each recipient,
+            including the Prospect `id`, ready for a batch update
+        """
+        payloads = []
+        prospectFields = self.prospectFields
+        for recipient, listings in recipientsListings:
+            fields = prospectFields(listings, recipient['agent'])
+            fields['id'] = recipient['prospectId']
+            payloads.append(fields)
+        return payloads
@@ -0,0 +1,184 @@
+"""Remembers the listing field values last written to each Prospect.
+
+Blindly writing every field on update, then blanking every field after the
+send, doubles the API traffic for fields that often did not change. With the
+values from the last write at hand:
+
+- an update only needs the fields whose value changed, plus blanks for the
+  slots the Prospect no longer needs (Listing5/6 when going from 6 listings
+  to 4). When nothing changed at all, the update can be skipped
+- a cleanup only needs to blank the fields that actually hold a value
+
+The values are kept in a small SQLite database, holding only the fields that
+currently have a value. It is safe to share between threads, and between
+processes working on the same file. Each call recording writes commits
+straight away, in a short transaction, so processes sharing the file (the
+shards of runSharded.py) are never kept waiting on each other for long. The
+database keeps a write-ahead log that is only synced to disk at checkpoints,
+which keeps those commits cheap.
+
+The same database remembers a hash of the last email each Prospect was sent
+(see payloadHash), so incremental runs can leave out the recipients whose
+email would be the same as last time.
+"""
+import hashlib, json, os, sqlite3, threading, time
+
+def payloadHash(payload):
+    """Provides a short hash of what an email is made from, the same in every run.
+
+    Args:
+        payload:
+            Anything the json module can encode (listings included), such as
+            the fields a Prospect is updated with
+    Returns:
+        the hash, as 32 hex digits
+    """
+    text = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=dict)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+class FieldStateStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # with a write-ahead log, a commit is a single append to the log, and NORMAL only syncs
+        # it to disk at checkpoints (a power cut may lose the last commits, but never corrupts)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS prospect_field ('
+                                     'prospect_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, '
+                                     'PRIMARY KEY (prospect_id, field)) WITHOUT ROWID')
+            # the hash of the last email sent to each Prospect, and of the one waiting on a list send
+            self._connection.execute('CREATE TABLE IF NOT EXISTS prospect_payload ('
+                                     'prospect_id TEXT PRIMARY KEY, sent_hash TEXT, sent_at REAL, '
+                                     'pending_hash TEXT, pending_run TEXT) WITHOUT ROWID')
+
+    def lastWritten(self, prospectId):
+        """Provides the fields that hold a value for a Prospect.
+
+        Returns:
+            a dict of field name to the (text) value last written
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT field, value FROM prospect_field WHERE prospect_id = ?', \
+                                            (str(prospectId),)).fetchall()
+        return dict(rows)
+
+    def changedFields(self, prospectId, prospectFields):
+        """Works out which fields an update really needs to send.
+
+        Args:
+            prospectId:
+                The Pardot ID of the Prospect about to be updated
+            prospectFields:
+                Every field (and value) the Prospect should end up with. Any
+                `id` key is left alone
+        Returns:
+            a dict with the fields whose value changed, plus a blank value for
+            every field holding a value that is not part of prospectFields
+        """
+        lastWritten = self.lastWritten(prospectId)
+        changes = {}
+        for field, value in prospectFields.items():
+            if field == 'id':
+                continue
+            if lastWritten.pop(field, '') != str(value):
+                changes[field] = value
+        for field in lastWritten:
+            changes[field] = ''
+        return changes
+
+    def filledFields(self, prospectId):
+        """Provides a blank value for every field currently holding a value.
+
+        Returns:
+            a dict of field name to '', ready for a cleanup update
+        """
+        return dict.fromkeys(self.lastWritten(prospectId), '')
+
+    def record(self, prospectId, prospectFields):
+        """Records fields that were successfully written to a Prospect."""
+        self.recordMany([(prospectId, prospectFields)])
+
+    def recordMany(self, writes):
+        """Records the fields written to many Prospects, in a single transaction.
+
+        Args:
+            writes:
+                An iterable of (prospectId, prospectFields) tuples. Blank
+                values are recorded by forgetting the field
+        """
+        filled = []
+        blank = []
+        for prospectId, prospectFields in writes:
+            for field, value in prospectFields.items():
+                if field == 'id':
+                    continue
+                value = str(value)
+                if value:
+                    filled.append((str(prospectId), field, value))
+                else:
+                    blank.append((str(prospectId), field))
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM prospect_field WHERE prospect_id = ? AND field = ?', blank)
+            self._connection.executemany('INSERT OR REPLACE INTO prospect_field (prospect_id, field, value) '
+                                         'VALUES (?, ?, ?)', filled)
+
+    def sentPayload(self, prospectId):
+        """Provides the hash of the last email sent to a Prospect, and when it was sent.
+
+        Returns:
+            a tuple of the hash (see payloadHash) and the time it was sent (in
+            seconds since the epoch), or None when nothing was sent yet
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT sent_hash, sent_at FROM prospect_payload '
+                                           'WHERE prospect_id = ? AND sent_hash IS NOT NULL', (str(prospectId),)).fetchone()
+        return row
+
+    def recordSent(self, payloads):
+        """Records the emails that were sent.
+
+        Args:
+            payloads:
+                An iterable of (prospectId, hash) tuples
+        """
+        sentAt = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT INTO prospect_payload (prospect_id, sent_hash, sent_at) VALUES (?, ?, ?) '
+                                         'ON CONFLICT (prospect_id) DO UPDATE SET sent_hash = excluded.sent_hash, '
+                                         'sent_at = excluded.sent_at', \
+                                         [(str(prospectId), digest, sentAt) for prospectId, digest in payloads])
+
+    def recordPending(self, runId, payloads):
+        """Records emails that go out with a list send, once it happens (see confirmPending).
+
+        Args:
+            runId:
+                The run whose list send the emails wait on
+            payloads:
+                An iterable of (prospectId, hash) tuples
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT INTO prospect_payload (prospect_id, pending_hash, pending_run) VALUES (?, ?, ?) '
+                                         'ON CONFLICT (prospect_id) DO UPDATE SET pending_hash = excluded.pending_hash, '
+                                         'pending_run = excluded.pending_run', \
+                                         [(str(prospectId), digest, runId) for prospectId, digest in payloads])
+
+    def confirmPending(self, runId):
+        """Records the emails waiting on a run's list send as sent, now that it happened.
+
+        Returns:
+            the number of Prospects recorded
+        """
+        with self._lock, self._connection:
+            return self._connection.execute('UPDATE prospect_payload SET sent_hash = pending_hash, sent_at = ?, '
+                                            'pending_hash = NULL, pending_run = NULL WHERE pending_run = ?', \
+                                            (time.time(), runId)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,239 @@
+"""A compact, columnar store for Listings.
+
+Keeping every listing as a `csv.DictReader` dict costs hundreds of bytes per
+listing for the repeated keys alone, and prices stay as text ("$340,000").
+This store keeps each field in its own column instead:
+
+- price, bedrooms, bathrooms and sqft are typed numeric columns (8 bytes each
+  per listing), ready to be sorted, filtered and indexed
+- id, fullAddress, listing_url and image_url are stored as UTF-8 bytes with an
+  offsets column, and only decoded into a string when they are read
+
+The columns can be saved to a binary snapshot file, which is memory-mapped
+when loaded: loading is nearly instant, and the operating system shares the
+pages between every process working with the same snapshot.
+
+Listings are handed out as `ListingView` objects, which behave like the
+read-only dicts the rest of the demo (and the Mako template) expect.
+"""
+import array, collections.abc, csv, math, mmap, os, struct, tempfile
+
+SNAPSHOT_MAGIC = b'LSTORE02'
+
+# (column name, array typecode). Missing values are stored as -1 (or NaN)
+NUMERIC_COLUMNS = (('price', 'q'), ('bedrooms', 'q'), ('bathrooms', 'd'), ('sqft', 'q'))
+STRING_COLUMNS = ('id', 'fullAddress', 'listing_url', 'image_url')
+FIELD_NAMES = ('id', 'price', 'bedrooms', 'bathrooms', 'sqft', 'fullAddress', 'listing_url', 'image_url')
+
+def parseNumber(value, typecode):
+    """Parses CSV text such as "$340,000" or "2.5" into a column value."""
+    value = (value or '').replace('$', '').replace(',', '').strip()
+    if not value:
+        return math.nan if typecode == 'd' else -1
+    number = float(value)
+    return number if typecode == 'd' else int(round(number))
+
+def _formatNumber(name, value):
+    """Formats a column value the same way it appeared in the original CSV."""
+    if value != value or value < 0: # NaN or -1 are missing values
+        return ''
+    if name == 'price':
+        return '${:,}'.format(value)
+    if name == 'bathrooms':
+        return '{:g}'.format(value)
+    return str(value)
+
+class ListingView(collections.abc.Mapping):
+    """A read-only, dict-like view of a single listing in a ListingStore."""
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._store.value(self._index, name)
+
+    def __iter__(self):
+        return iter(FIELD_NAMES)
+
+    def __len__(self):
+        return len(FIELD_NAMES)
+
+    def __reduce__(self):
+        # views are sent to other processes (for rendering) as plain dicts, as
+        # a memory-mapped store can't be pickled
+        return (dict, (dict(self),))
+
+    def __repr__(self):
+        return 'ListingView({!r})'.format(dict(self))
+
+def snapshotIdentity(snapshotPath):
+    """Reads the identity of the source a snapshot was built from.
+
+    Returns:
+        the identity (see dataSources.DataSource.identity), or None when
+        there is no snapshot, or it was written in an older format
+    """
+    try:
+        with open(snapshotPath, 'rb') as snapshot:
+            if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            identityLength, = struct.unpack('<q', snapshot.read(8))
+            return snapshot.read(identityLength).decode('utf-8')
+    except (OSError, struct.error, UnicodeDecodeError):
+        return None
+
+class ListingStore(collections.abc.Sequence):
+    def __init__(self, rowCount, numericColumns, offsetColumns, blobColumns, mapped=None):
+        self._rowCount = rowCount
+        self._numeric = numericColumns
+        self._offsets = offsetColumns
+        self._blobs = blobColumns
+        self._mapped = mapped # keeps the snapshot mapped for as long as the store lives
+
+    @classmethod
+    def fromRows(cls, rows):
+        """Builds a store from dict rows, such as the ones csv.DictReader provides.
+
+        Args:
+            rows:
+                An iterable of dicts with (at least) the listing FIELD_NAMES
+        Returns:
+            a new in-memory ListingStore
+        """
+        numeric = {name: array.array(typecode) for name, typecode in NUMERIC_COLUMNS}
+        offsets = {name: array.array('q', [0]) for name in STRING_COLUMNS}
+        blobs = {name: bytearray() for name in STRING_COLUMNS}
+        rowCount = 0
+        for row in rows:
+            for name, typecode in NUMERIC_COLUMNS:
+                numeric[name].append(parseNumber(row.get(name), typecode))
+            for name in STRING_COLUMNS:
+                blobs[name] += (row.get(name) or '').encode('utf-8')
+                offsets[name].append(len(blobs[name]))
+            rowCount += 1
+        return cls(rowCount, \
+                   {name: memoryview(column) for name, column in numeric.items()}, \
+                   {name: memoryview(column) for name, column in offsets.items()}, \
+                   {name: memoryview(bytes(blob)) for name, blob in blobs.items()})
+
+    @classmethod
+    def fromCsv(cls, csvPath):
+        with open(csvPath, 'r') as csvFile:
+            return cls.fromRows(csv.DictReader(csvFile))
+
+    @classmethod
+    def load(cls, source, snapshotPath=None):
+        """Loads listings, going through the binary snapshot when one is configured.
+
+        The snapshot is (re)built whenever it is missing, or was built from a
+        source with another identity (see DataSource.identity), then
+        memory-mapped.
+
+        Args:
+            source:
+                Where the listings are read from, a dataSources.DataSource
+            snapshotPath:
+                Optionally, where the binary snapshot is kept
+        Returns:
+            a ListingStore
+        """
+        if not snapshotPath:
+            return cls.fromRows(source.rows(columns=FIELD_NAMES))
+        identity = source.identity()
+        if snapshotIdentity(snapshotPath) != identity:
+            cls.fromRows(source.rows(columns=FIELD_NAMES)).writeSnapshot(snapshotPath, identity)
+        return cls.openSnapshot(snapshotPath)
+
+    def writeSnapshot(self, snapshotPath, sourceIdentity=''):
+        """Writes the store to a binary snapshot file.
+
+        The layout is a header (magic, the identity of the source padded to a
+        multiple of 8 bytes and its length, row count and the length of each
+        string blob), followed by every numeric column, every offsets column
+        and finally every string blob. The file is written next to its final path
+        and then moved into place, so readers never see a partial snapshot.
+        """
+        directory = os.path.dirname(snapshotPath) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=directory, prefix='.listings-')
+        with os.fdopen(fd, 'wb') as snapshot:
+            identity = sourceIdentity.encode('utf-8')
+            snapshot.write(SNAPSHOT_MAGIC)
+            snapshot.write(struct.pack('<q', len(identity)))
+            snapshot.write(identity + b'\0' * (-len(identity) % 8))
+            snapshot.write(struct.pack('<q', self._rowCount))
+            for name in STRING_COLUMNS:
+                snapshot.write(struct.pack('<q', len(self._blobs[name])))
+            for name, typecode in NUMERIC_COLUMNS:
+                snapshot.write(self._numeric[name].tobytes())
+            for name in STRING_COLUMNS:
+                snapshot.write(self._offsets[name].tobytes())
+            for name in STRING_COLUMNS:
+                snapshot.write(self._blobs[name].tobytes())
+        os.chmod(tempPath, 0o644)
+        os.replace(tempPath, snapshotPath)
+
+    @classmethod
+    def openSnapshot(cls, snapshotPath):
+        """Memory-maps a snapshot written by writeSnapshot.
+
+        Returns:
+            a ListingStore reading straight from the mapped file
+        """
+        with open(snapshotPath, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a listing snapshot'.format(snapshotPath))
+
+        view = memoryview(mapped)
+        identityLength, = struct.unpack_from('<q', mapped, len(SNAPSHOT_MAGIC))
+        position = len(SNAPSHOT_MAGIC) + 8 + identityLength + -identityLength % 8
+        rowCount, = struct.unpack_from('<q', mapped, position)
+        position += 8
+        blobLengths = struct.unpack_from('<{}q'.format(len(STRING_COLUMNS)), mapped, position)
+        position += 8 * len(STRING_COLUMNS)
+
+        numeric = {}
+        for name, typecode in NUMERIC_COLUMNS:
+            numeric[name] = view[position:position + 8 * rowCount].cast(typecode)
+            position += 8 * rowCount
+        offsets = {}
+        for name in STRING_COLUMNS:
+            offsets[name] = view[position:position + 8 * (rowCount + 1)].cast('q')
+            position += 8 * (rowCount + 1)
+        blobs = {}
+        for name, length in zip(STRING_COLUMNS, blobLengths):
+            blobs[name] = view[position:position + length]
+            position += length
+        return cls(rowCount, numeric, offsets, blobs, mapped)
+
+    def __len__(self):
+        return self._rowCount
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ListingView(self, i) for i in range(*index.indices(self._rowCount))]
+        if index < 0:
+            index += self._rowCount
+        if not 0 <= index < self._rowCount:
+            raise IndexError('listing index out of range')
+        return ListingView(self, index)
+
+    def column(self, name):
+        """Provides a typed numeric column (price, bedrooms, bathrooms or sqft).
+
+        Returns:
+            a memoryview of the column, indexed by listing position
+        """
+        return self._numeric[name]
+
+    def value(self, index, name):
+        """Provides a single field of a listing, formatted as in the CSV file."""
+        if name in self._numeric:
+            return _formatNumber(name, self._numeric[name][index])
+        if name in self._blobs:
+            offsets = self._offsets[name]
+            return str(self._blobs[name][offsets[index]:offsets[index + 1]], 'utf-8')
+        raise KeyError(name)
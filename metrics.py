@@ -0,0 +1,249 @@
+"""Times each stage of a run, and counts what went through it.
+
+The scripts only print what they are doing, which says little about where the
+time goes: reading recipients, picking listings, preparing fields, rendering,
+encoding batches or waiting on the API. Each of those stages is wrapped in a
+timer, for example:
+
+    with metrics.timer('listings.select'):
+        ...
+
+Timers only keep a call count, a total and a maximum, so they cost about a
+microsecond each and can stay on all the time. At the end of a run the stages
+are printed, slowest first, and saved as JSON or in the Prometheus text
+format (see the `[Metrics]` section of config/app.ini).
+
+For a closer look, a run can also be profiled (`--profile` on scripts 2-4 and 6),
+either with cProfile or with a sampling profiler that takes a snapshot of
+every thread's stack a hundred times a second.
+"""
+import collections, cProfile, io, json, os, pstats, sys, threading, time
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stages = {}
+        self._counters = {}
+
+    def timer(self, stage):
+        """Provides a context manager timing whatever runs inside it as a stage."""
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Records one call of a stage that took `seconds`."""
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                self._stages[stage] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds > stats[2]:
+                    stats[2] = seconds
+
+    def count(self, name, amount=1):
+        """Adds to a counter, such as `emails.sent`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def summary(self):
+        """Summarizes the stages and counters recorded so far.
+
+        Returns:
+            a dict with the elapsed seconds of the run, the call count, total
+            seconds and max milliseconds of each stage, and every counter
+        """
+        with self._lock:
+            return {
+                'elapsed_seconds': time.perf_counter() - self._started,
+                'stages': {stage: {'count': count, 'seconds': seconds, 'max_ms': 1000 * maxSeconds} \
+                           for stage, (count, seconds, maxSeconds) in self._stages.items()},
+                'counters': dict(self._counters)
+            }
+
+class _Timer:
+    __slots__ = ('_metrics', '_stage', '_started')
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._stage, time.perf_counter() - self._started)
+
+# the metrics of this process, used by every module
+_metrics = Metrics()
+
+def timer(stage):
+    return _metrics.timer(stage)
+
+def observe(stage, seconds):
+    _metrics.observe(stage, seconds)
+
+def count(name, amount=1):
+    _metrics.count(name, amount)
+
+def summary():
+    return _metrics.summary()
+
+def mergeSummaries(summaries):
+    """Combines the summaries of several processes, such as the shards of a run.
+
+    Unlike latency percentiles, totals and maximums add up exactly.
+    """
+    merged = {'elapsed_seconds': 0.0, 'stages': {}, 'counters': {}}
+    for summary in summaries:
+        merged['elapsed_seconds'] = max(merged['elapsed_seconds'], summary['elapsed_seconds'])
+        for stage, stats in summary['stages'].items():
+            total = merged['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_ms': 0.0})
+            total['count'] += stats['count']
+            total['seconds'] += stats['seconds']
+            total['max_ms'] = max(total['max_ms'], stats['max_ms'])
+        for name, value in summary['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+    return merged
+
+def printSummary(summary):
+    """Prints every stage, slowest first, then every counter."""
+    print('run took {elapsed_seconds:.1f}s'.format(**summary))
+    for stage, stats in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print('    {stage}: {count} calls, {seconds:.3f}s total, mean {mean:.2f}ms, max {max_ms:.1f}ms' \
+                .format(stage = stage, mean = 1000 * stats['seconds'] / stats['count'], **stats))
+    for name, value in sorted(summary['counters'].items()):
+        print('    {name}: {value}'.format(name = name, value = value))
+
+def writeSummary(summary, path, labels=None):
+    """Saves a summary to a file, as JSON or, for a `.prom` file, in the Prometheus text format.
+
+    Args:
+        summary:
+            The summary, as provided by summary or mergeSummaries
+        path:
+            The file to write. It is replaced as a whole, so a Prometheus
+            textfile collector never reads half a file
+        labels:
+            Optionally, a dict of labels (such as the script) added to every
+            Prometheus sample, and to the JSON
+    """
+    labels = labels or {}
+    if path.endswith('.prom'):
+        content = prometheusText(summary, labels)
+    else:
+        content = json.dumps(dict(summary, labels=labels), indent=2)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporaryPath = '{path}.{pid}.tmp'.format(path = path, pid = os.getpid())
+    with open(temporaryPath, 'w') as metricsFile:
+        metricsFile.write(content)
+    os.replace(temporaryPath, path)
+
+def prometheusText(summary, labels):
+    """Formats a summary in the Prometheus text exposition format."""
+    def sample(name, value, extraLabels=None):
+        allLabels = dict(labels, **(extraLabels or {}))
+        if not allLabels:
+            return '{name} {value}'.format(name = name, value = value)
+        labelText = ','.join('{key}="{value}"'.format(key = key, value = str(value).replace('\\', '\\\\').replace('"', '\\"')) \
+                             for key, value in sorted(allLabels.items()))
+        return '{name}{{{labels}}} {value}'.format(name = name, labels = labelText, value = value)
+
+    stages = sorted(summary['stages'].items())
+    lines = ['# TYPE pardot_run_seconds gauge', sample('pardot_run_seconds', summary['elapsed_seconds'])]
+    lines.append('# TYPE pardot_stage_calls_total counter')
+    lines += [sample('pardot_stage_calls_total', stats['count'], {'stage': stage}) for stage, stats in stages]
+    lines.append('# TYPE pardot_stage_seconds_total counter')
+    lines += [sample('pardot_stage_seconds_total', stats['seconds'], {'stage': stage}) for stage, stats in stages]
+    lines.append('# TYPE pardot_stage_max_seconds gauge')
+    lines += [sample('pardot_stage_max_seconds', stats['max_ms'] / 1000, {'stage': stage}) for stage, stats in stages]
+    lines.append('# TYPE pardot_events_total counter')
+    lines += [sample('pardot_events_total', value, {'event': name}) for name, value in sorted(summary['counters'].items())]
+    return '\n'.join(lines) + '\n'
+
+class Profiler:
+    """Profiles the whole process, every thread included.
+
+    Two modes are available:
+
+    - `cprofile` records every function call with cProfile. It is exact, but
+      slows the run down noticeably. The profile is saved for pstats or
+      snakeviz, and the slowest functions are printed
+    - `sample` takes a snapshot of every thread's stack every `interval`
+      seconds. It barely slows the run down. The stacks are saved in the
+      folded format used by flame graph tools, and the functions seen most
+      often are printed
+
+    Only this process is profiled, not the rendering processes of script 2.
+    """
+    def __init__(self, mode='cprofile', interval=0.01):
+        self.mode = mode
+        self._interval = interval
+        self._profiles = []
+        self._stacks = collections.Counter()
+        self._stopping = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name='metrics-sampler', daemon=True)
+            self._sampler.start()
+            return
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        if sys.version_info < (3, 12):
+            # before 3.12, cProfile only sees the thread that enabled it, so each new thread
+            # enables a profile of its own the first time it calls anything
+            threading.setprofile(self._profileThread)
+        profile.enable()
+
+    def _profileThread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        profile.enable()
+
+    def _sample(self):
+        ownId = threading.get_ident()
+        while not self._stopping.wait(self._interval):
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{name} ({filename}:{line})'.format(name = code.co_name, \
+                                 filename = os.path.basename(code.co_filename), line = code.co_firstlineno))
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self, path):
+        """Stops profiling, saves the profile to `path` and prints the top of it."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.mode == 'sample':
+            self._stopping.set()
+            self._sampler.join()
+            with open(path, 'w') as foldedFile:
+                for stack, samples in self._stacks.most_common():
+                    foldedFile.write('{stack} {samples}\n'.format(stack = stack, samples = samples))
+            functions = collections.Counter()
+            for stack, samples in self._stacks.items():
+                functions[stack.rpartition(';')[2]] += samples
+            total = sum(self._stacks.values()) or 1
+            print('{total} stack samples saved to {path}, most often running:'.format(total = total, path = path))
+            for function, samples in functions.most_common(15):
+                print('    {share:5.1f}% {function}'.format(share = 100 * samples / total, function = function))
+            return
+        threading.setprofile(None)
+        self._profiles[0].disable()
+        output = io.StringIO()
+        stats = pstats.Stats(*self._profiles, stream=output)
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(25)
+        print('profile saved to {path}, the slowest functions:'.format(path = path))
+        print(output.getvalue())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""A local stand-in for the Salesforce and Pardot APIs used by this demo.
+
+Useful for trying out the scripts (and measuring how fast they go) without
+sending a single real email. Start the server, then point both the
+`[Salesforce]` and `[Pardot]` urls in `config/app.ini` at it:
+
+    python mockPardotServer.py --port 8080
+
+    [Salesforce]
+    url=http://localhost:8080
+    [Pardot]
+    url=http://localhost:8080
+
+To see how the scripts cope with a slower, less reliable API, it can add
+latency to every API call, fail a share of them, and enforce rate, concurrency
+and daily limits, answering just like Pardot does when they are exceeded:
+
+    python mockPardotServer.py --port 8080 --latency-ms 150 --error-rate 0.01 \
+        --max-concurrent 5 --daily-limit 100000
+
+The number of API calls made to each endpoint is available (as JSON) at
+`/mock/stats`.
+"""
+import argparse, collections, itertools, json, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def _ok(**payload):
+    payload['@attributes'] = {'stat': 'ok', 'version': 1}
+    return 200, payload
+
+def _fail(status, errorCode, error):
+    return status, {'@attributes': {'stat': 'fail', 'err_code': errorCode}, 'err': error}
+
+def _token(handler, match):
+    accessToken = 'mock-access-token-{n}'.format(n = next(handler.tokenCounter))
+    with handler.tokensLock:
+        handler.tokens[accessToken] = time.time()
+    return 200, {'access_token': accessToken, 'token_type': 'Bearer'}
+
+def _updateProspect(handler, match):
+    return _ok(prospect={'id': int(match.group('id'))})
+
+def _batchUpdateProspects(handler, match):
+    # version 3 takes the prospects keyed by id, version 4 takes a list of prospects with their id
+    form = parse_qs(handler.body.decode('utf-8'))
+    try:
+        prospects = json.loads(form.get('prospects', [''])[0])['prospects']
+    except (ValueError, KeyError, TypeError):
+        return _fail(400, 71, 'Input needs to be valid JSON or XML')
+    if match.group('version') == '3':
+        valid = isinstance(prospects, dict) and all(isinstance(fields, dict) for fields in prospects.values())
+    else:
+        valid = isinstance(prospects, list) and all(isinstance(fields, dict) and 'id' in fields for fields in prospects)
+    if not valid or not prospects:
+        return _fail(400, 71, 'Input needs to be valid JSON or XML')
+    return _ok()
+
+def _sendEmail(handler, match):
+    return _ok(email={'id': 1})
+
+def _createCustomField(handler, match):
+    form = parse_qs(handler.body.decode('utf-8'))
+    fieldApiName = form.get('field_id', [''])[0]
+    with handler.customFieldsLock:
+        if any(field['field_id'] == fieldApiName for field in handler.customFields.values()):
+            return _fail(400, 1, 'Field ID already in use')
+        fieldId = next(handler.customFieldCounter)
+        handler.customFields[fieldId] = {'id': fieldId, 'name': form.get('name', [''])[0], 'field_id': fieldApiName}
+    return _ok(customField=handler.customFields[fieldId])
+
+def _deleteCustomField(handler, match):
+    with handler.customFieldsLock:
+        if handler.customFields.pop(int(match.group('id')), None) is None:
+            return _fail(400, 31, 'Invalid custom field ID')
+    return 204, None
+
+def _queryCustomFields(handler, match):
+    query = parse_qs(urlparse(handler.path).query)
+    idGreaterThan = int(query.get('id_greater_than', ['0'])[0])
+    limit = int(query.get('limit', ['200'])[0])
+    with handler.customFieldsLock:
+        fields = sorted((field for fieldId, field in handler.customFields.items() if fieldId > idGreaterThan), \
+                        key=lambda field: field['id'])
+    return _ok(result={'total_results': len(fields), 'customField': fields[:limit]})
+
+def _endpoint(path):
+    """Groups API calls by object and action, for example `prospect/batchUpdate`."""
+    pieces = path.split('/') # '', 'api', object, 'version', n, 'do', action...
+    return '/'.join(pieces[2:3] + pieces[6:7])
+
+class MockPardotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, just like the real APIs
+    disable_nagle_algorithm = True
+    tokenLifetime = 0 # seconds before an access token expires, 0 for never
+    tokens = {}       # access token -> when it was issued
+    tokensLock = threading.Lock()
+    tokenCounter = itertools.count(1)
+    customFields = {} # custom field id -> custom field
+    customFieldsLock = threading.Lock()
+    customFieldCounter = itertools.count(1000)
+
+    # simulated API conditions, set from the command line
+    latencySeconds = 0.0 # average time taken by each API call
+    errorRate = 0.0      # share of API calls failing with a 503
+    maxConcurrent = 0    # API calls allowed in flight at once (Pardot error 122 beyond), 0 for no limit
+    requestsPerSecond = 0 # API calls allowed each second (HTTP 429 beyond), 0 for no limit
+    dailyLimit = 0       # API calls allowed in total (Pardot error 66 beyond), 0 for no limit
+    limitsLock = threading.Lock()
+    inFlight = 0
+    callCount = 0
+    currentSecond = 0
+    currentSecondCount = 0
+    endpointCounts = collections.Counter()
+    routes = [
+        ('POST', re.compile(r'^/services/oauth2/token$'), _token),
+        ('POST', re.compile(r'^/api/prospect/version/\d/do/update/id/(?P<id>\d+)$'), _updateProspect),
+        ('POST', re.compile(r'^/api/prospect/version/(?P<version>\d)/do/batchUpdate$'), _batchUpdateProspects),
+        ('POST', re.compile(r'^/api/email/version/\d/do/send/(prospect_id/\d+)?$'), _sendEmail),
+        ('POST', re.compile(r'^/api/customField/version/\d/do/create$'), _createCustomField),
+        ('DELETE', re.compile(r'^/api/customField/version/\d/do/delete/id/(?P<id>\d+)$'), _deleteCustomField),
+        ('GET', re.compile(r'^/api/customField/version/\d/do/query$'), _queryCustomFields),
+    ]
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        path = urlparse(self.path).path
+        if path == '/mock/stats':
+            with self.limitsLock:
+                stats = {'calls': self.callCount, 'endpoints': dict(self.endpointCounts)}
+            self._respond(200, stats)
+            return
+        if path.startswith('/api/'):
+            self._handleApiCall(method, path)
+        else:
+            self._route(method, path)
+
+    def _handleApiCall(self, method, path):
+        with self.limitsLock:
+            cls = type(self)
+            cls.callCount += 1
+            cls.endpointCounts[_endpoint(path)] += 1
+            now = int(time.time())
+            if now != cls.currentSecond:
+                cls.currentSecond, cls.currentSecondCount = now, 0
+            cls.currentSecondCount += 1
+            if self.dailyLimit and self.callCount > self.dailyLimit:
+                failure = _fail(400, 66, 'Daily API rate limit met')
+            elif self.requestsPerSecond and self.currentSecondCount > self.requestsPerSecond:
+                failure = (429, None)
+            elif self.maxConcurrent and self.inFlight >= self.maxConcurrent:
+                failure = _fail(400, 122, 'You have exceeded your concurrent request limit')
+            else:
+                failure = None
+                cls.inFlight += 1
+        if failure is not None:
+            self._respond(*failure)
+            return
+
+        try:
+            if self.latencySeconds:
+                time.sleep(random.uniform(0.5, 1.5) * self.latencySeconds)
+            if not self._validToken():
+                self._respond(*_fail(401, 184, 'access_token is invalid, unverified, or expired'))
+            elif self.errorRate and random.random() < self.errorRate:
+                self._respond(503, None)
+            else:
+                self._route(method, path)
+        finally:
+            with self.limitsLock:
+                type(self).inFlight -= 1
+
+    def _route(self, method, path):
+        for routeMethod, pattern, route in self.routes:
+            match = pattern.match(path)
+            if routeMethod == method and match:
+                status, payload = route(self, match)
+                break
+        else:
+            status, payload = _fail(404, 404, 'Unknown endpoint')
+        self._respond(status, payload)
+
+    def _validToken(self):
+        if not self.tokenLifetime:
+            return True
+        accessToken = (self.headers.get('Authorization') or '')[len('Bearer '):]
+        with self.tokensLock:
+            issued = self.tokens.get(accessToken)
+        return issued is not None and time.time() - issued < self.tokenLifetime
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # thousands of requests a second would drown the console
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local mock of the Salesforce/Pardot APIs')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token-lifetime', type=float, default=0, \
+                        help='seconds before an access token expires (default: never)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='average time taken by each API call')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of API calls failing with a 503 (0-1)')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='API calls allowed in flight at once')
+    parser.add_argument('--requests-per-second', type=int, default=0, help='API calls allowed each second')
+    parser.add_argument('--daily-limit', type=int, default=0, help='API calls allowed in total')
+    args = parser.parse_args()
+    MockPardotHandler.tokenLifetime = args.token_lifetime
+    MockPardotHandler.latencySeconds = args.latency_ms / 1000
+    MockPardotHandler.errorRate = args.error_rate
+    MockPardotHandler.maxConcurrent = args.max_concurrent
+    MockPardotHandler.requestsPerSecond = args.requests_per_second
+    MockPardotHandler.dailyLimit = args.daily_limit
+
+    server = ThreadingHTTPServer((args.host, args.port), MockPardotHandler)
+    print('Mock Pardot API listening on http://{host}:{port}'.format(host = args.host, port = args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""Provides a shared HTTP client for all Salesforce and Pardot API requests.
+
+Opening a new TLS connection for every API call is by far the slowest part of
+sending to a large audience, so every script and helper in this demo goes
+through a single `PardotClient`. It holds a pooled, keep-alive
+`requests.Session`, builds the authorization headers once per access token
+and keeps latency counters for each endpoint it talks to. Every request also
+passes through one rate limiter, so the `requests_per_second` ceiling holds
+no matter how many threads share the client (and, with `rate_limit_path`,
+how many processes share the limit).
+
+Access tokens expire, sometimes in the middle of a long run. When a Legacy API
+request is rejected with an authentication error, the client asks for a new
+token (through the `reauthenticate` callback) and sends the request once more.
+
+Other failures that are likely to go away on their own (connection errors,
+5xx responses, HTTP 429 and Pardot's concurrent request limit) are retried
+with exponential backoff and jitter. Requests that must not be repeated,
+such as sending an email, are only retried when they are known not to have
+reached Pardot (the connection could not be made, or Pardot turned them away
+with HTTP 429 or its concurrent request limit); a timeout or 5xx response may
+mean the email went out, so it is left for the caller to look into.
+
+Once Pardot reports that the daily API limit is reached, every later request
+fails straight away with `RequestFailed`, rather than using up requests that
+are bound to fail.
+"""
+import json, metrics, random, requests, threading, time
+from requests.adapters import HTTPAdapter
+from concurrency import LatencySample, RateLimiter, SharedRateLimiter
+
+# the Pardot error code for an invalid or expired access token
+INVALID_TOKEN_ERROR_CODE = 184
+# the Pardot error code for too many requests in flight at once for the Business Unit
+CONCURRENT_LIMIT_ERROR_CODE = 122
+# the Pardot error code for running out of API requests for the day
+DAILY_LIMIT_ERROR_CODE = 66
+
+class RequestFailed(Exception):
+    """Raised when a request could not get a response at all, or was not even
+    sent because the daily API limit was reached."""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class PardotClient:
+    def __init__(self, config, reauthenticate=None):
+        """
+        Args:
+            config:
+                The configuration dict loaded by demoFunctions.readConfig
+            reauthenticate:
+                Optionally, called with a rejected access token. It should
+                store a new access token in the config
+        """
+        self._config = config
+        self._reauthenticate = reauthenticate
+        self._authLock = threading.Lock()
+        self._pardotUrl = config['Pardot']['url']
+        self._legacyVersion = config['Pardot']['legacy_api_version']
+        self._timeout = config.getfloat('Http', 'timeout', fallback=30)
+
+        poolSize = config.getint('Http', 'pool_size', fallback=10)
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self._session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        requestsPerSecond = config.getfloat('Http', 'requests_per_second', fallback=0)
+        rateLimitPath = config.get('Http', 'rate_limit_path', fallback='')
+        self._rateLimiter = SharedRateLimiter(rateLimitPath, requestsPerSecond) if rateLimitPath \
+                            else RateLimiter(requestsPerSecond)
+        self._maxRetries = config.getint('Http', 'max_retries', fallback=4)
+        self._backoffSeconds = config.getfloat('Http', 'backoff_seconds', fallback=1)
+        self._maxBackoffSeconds = config.getfloat('Http', 'max_backoff_seconds', fallback=30)
+        self._dailyLimitReached = False
+
+        self._headers = None
+        self._headersToken = None
+        self._stats = {}
+        self._statsLock = threading.Lock()
+
+    def headers(self):
+        """Provides the headers needed by every Pardot API request.
+
+        The headers are only rebuilt when the access token stored in the
+        config changes, so they can be shared by every request in a run.
+
+        Returns:
+            a dict containing the Authorization and Business Unit headers
+        """
+        accessToken = self._config['Salesforce'].get('access_token')
+        if self._headers is None or accessToken != self._headersToken:
+            self._headers = {
+                'Authorization': 'Bearer ' + accessToken,
+                'Pardot-Business-Unit-Id': self._config['Pardot']['business_unit_id']
+            }
+            self._headersToken = accessToken
+        return self._headers
+
+    def legacyApiUrl(self, objectName, action):
+        """Builds the URL for a Pardot Legacy API (v3/v4) request.
+
+        Args:
+            objectName:
+                The Pardot object being worked with, such as `prospect`
+            action:
+                Everything after `/do/`, for example `update/id/1234`
+        Returns:
+            the complete URL, asking for a JSON response
+        """
+        return '{pardotUrl}/api/{objectName}/version/{legacyVersion}/do/{action}?format=json' \
+                .format(pardotUrl = self._pardotUrl, \
+                        objectName = objectName, \
+                        legacyVersion = self._legacyVersion, \
+                        action = action)
+
+    def legacyRequest(self, method, objectName, action, idempotent=True, **kwargs):
+        """Sends an authenticated request to the Pardot Legacy API.
+
+        Latency is tracked per endpoint, using the object name and the first
+        piece of the action (for example `prospect/update`). A request rejected
+        because the access token expired is sent again, once, with a new one.
+
+        Args:
+            method:
+                The HTTP method, such as `POST` or `DELETE`
+            objectName:
+                The Pardot object being worked with, such as `prospect`
+            action:
+                Everything after `/do/`, for example `update/id/1234`
+            idempotent:
+                Whether sending the request twice does no harm. False for
+                requests that must never be repeated, such as sending an
+                email (see request)
+            **kwargs:
+                Passed along to `requests.Session.request` (data, params...)
+        Returns:
+            the `requests.Response`
+        """
+        endpoint = '{objectName}/{action}'.format(objectName = objectName, action = action.split('/')[0])
+        url = self.legacyApiUrl(objectName, action)
+        headers = self.headers()
+        response = self.request(method, url, endpoint, idempotent, headers=headers, **kwargs)
+        if self._reauthenticate is not None and self._isAuthError(response):
+            # the request was turned away, so it is safe to send again even when it is not idempotent
+            self._refreshToken(headers['Authorization'][len('Bearer '):])
+            response = self.request(method, url, endpoint, idempotent, headers=self.headers(), **kwargs)
+        return response
+
+    def _isAuthError(self, response):
+        return response.status_code == 401 or _errorCode(response) == INVALID_TOKEN_ERROR_CODE
+
+    def _refreshToken(self, rejectedToken):
+        # many threads may hit the expired token at once, only the first one asks for a new token
+        with self._authLock:
+            if self._config['Salesforce'].get('access_token') == rejectedToken:
+                print('Access token was rejected, authenticating again')
+                self._reauthenticate(rejectedToken)
+
+    def request(self, method, url, endpoint, idempotent=True, **kwargs):
+        """Sends a request through the pooled session, recording its latency.
+
+        Connection errors, 5xx and 429 responses and Pardot's concurrent
+        request limit are retried (up to `max_retries` times, see `[Http]` in
+        config/app.ini), waiting a little longer after each attempt.
+
+        A request that is not idempotent is only retried when it cannot have
+        been acted on: the connection could not be made, or Pardot answered
+        with HTTP 429 or its concurrent request limit. After a timeout or a
+        5xx response it may well have gone through, so it is not sent again.
+
+        Args:
+            method:
+                The HTTP method, such as `POST` or `DELETE`
+            url:
+                The complete URL of the request
+            endpoint:
+                A short label used to group latency counters
+            idempotent:
+                Whether sending the request twice does no harm. False for
+                requests that must never be repeated, such as sending an email
+            **kwargs:
+                Passed along to `requests.Session.request`
+        Returns:
+            the `requests.Response` (of the last attempt, when retries ran out)
+        Raises:
+            RequestFailed: no response could be had, or the daily API limit
+            has been reached
+        """
+        kwargs.setdefault('timeout', self._timeout)
+        attempt = 0
+        while True:
+            if self._dailyLimitReached:
+                raise RequestFailed('daily API limit reached, request not sent')
+            with metrics.timer('api.rateLimitWait'):
+                self._rateLimiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self._session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self._record(endpoint, time.perf_counter() - started, True)
+                # ConnectionError (ConnectTimeout included) means nothing was sent, but a
+                # ReadTimeout may come after Pardot already acted on the request
+                if attempt >= self._maxRetries or not (idempotent or isinstance(e, requests.ConnectionError)):
+                    raise RequestFailed('{error}: {message}'.format(error = type(e).__name__, message = e))
+                retryAfter = None
+            else:
+                errorCode = _errorCode(response)
+                self._record(endpoint, time.perf_counter() - started, response.status_code >= 400 or errorCode is not None)
+                if errorCode == DAILY_LIMIT_ERROR_CODE:
+                    print('Daily API limit reached, no more requests will be sent')
+                    self._dailyLimitReached = True
+                    return response
+                retryable = response.status_code == 429 or errorCode == CONCURRENT_LIMIT_ERROR_CODE \
+                            or (idempotent and response.status_code >= 500)
+                if not retryable or attempt >= self._maxRetries:
+                    return response
+                retryAfter = response.headers.get('Retry-After')
+            self._backoff(attempt, retryAfter)
+            attempt += 1
+
+    def _backoff(self, attempt, retryAfter):
+        # "full jitter": a random wait up to an exponentially growing ceiling, so that many threads
+        # failing at once don't all come back at the same moment
+        ceiling = min(self._maxBackoffSeconds, self._backoffSeconds * 2 ** attempt)
+        seconds = random.uniform(0, ceiling)
+        if retryAfter is not None and retryAfter.isdigit():
+            seconds = max(seconds, min(self._maxBackoffSeconds, float(retryAfter)))
+        metrics.observe('api.backoff', seconds)
+        time.sleep(seconds)
+
+    def _record(self, endpoint, seconds, failed):
+        metrics.observe('api.' + endpoint, seconds)
+        with self._statsLock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = {'errors': 0, 'seconds': LatencySample()}
+            stats['errors'] += 1 if failed else 0
+            stats['seconds'].add(seconds)
+
+    def latencySummary(self):
+        """Summarizes the latency counters collected so far.
+
+        Returns:
+            a dict mapping each endpoint to its request count, error count and
+            mean/p50/p99/max latency in milliseconds
+        """
+        summary = {}
+        with self._statsLock:
+            for endpoint, stats in self._stats.items():
+                seconds = stats['seconds']
+                p50, p99 = seconds.percentiles(50, 99)
+                summary[endpoint] = {
+                    'count': seconds.count,
+                    'errors': stats['errors'],
+                    'mean_ms': 1000 * seconds.total / seconds.count,
+                    'p50_ms': 1000 * p50,
+                    'p99_ms': 1000 * p99,
+                    'max_ms': 1000 * seconds.max
+                }
+        return summary
+
+    def printStats(self):
+        """Prints the latency counters for every endpoint used so far.
+
+        When `stats_path` is set in the `[Http]` section of config/app.ini,
+        they are also saved there as JSON, for benchmarks to pick up.
+        """
+        summary = self.latencySummary()
+        printLatencySummary(summary)
+        statsPath = self._config.get('Http', 'stats_path', fallback='')
+        if statsPath:
+            with open(statsPath, 'w') as statsFile:
+                json.dump(summary, statsFile, indent=2)
+
+    def close(self):
+        """Closes every pooled connection."""
+        self._session.close()
+
+def printLatencySummary(summary):
+    """Prints a latency summary, as provided by PardotClient.latencySummary."""
+    for endpoint, stats in sorted(summary.items()):
+        print('{endpoint}: {count} requests ({errors} errors), mean {mean_ms:.1f}ms, '\
+                'p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, max {max_ms:.1f}ms' \
+                .format(endpoint = endpoint, **stats))
+
+def mergeLatencySummaries(summaries):
+    """Combines the latency summaries of several processes, such as the shards of a run.
+
+    Counts add up and means are weighted by count. Percentiles can't be
+    recovered from summaries, so the merged p50 is weighted like the mean and
+    the merged p99 is the worst of the p99s, erring on the slow side.
+
+    Args:
+        summaries:
+            The summaries to combine, as provided by PardotClient.latencySummary
+    Returns:
+        a single summary, in the same form
+    """
+    merged = {}
+    for summary in summaries:
+        for endpoint, stats in summary.items():
+            total = merged.get(endpoint)
+            if total is None:
+                merged[endpoint] = dict(stats)
+                continue
+            count = total['count'] + stats['count']
+            for key in ('mean_ms', 'p50_ms'):
+                total[key] = (total[key] * total['count'] + stats[key] * stats['count']) / count
+            total['p99_ms'] = max(total['p99_ms'], stats['p99_ms'])
+            total['max_ms'] = max(total['max_ms'], stats['max_ms'])
+            total['errors'] += stats['errors']
+            total['count'] = count
+    return merged
+
+def _errorCode(response):
+    """Provides the Pardot error code of a failed Legacy API response, or None."""
+    # most responses are fine, so only parse the ones that look like a failure
+    if response.status_code < 400 and b'"fail"' not in response.content:
+        return None
+    try:
+        return int(response.json().get('@attributes', {}).get('err_code'))
+    except (ValueError, TypeError, AttributeError):
+        return None
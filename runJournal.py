@@ -0,0 +1,74 @@
+"""Records how far a send run got, so it can be resumed after a crash.
+
+Each script writes its progress to its own journal: one line per step done for
+a recipient (for example, `sent` for Prospect 1234). Lines are only ever
+appended, with a single small write each, so keeping the journal costs next to
+nothing, even with many threads writing at once. A run that is killed halfway
+loses at most the line being written, which is cut off when the journal is
+resumed, so the next line is not appended to it.
+
+Started with `--resume`, a script reads its journal back and skips whatever
+was already done. Without it, the journal is started over.
+"""
+import os
+
+class RunJournal:
+    def __init__(self, path, resume=False):
+        """
+        Args:
+            path:
+                The journal file
+            resume:
+                Read back the steps recorded by the previous run. Otherwise,
+                they are forgotten and the journal starts over
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._path = path
+        self._steps = {}
+        if resume and os.path.isfile(path):
+            self._load()
+        # O_APPEND makes each write land at the end of the file, whole, without any locking
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC)
+        self._fd = os.open(path, flags, 0o644)
+
+    def _load(self):
+        complete = 0 # bytes, up to the end of the last whole line
+        with open(self._path, 'rb') as journalFile:
+            for line in journalFile:
+                if not line.endswith(b'\n'):
+                    break # the run was killed while writing this line
+                complete += len(line)
+                step, _, key = line.decode('utf-8').rstrip('\n').partition('\t')
+                self._steps.setdefault(step, set()).add(key)
+        if complete < os.path.getsize(self._path):
+            # drop the partial line, otherwise the next step recorded would be appended to it and lost
+            os.truncate(self._path, complete)
+
+    def record(self, step, key):
+        """Records that a step was done, for example `record('sent', prospectId)`."""
+        self.recordMany(step, [key])
+
+    def recordMany(self, step, keys):
+        """Records that a step was done for many keys, with a single write."""
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        os.write(self._fd, ''.join('{step}\t{key}\n'.format(step = step, key = key) for key in keys).encode('utf-8'))
+        self._steps.setdefault(step, set()).update(keys)
+
+    def has(self, step, key):
+        """Tells whether a step was recorded for a key, by this run or the one resumed."""
+        keys = self._steps.get(step)
+        return keys is not None and str(key) in keys
+
+    def keys(self, step):
+        """Provides every key a step was recorded for."""
+        return set(self._steps.get(step, ()))
+
+    def count(self, step):
+        return len(self._steps.get(step, ()))
+
+    def close(self):
+        os.close(self._fd)
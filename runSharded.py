@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Runs scripts 2, 3 or 4 as several processes, each sending to a shard of the recipients.
+
+Recipients are split into shards by Prospect id (see dataServices.shardOf), and
+the script is run once for each shard, a few processes at a time. Since each
+shard is a process of its own, the work is spread over every core rather than
+waiting on a single interpreter. The processes still share the API: they take
+turns through the rate limit file (`rate_limit_path` in the `[Http]` section of
+config/app.ini), so together they stay under `requests_per_second`.
+
+    python runSharded.py 3 --shards 8              # 8 shards, as many processes as cores
+    python runSharded.py 4 --shards 8 --resume     # retry the shards that failed
+
+Shards are handed out through a small SQLite file (--queue). More machines can
+help with a run by sharing that file (and the rest of the project directory)
+and starting `runSharded.py <script> --join` on each of them.
+
+Once every shard is done, the last instance to finish merges the API stats,
+metrics and dead letters of the shards and, for script 4, sends the email to
+the list, once.
+"""
+import argparse, demoFunctions, json, metrics, os, socket, subprocess, sys, threading, uuid
+from cleanupQueue import CleanupQueue
+from pardotClient import mergeLatencySummaries, printLatencySummary
+from shardQueue import ShardQueue
+
+SCRIPTS = {
+    '2': '2-sendCompleteHtmlToProspects.py',
+    '3': '3-sendUsingPardotTemplateOneToOne.py',
+    '4': '4-sendUsingPardotTemplateList.py',
+}
+
+parser = argparse.ArgumentParser(description='Runs a send script as several processes, one shard of the recipients each')
+parser.add_argument('script', choices=sorted(SCRIPTS), help='the script to run')
+parser.add_argument('--shards', type=int, help='the number of shards (defaults to [Sharding] shards, or the number of cores)')
+parser.add_argument('--processes', type=int, help='shards to run at once (defaults to [Sharding] processes, or the number of cores)')
+parser.add_argument('--resume', action='store_true', help='retry the shards that failed or were interrupted')
+parser.add_argument('--join', action='store_true', help='help with a run another instance started, without starting over')
+parser.add_argument('--queue', help='the file shards are handed out from (shared by every instance helping with a run)')
+args = parser.parse_args()
+
+# read our configuration
+config = demoFunctions.readConfig()
+script = SCRIPTS[args.script]
+scriptName = os.path.splitext(script)[0]
+directory = config.get('Sharding', 'directory', fallback='.cache/shards')
+os.makedirs(directory, exist_ok=True)
+queue = ShardQueue(args.queue or os.path.join(directory, scriptName + '.queue.sqlite'))
+
+if args.join or args.resume:
+    if queue.value('shards') is None:
+        print('there is no run of {scriptName} to pick up, start one first'.format(scriptName = scriptName))
+        sys.exit(1)
+    if args.resume:
+        queue.resume()
+else:
+    shards = args.shards or config.getint('Sharding', 'shards', fallback=0) or os.cpu_count() or 1
+    queue.start(shards, uuid.uuid4().hex)
+shards = int(queue.value('shards'))
+runId = queue.value('run_id')
+processes = args.processes or config.getint('Sharding', 'processes', fallback=0) or os.cpu_count() or 1
+print('running {scriptName} in {shards} shards, {processes} at a time'.format(scriptName = scriptName, \
+                                                                          shards = shards, processes = processes))
+
+def runShard(shard, attempts):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script), \
+               '--shard', str(shard), '--shards', str(shards)]
+    if attempts > 0:
+        # the shard was started before, its journal knows what was already done
+        command.append('--resume')
+    if args.script == '4':
+        command += ['--run-id', runId]
+    logPath = demoFunctions.shardFilePath(os.path.join(directory, scriptName + '.log'), shard, shards)
+    with open(logPath, 'a' if attempts > 0 else 'w') as logFile:
+        return subprocess.call(command, stdin=subprocess.DEVNULL, stdout=logFile, stderr=subprocess.STDOUT), logPath
+
+def work():
+    worker = '{host}:{pid}:{thread}'.format(host = socket.gethostname(), pid = os.getpid(), \
+                                            thread = threading.current_thread().name)
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            return
+        shard, attempts = claimed
+        exitCode, logPath = runShard(shard, attempts)
+        queue.finish(shard, exitCode)
+        print('shard {shard} {outcome}, see {logPath}'.format(shard = shard, logPath = logPath, \
+                outcome = 'done' if exitCode == 0 else 'failed with exit code {code}'.format(code = exitCode)))
+
+threads = [threading.Thread(target=work, name='shard-worker-{n}'.format(n = n)) for n in range(processes)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+counts = queue.counts()
+if not queue.claimFinish():
+    queue.close()
+    if counts.get('failed'):
+        print('{failed} shards failed, run again with --resume once the failures are sorted out' \
+                .format(failed = counts['failed']))
+        sys.exit(5)
+    if counts.get('done', 0) == shards:
+        print('every shard is done, and the run was already finished')
+        sys.exit(0)
+    print('{done} of {shards} shards done, the other instances helping with the run will finish it' \
+            .format(done = counts.get('done', 0), shards = shards))
+    sys.exit(0)
+
+# every shard is done, and this instance is the one finishing the run
+summaries = []
+shardMetrics = []
+deadLetters = demoFunctions.getDeadLetters(config)
+for shard in range(shards):
+    statsPath = demoFunctions.shardStatsPath(config, script, shard, shards)
+    if os.path.isfile(statsPath):
+        with open(statsPath) as statsFile:
+            summaries.append(json.load(statsFile))
+    shardMetricsPath = demoFunctions.shardMetricsPath(config, script, shard, shards)
+    if os.path.isfile(shardMetricsPath):
+        with open(shardMetricsPath) as metricsFile:
+            shardMetrics.append(json.load(metricsFile))
+    deadLetters.mergeFrom(demoFunctions.shardFilePath(deadLetters.path(), shard, shards))
+printLatencySummary(mergeLatencySummaries(summaries))
+
+def writeMetrics():
+    # the stages of every shard, along with whatever this process did to finish the run
+    merged = metrics.mergeSummaries(shardMetrics + [metrics.summary()])
+    metrics.printSummary(merged)
+    path = demoFunctions.metricsPath(config, script)
+    metrics.writeSummary(merged, path, {'script': scriptName, 'shards': shards})
+    print('metrics saved to {path}'.format(path = path))
+
+if args.script == '4' and queue.value('list_sent') != '1':
+    # a single API call to send the email to the List, now that every shard updated its prospects
+    demoFunctions.authenticate(config)
+    print('done updating prospects, sending email now')
+    sent = demoFunctions.sendListEmail(config)
+    if sent:
+        queue.setValue('list_sent', '1')
+    else:
+        # leave the finishing to whoever resumes the run
+        queue.releaseFinish()
+    cleanupQueue = CleanupQueue(config.get('Cleanup', 'queue_path', fallback='.cache/cleanupQueue.sqlite'))
+    demoFunctions.scheduleListCleanups(config, cleanupQueue, runId, sent)
+    cleanupQueue.close()
+    demoFunctions.getClient(config).printStats()
+    queue.close()
+    demoFunctions.reportDeadLetters(config)
+    writeMetrics()
+    if not sent:
+        sys.exit(5)
+else:
+    queue.close()
+    demoFunctions.reportDeadLetters(config)
+    writeMetrics()
+print('Script executed successfully')
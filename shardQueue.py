@@ -0,0 +1,124 @@
+"""Hands out the shards of a sharded run to the processes working on it.
+
+runSharded.py splits the recipients of a run into shards (see
+dataServices.shardOf) and runs a script once for each shard. The shards are
+kept in a small SQLite file, each one claimed before it is worked on, so
+several runSharded.py instances (on one machine, or on several machines
+sharing the file) can work through the same run without doing a shard twice.
+
+The file also remembers the run itself: how many shards it has, its id, and
+whether the work that happens once every shard is done (merging stats,
+sending a list email) has been taken care of.
+"""
+import os, sqlite3, threading, time
+
+class ShardQueue:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS shard ('
+                                 'shard INTEGER PRIMARY KEY, status TEXT NOT NULL, worker TEXT, '
+                                 'claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0, exit_code INTEGER)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+
+    def start(self, shards, runId):
+        """Starts a new run, forgetting any previous one.
+
+        Args:
+            shards:
+                The number of shards to split the recipients into
+            runId:
+                Identifies the run, shared by every shard
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.execute('DELETE FROM shard')
+            self._connection.execute('DELETE FROM run')
+            self._connection.executemany("INSERT INTO shard (shard, status) VALUES (?, 'pending')", \
+                                         [(shard,) for shard in range(shards)])
+            self._connection.executemany('INSERT INTO run (key, value) VALUES (?, ?)', \
+                                         [('shards', str(shards)), ('run_id', runId), ('finished', '0')])
+            self._connection.execute('COMMIT')
+
+    def resume(self):
+        """Puts every shard that failed, or was left running by an interrupted
+        run, back in line. Only do this when no other instance is working on
+        the run."""
+        with self._lock:
+            self._connection.execute("UPDATE shard SET status = 'pending', worker = NULL, claimed_at = NULL "
+                                     "WHERE status IN ('failed', 'running')")
+
+    def value(self, key):
+        """Provides something remembered about the run (`shards`, `run_id`...), or None."""
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM run WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def setValue(self, key, value):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO run (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def claim(self, worker):
+        """Claims the next pending shard.
+
+        Args:
+            worker:
+                Describes who is working on the shard, for example the host
+                name and process id
+        Returns:
+            a tuple of the shard number and how many times it was claimed
+            before, or None when no shard is pending
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute("SELECT shard, attempts FROM shard WHERE status = 'pending' "
+                                               "ORDER BY shard LIMIT 1").fetchone()
+                if row is not None:
+                    self._connection.execute("UPDATE shard SET status = 'running', worker = ?, claimed_at = ?, "
+                                             "attempts = attempts + 1 WHERE shard = ?", (worker, time.time(), row[0]))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return row
+
+    def finish(self, shard, exitCode):
+        """Records how a shard went: done when its script exited with 0, failed otherwise."""
+        with self._lock:
+            self._connection.execute('UPDATE shard SET status = ?, exit_code = ? WHERE shard = ?', \
+                                     ('done' if exitCode == 0 else 'failed', exitCode, shard))
+
+    def counts(self):
+        """Provides the number of shards in each status (pending, running, done, failed)."""
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM shard GROUP BY status').fetchall())
+
+    def claimFinish(self):
+        """Claims the work to do once every shard is done.
+
+        Returns:
+            True for exactly one caller, once every shard is done
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                notDone = self._connection.execute("SELECT COUNT(*) FROM shard WHERE status != 'done'").fetchone()[0]
+                claimed = notDone == 0 and self._connection.execute("UPDATE run SET value = '1' "
+                                                                    "WHERE key = 'finished' AND value = '0'").rowcount == 1
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def releaseFinish(self):
+        """Gives the finishing work back, for example when the list email could not be sent."""
+        self.setValue('finished', '0')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
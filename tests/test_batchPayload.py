@@ -0,0 +1,67 @@
+"""Checks the Prospect batch update payloads of both Legacy API versions.
+
+Run from the root of the project with `python -m pytest tests` (or
+`python -m unittest discover tests`).
+"""
+import json, os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batchPayload
+from batchPayload import BatchPayload, encodeBatch
+
+BATCH = [
+    {'id': 1234, 'PD2021_Listing_Count': 2, 'PD2021_Listing_AgentName': 'Deniece', 'PD2021_Listing1_Price': '$340,000'},
+    {'id': '5678', 'PD2021_Listing_Count': 1, 'PD2021_Listing_AgentName': 'James', 'PD2021_Listing1_Price': ''},
+]
+# non ASCII values and the characters JSON escapes
+TRICKY = {'id': 1, 'PD2021_Listing_AgentName': 'Zoë "the closer" \\ O\'Brien\n☃', 'PD2021_Listing_Count': 0}
+
+class BatchPayloadTest(unittest.TestCase):
+    def test_version4_is_a_list_of_prospects(self):
+        self.assertEqual(encodeBatch(BATCH, 4),
+                         '{"prospects":['
+                         '{"id":1234,"PD2021_Listing_Count":2,"PD2021_Listing_AgentName":"Deniece","PD2021_Listing1_Price":"$340,000"},'
+                         '{"id":"5678","PD2021_Listing_Count":1,"PD2021_Listing_AgentName":"James","PD2021_Listing1_Price":""}'
+                         ']}')
+
+    def test_version3_is_keyed_by_id_without_the_id_among_the_fields(self):
+        self.assertEqual(encodeBatch(BATCH, 3),
+                         '{"prospects":{'
+                         '"1234":{"PD2021_Listing_Count":2,"PD2021_Listing_AgentName":"Deniece","PD2021_Listing1_Price":"$340,000"},'
+                         '"5678":{"PD2021_Listing_Count":1,"PD2021_Listing_AgentName":"James","PD2021_Listing1_Price":""}'
+                         '}}')
+
+    def test_api_version_can_be_text_from_the_config(self):
+        self.assertEqual(encodeBatch(BATCH, '3'), encodeBatch(BATCH, 3))
+        self.assertEqual(encodeBatch(BATCH, '4'), encodeBatch(BATCH, 4))
+
+    def test_escaped_and_non_ascii_values_decode_back(self):
+        for apiVersion in (3, 4):
+            decoded = json.loads(encodeBatch([TRICKY], apiVersion))['prospects']
+            prospect = decoded['1'] if apiVersion == 3 else decoded[0]
+            self.assertEqual(prospect['PD2021_Listing_AgentName'], TRICKY['PD2021_Listing_AgentName'])
+        self.assertIn('Zoë', encodeBatch([TRICKY], 4)) # not escaped as ë
+
+    def test_size_counts_every_piece_and_comma(self):
+        payload = BatchPayload(4)
+        for prospect in BATCH:
+            payload.add(prospect, payload.encodeProspect(prospect))
+        self.assertEqual(len(payload), 2)
+        self.assertEqual(payload.prospects, BATCH)
+        # the pieces, each with a comma, plus the wrapping minus the comma the last piece doesn't need
+        self.assertEqual(payload.size + len('{"prospects":[]}') - 1, len(payload.encode()))
+
+    @unittest.skipIf(batchPayload.orjson is None, 'orjson is not installed')
+    def test_both_encoders_give_the_same_bytes(self):
+        for apiVersion in (3, 4):
+            for batch in (BATCH, [TRICKY]):
+                texts = []
+                for encoder in (batchPayload.stdlibDumps, batchPayload.orjsonDumps):
+                    payload = BatchPayload(apiVersion, encoder)
+                    for prospect in batch:
+                        payload.add(prospect)
+                    texts.append(payload.encode().encode('utf-8'))
+                self.assertEqual(texts[0], texts[1])
+
+if __name__ == '__main__':
+    unittest.main()
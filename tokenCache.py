@@ -0,0 +1,103 @@
+"""Keeps Salesforce access tokens on disk, so runs can share them.
+
+Every script used to log in with the Username/Password OAuth flow when it
+started, even when the previous run got a perfectly good token a minute
+earlier. `TokenCache` saves each token in a small JSON file along with when it
+should be considered expired, so back-to-back runs and parallel workers skip
+the login call.
+
+Salesforce does not say how long a token lasts (that is up to the session
+settings of the org), so tokens are trusted for a configured time to live.
+A token rejected before then is simply replaced (see demoFunctions.authenticate).
+
+The file is only ever replaced as a whole, so readers never see half a write.
+Logging in happens while holding a lock file, so when several processes find
+the cache empty at the same time, only one of them logs in and the others pick
+up its token. The lock file needs `fcntl`, so on Windows only the threads of a
+single process are kept in step.
+"""
+import json, os, threading, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class TokenCache:
+    def __init__(self, path, ttlSeconds):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._path = path
+        self._ttlSeconds = ttlSeconds
+        self._lock = threading.RLock()
+        self._lockDepth = 0
+        self._lockFile = None
+
+    def get(self, key):
+        """Provides a cached access token, unless it has expired.
+
+        Args:
+            key:
+                Identifies the org and user the token belongs to
+        Returns:
+            the access token, or None when there is no valid token for key
+        """
+        entry = self._read().get(key)
+        if entry is None or entry.get('expires_at', 0) <= time.time():
+            return None
+        return entry.get('access_token')
+
+    def put(self, key, accessToken):
+        """Saves a new access token, valid for the configured time to live."""
+        with self.locked():
+            entries = self._read()
+            now = time.time()
+            entries = {k: entry for k, entry in entries.items() if entry.get('expires_at', 0) > now}
+            entries[key] = {'access_token': accessToken, 'expires_at': now + self._ttlSeconds}
+            self._write(entries)
+
+    def locked(self):
+        """Provides a context manager holding the cache for this thread and
+        process, for example while logging in. It can be nested."""
+        return _CacheLock(self)
+
+    def _acquire(self):
+        self._lock.acquire()
+        if self._lockDepth == 0 and fcntl is not None:
+            self._lockFile = open(self._path + '.lock', 'a')
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+        self._lockDepth += 1
+
+    def _release(self):
+        self._lockDepth -= 1
+        if self._lockDepth == 0 and self._lockFile is not None:
+            fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+            self._lockFile.close()
+            self._lockFile = None
+        self._lock.release()
+
+    def _read(self):
+        try:
+            with open(self._path) as cacheFile:
+                return json.load(cacheFile)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        # tokens are as good as a password for a while, so only the owner may read them
+        temporaryPath = '{path}.{pid}.tmp'.format(path = self._path, pid = os.getpid())
+        with os.fdopen(os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cacheFile:
+            json.dump(entries, cacheFile)
+        os.replace(temporaryPath, self._path)
+
+class _CacheLock:
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __enter__(self):
+        self._cache._acquire()
+        return self._cache
+
+    def __exit__(self, *exc):
+        self._cache._release()